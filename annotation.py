@@ -3,15 +3,35 @@ Some links:
 https://gitlab.com/postgres/postgres/blob/master/src/include/nodes/plannodes.h
 https://docs.gitlab.com/ee/development/understanding_explain_plans.html
 """
+import html
+import re
+
+from markupsafe import Markup
+
+COLLAPSED_RELATIONS_SHOWN = 5
 
 class FontFormat:
     """
-        Class to define constants, which are used for formating the annotations
-    """
-    BOLD_START = "<b>"
-    BOLD_END = "</b>"
-    ITALIC_START = "<em>"
-    ITALIC_END = "</em>"
+        Class to define constants, which are used for formating the annotations.
+        Annotations mark formatted words with control characters rather than HTML tags,
+        and are rendered to HTML or text only where they are shown.
+    """
+    BOLD_START = "\x02"
+    BOLD_END = "\x03"
+    ITALIC_START = "\x0e"
+    ITALIC_END = "\x0f"
+    BOLD = 1
+    ITALIC = 2
+    MARKERS = {
+        BOLD_START: (BOLD, True),
+        BOLD_END: (BOLD, False),
+        ITALIC_START: (ITALIC, True),
+        ITALIC_END: (ITALIC, False),
+    }
+    HTML_TAGS = [(BOLD, "<b>", "</b>"), (ITALIC, "<em>", "</em>")]
+
+
+ANNOTATION_MARKER = re.compile("([" + "".join(FontFormat.MARKERS) + "])")
 
 
 def make_bold(string):
@@ -26,6 +46,49 @@ def make_italic(string):
     """
     return FontFormat.ITALIC_START + string + FontFormat.ITALIC_END
 
+def annotation_tokens(annotation):
+    """
+        Splits an annotation into [text, style] tokens, where style is a combination of
+        FontFormat.BOLD and FontFormat.ITALIC, or 0 for plain text
+    """
+    tokens = []
+    style = 0
+    # Splitting on the markers alternates text and markers, starting and ending with text
+    parts = ANNOTATION_MARKER.split(annotation)
+    for index, part in enumerate(parts):
+        if index % 2:
+            flag, opens = FontFormat.MARKERS[part]
+            style = style | flag if opens else style & ~flag
+        elif part:
+            tokens.append([part, style])
+    return tokens
+
+
+def render_html(annotation):
+    """
+        Renders an annotation, or its tokens, to HTML, escaping the text taken from the query
+    """
+    if isinstance(annotation, str):
+        annotation = annotation_tokens(annotation)
+    result = ""
+    for text, style in annotation:
+        text = html.escape(text, quote=False)
+        for flag, start, end in FontFormat.HTML_TAGS:
+            if style & flag:
+                text = start + text + end
+        result += text
+    return Markup(result)
+
+
+def render_text(annotation):
+    """
+        Renders an annotation, or its tokens, to plain text
+    """
+    if isinstance(annotation, str):
+        annotation = annotation_tokens(annotation)
+    return "".join(text for text, _ in annotation)
+
+
 def retrieve_aqp_annotation(query_plan:dict, comparison:dict):
     """
         Checks if any of the node type's query is in the comparison's keys,
@@ -33,21 +96,94 @@ def retrieve_aqp_annotation(query_plan:dict, comparison:dict):
 
         Works because each annotation function is called only when it's relevant plan is retrieved.
     """
-    query_values = list(query_plan.values())
-    compare_keys = list(comparison.keys())
+    if not comparison:
+        return None
 
-    for query_value in query_values:
-        if query_value in compare_keys:
-            return comparison.get(query_value)
+    for query_value in query_plan.values():
+        # Comparisons of lists such as sort and group keys are indexed by tuples
+        if type(query_value) is list:
+            query_value = tuple(query_value)
+        try:
+            if query_value in comparison:
+                return comparison[query_value]
+        except TypeError:
+            # Values that cannot be hashed, such as the children of the node, are never compared
+            continue
 
     return None
 
 
-def default_annotation(query_plan):
+def parallel_annotation(query_plan):
+    """
+        Describes how a node takes part in a parallel plan, or returns an empty string
+        if the node is not parallel aware
+    """
+    if not query_plan.get("Parallel Aware"):
+        return ""
+    return f" The work is {make_bold('shared between parallel workers')}, each worker processing a portion of the rows."
+
+
+def collapsed_annotation(query_plan):
+    """
+        Describes the nodes that a collapsed node stands for, or returns an empty string
+        if the node was not collapsed
+    """
+    count = query_plan.get("Collapsed Count", 1)
+    if count <= 1:
+        return ""
+
+    result = f" This operation stands for {make_bold(str(count))} operations of the same shape"
+    relations = query_plan.get("Collapsed Relations", [])
+    if relations:
+        shown = ", ".join(make_bold(relation) for relation in relations[:COLLAPSED_RELATIONS_SHOWN])
+        if len(relations) > COLLAPSED_RELATIONS_SHOWN:
+            shown += f" and {len(relations) - COLLAPSED_RELATIONS_SHOWN} more"
+        result += f" on {shown}"
+    low, high = query_plan["Collapsed Cost Range"]
+    result += f", costing from {low:.2f} to {high:.2f} each and {query_plan['Collapsed Total Cost']:.2f} in total."
+    return result
+
+
+def partial_aggregate_annotation(query_plan):
+    """
+        Describes the partial or finalize stage of a parallel aggregate, or returns an empty string
+        for a simple aggregate
+    """
+    partial_mode = query_plan.get("Partial Mode", "Simple")
+    if partial_mode == "Partial":
+        return f"Each parallel worker computes a {make_bold('partial')} aggregate over its own rows."
+    if partial_mode == "Finalize":
+        return f"The partial aggregates from the parallel workers are {make_bold('finalized')} into the result."
+    return ""
+
+
+def format_kilobytes(kilobytes):
+    """
+        Formats an amount of memory in kB the way PostgreSQL shows work_mem, e.g. 64kB, 4MB or 1GB
+    """
+    for unit in ["kB", "MB", "GB"]:
+        if kilobytes < 1024 or unit == "GB":
+            return f"{kilobytes:.0f}{unit}" if kilobytes == int(kilobytes) else f"{kilobytes:.1f}{unit}"
+        kilobytes /= 1024
+
+
+def work_mem_annotation(min_work_mem, work_mem):
+    """
+        Describes the work_mem that a sort or hash needs to run in memory rather than spill to disk,
+        compared with the current work_mem
+    """
+    if min_work_mem > work_mem:
+        return (f" It spills to disk with the current {make_italic('work_mem')} of {format_kilobytes(work_mem)},"
+                f" and needs at least {make_bold(format_kilobytes(min_work_mem))} to run in memory.")
+    return (f" It runs in memory, which needs a {make_italic('work_mem')} of at least"
+            f" {make_bold(format_kilobytes(min_work_mem))}.")
+
+
+def default_annotation(query_plan, comparison=None):
     """
          Default Annotation if none of the node types are identified in the annotation functions listed below
     """
-    return f"The {make_italic(query_plan['Node Type'])} operation is performed."
+    return f"The {make_italic(query_plan['Node Type'])} operation is performed.{parallel_annotation(query_plan)}"
 
 
 
@@ -57,10 +193,13 @@ def append_annotation(query_plan, comparison):
     """
     aqp_annotation = retrieve_aqp_annotation(query_plan, comparison)
 
+    result = f"The {make_italic(query_plan['Node Type'])} operation combines the results of the child sub-operations."
+    result += parallel_annotation(query_plan)
+
     if aqp_annotation is not None:
-        return f"The {make_italic(query_plan['Node Type'])} operation combines the results of the child sub-operations. {aqp_annotation}"
+        return f"{result} {aqp_annotation}"
     else:
-        return f"The {make_italic(query_plan['Node Type'])} operation combines the results of the child sub-operations."
+        return result
 
 
 
@@ -157,10 +296,33 @@ def hash_func_annotation(query_plan, comparison):
     """
     aqp_annotation = retrieve_aqp_annotation(query_plan, comparison)
 
+    result = f"The {make_italic(query_plan['Node Type'])} function hashes the query rows into memory, for use by its parent operation."
+    result += parallel_annotation(query_plan)
+
+    if aqp_annotation is not None:
+        return f"{result} {aqp_annotation}"
+    else:
+        return result
+
+def gather_annotation(query_plan, comparison):
+    """
+        Generates annotation for gather
+    """
+    aqp_annotation = retrieve_aqp_annotation(query_plan, comparison)
+
+    result = f"The {make_italic(query_plan['Node Type'])} operation runs the sub-operations in parallel"
+
+    # Get the number of parallel workers planned
+    if "Workers Planned" in query_plan:
+        result += f" with {make_bold(str(query_plan['Workers Planned']))} worker(s)"
+
+    result += " and collects their output in any order."
+
     if aqp_annotation is not None:
-        return f"The {make_italic(query_plan['Node Type'])} function hashes the query rows into memory, for use by its parent operation. {aqp_annotation}"
+        return f"{result} {aqp_annotation}"
     else:
-        return f"The {make_italic(query_plan['Node Type'])} function hashes the query rows into memory, for use by its parent operation."
+        return result
+
 
 def gather_merge_annotation(query_plan, comparison):
     """
@@ -168,10 +330,18 @@ def gather_merge_annotation(query_plan, comparison):
     """
     aqp_annotation = retrieve_aqp_annotation(query_plan, comparison)
 
+    result = f"The {make_italic(query_plan['Node Type'])} operation combines the output table from sub-operations by executing the operation in parallel"
+
+    # Get the number of parallel workers planned
+    if "Workers Planned" in query_plan:
+        result += f" with {make_bold(str(query_plan['Workers Planned']))} worker(s)"
+
+    result += ", merging the sorted output of each worker to preserve the sort order."
+
     if aqp_annotation is not None:
-        return f"The {make_italic(query_plan['Node Type'])} operation combines the output table from sub-operations by executing the operation in parallel. {aqp_annotation}"
+        return f"{result} {aqp_annotation}"
     else:
-        return f"The {make_italic(query_plan['Node Type'])} operation combines the output table from sub-operations by executing the operation in parallel."
+        return result
 
 
 def aggregate_annotation(query_plan, comparison):
@@ -184,6 +354,11 @@ def aggregate_annotation(query_plan, comparison):
     # Obtain strategy from query plan
     strategy = query_plan["Strategy"]
 
+    # Describe the parallel stage of the aggregate ahead of the AQP comparison, if any
+    partial_annotation = partial_aggregate_annotation(query_plan)
+    if partial_annotation:
+        aqp_annotation = partial_annotation if aqp_annotation is None else f"{partial_annotation} {aqp_annotation}"
+
     # Sorted strategy
     if strategy == "Sorted":
         result = f"The {make_italic(query_plan['Node Type'])} operation sorts the tuples based on their keys, "
@@ -306,6 +481,8 @@ def index_scan_annotation(query_plan, comparison):
     if "Filter" in query_plan:
         result += f" The result is further filtered by {make_bold(query_plan['Filter'].replace('::text', ''))}."
 
+    result += parallel_annotation(query_plan)
+
     if aqp_annotation is not None:
         return f"{result} {aqp_annotation}"
     else:
@@ -333,6 +510,8 @@ def index_only_scan_annotation(query_plan, comparison):
     if "Filter" in query_plan:
         result += f" The result is further filtered by {make_bold(query_plan['Filter'].replace('::text', ''))}."
 
+    result += parallel_annotation(query_plan)
+
     if aqp_annotation is not None:
         return f"{result} {aqp_annotation}"
     else:
@@ -414,6 +593,8 @@ def sequential_scan_annotation(query_plan, comparison):
 
     result += "."
 
+    result += parallel_annotation(query_plan)
+
     if aqp_annotation is not None:
         return f"{result} {aqp_annotation}"
     else:
@@ -470,6 +651,8 @@ def hash_join_annotation(query_plan, comparison):
 
     result += "."
 
+    result += parallel_annotation(query_plan)
+
     if aqp_annotation is not None:
         return f"{result} {aqp_annotation}"
     else:
@@ -502,6 +685,7 @@ class Annotation(object):
         "Sort": sort_annotation,
         "Hash": hash_func_annotation,
         "Hash Join": hash_join_annotation,
+        "Gather": gather_annotation,
         "Gather Merge": gather_merge_annotation,
     }
 
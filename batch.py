@@ -0,0 +1,212 @@
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from multiprocessing import Pool
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+from preprocessing import *
+
+worker_processor = None
+worker_output_dir = None
+
+# Where a statement may end, or a literal, identifier, dollar-quoted body or comment that may contain a semicolon begins
+SQL_BOUNDARY = re.compile(r"""[;'"]|--|/\*|(?<![\w$])\$(?:[A-Za-z_]\w*)?\$""")
+SQL_BLOCK_COMMENT = re.compile(r"/\*|\*/")
+SQL_QUOTE_END = {"'": re.compile(r"(?:[^']|'')*'"), '"': re.compile(r'(?:[^"]|"")*"')}
+SQL_ESCAPED_STRING_END = re.compile(r"(?:[^'\\]|''|\\.)*'", re.S)
+SQL_ESCAPE_STRING = re.compile(r"(?<![\w$])[Ee]\Z")
+
+
+def find_query_files(paths) -> list:
+    """Finds the .sql files to explain.
+
+    Args:
+        paths (list): Paths of .sql files, or of directories searched recursively for .sql files.
+
+    Returns:
+        list: Sorted paths of the .sql files.
+    """
+    query_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, file_names in os.walk(path):
+                query_files += [os.path.join(directory, name) for name in file_names if name.endswith(".sql")]
+        else:
+            query_files.append(path)
+    return sorted(query_files)
+
+
+def split_statements(text) -> list:
+    """Splits the contents of a .sql file into its statements on the semicolons that are
+    outside of string literals, quoted identifiers, dollar-quoted bodies and comments.
+
+    Args:
+        text (str): Contents of the file.
+
+    Returns:
+        list: The non-empty statements, without their semicolons.
+    """
+    statements = []
+    start = 0
+    index = 0
+    while True:
+        match = SQL_BOUNDARY.search(text, index)
+        if match is None:
+            break
+        token = match.group()
+        index = match.end()
+        if token == ";":
+            statements.append(text[start:match.start()])
+            start = index
+        elif token == "--":
+            newline = text.find("\n", index)
+            index = len(text) if newline < 0 else newline + 1
+        elif token == "/*":
+            # Block comments nest in PostgreSQL
+            depth = 1
+            while depth:
+                comment = SQL_BLOCK_COMMENT.search(text, index)
+                if comment is None:
+                    index = len(text)
+                    break
+                depth += 1 if comment.group() == "/*" else -1
+                index = comment.end()
+        elif token.startswith("$"):
+            end = text.find(token, index)
+            index = len(text) if end < 0 else end + len(token)
+        else:
+            # Quotes are escaped by doubling them, and by a backslash in E'' strings
+            escaped = token == "'" and SQL_ESCAPE_STRING.search(text, 0, match.start()) is not None
+            closing = (SQL_ESCAPED_STRING_END if escaped else SQL_QUOTE_END[token]).match(text, index)
+            index = closing.end() if closing else len(text)
+    statements.append(text[start:])
+    return [statement.strip() for statement in statements if statement.strip()]
+
+
+def init_worker(target, output_dir):
+    """Gives each worker process a query processor with its own connection to the target.
+
+    Args:
+        target (str): Name of the target to explain against.
+        output_dir (str): Directory the graphs are saved under.
+    """
+    global worker_processor, worker_output_dir
+    worker_processor = QueryProcessor(target_configs[target])
+    worker_output_dir = output_dir
+
+
+def explain_query(job) -> dict:
+    """Validates, explains and annotates a query and renders its graph, timing each stage.
+
+    Args:
+        job (tuple): Path of the file, index of the statement in the file and the query.
+
+    Returns:
+        dict: The report of the query.
+    """
+    file_name, index, query = job
+    result = {"file": file_name, "index": index, "query": query, "fingerprint": fingerprint_query(query),
+              "error": False, "timings": {}}
+    timings = result["timings"]
+
+    start = time.perf_counter()
+    output = validate(query, worker_processor)
+    timings["validate"] = time.perf_counter() - start
+    if output["error"]:
+        result.update(error=True, error_message=output["error_message"])
+        return result
+
+    start = time.perf_counter()
+    plan = worker_processor.explain(query)
+    timings["explain"] = time.perf_counter() - start
+    if plan is None:
+        result.update(error=True, error_message="Query could not be explained.")
+        return result
+
+    start = time.perf_counter()
+    graph = plan.save_graph_file(worker_output_dir)
+    timings["graph"] = time.perf_counter() - start
+
+    result.update(
+        graph=f"static/{graph}",
+        explanation=[annotation_tokens(item) for item in plan.explanation],
+        total_cost=plan.query_plan["Total Cost"],
+        total_plan_rows=plan.plan_rows,
+        total_seq_scan=plan.num_seq_scan_nodes,
+        total_index_scan=plan.num_index_scan_nodes,
+        total_parallel_nodes=plan.num_parallel_nodes,
+        node_type_counts=plan.node_type_counts,
+        shape_hash=plan.shape_hash,
+    )
+    return result
+
+
+def write_reports(report, output_dir):
+    """Writes the report as report.json and report.html in the output directory.
+
+    Args:
+        report (dict): The report of every query.
+        output_dir (str): Directory to write the reports to.
+    """
+    with open(os.path.join(output_dir, "report.json"), "w") as report_file:
+        json.dump(report, report_file, indent=2)
+
+    environment = Environment(
+        loader=FileSystemLoader(os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")),
+        autoescape=select_autoescape(["html"]),
+    )
+    environment.filters["annotation"] = render_html
+    with open(os.path.join(output_dir, "report.html"), "w") as report_file:
+        report_file.write(environment.get_template("report.html").render(**report))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Explain and annotate a corpus of .sql queries in parallel.")
+    parser.add_argument("paths", nargs="+", help=".sql files or directories containing .sql files")
+    parser.add_argument("-o", "--output", default="report", help="directory to write the reports to")
+    parser.add_argument("-j", "--processes", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("-t", "--target", default=DEFAULT_TARGET, choices=list(target_configs.keys()),
+                        help="PostgreSQL target to explain against")
+    args = parser.parse_args(argv)
+
+    jobs = []
+    for file_name in find_query_files(args.paths):
+        with open(file_name) as query_file:
+            for index, query in enumerate(split_statements(query_file.read())):
+                jobs.append((file_name, index, query))
+
+    output_dir = os.path.abspath(args.output)
+    os.makedirs(os.path.join(output_dir, "static"), exist_ok=True)
+
+    start = time.perf_counter()
+    results = []
+    with Pool(args.processes, initializer=init_worker, initargs=(args.target, output_dir)) as pool:
+        for result in pool.imap_unordered(explain_query, jobs):
+            results.append(result)
+            timings = ", ".join(f"{stage} {duration:.2f}s" for stage, duration in result["timings"].items())
+            status = "error" if result["error"] else "ok"
+            print(f"[{len(results)}/{len(jobs)}] {result['file']}#{result['index']} {status} ({timings})",
+                  file=sys.stderr)
+    elapsed = time.perf_counter() - start
+
+    results.sort(key=lambda result: (result["file"], result["index"]))
+    report = {
+        "generated_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "target": args.target,
+        "elapsed": elapsed,
+        "num_queries": len(results),
+        "num_errors": sum(1 for result in results if result["error"]),
+        "queries": results,
+    }
+    write_reports(report, output_dir)
+    print(f"Explained {len(results)} queries in {elapsed:.2f}s, {report['num_errors']} failed. "
+          f"Reports written to {output_dir}", file=sys.stderr)
+    return 1 if report["num_errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
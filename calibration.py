@@ -0,0 +1,208 @@
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+
+from batch import find_query_files, split_statements
+from preprocessing import *
+
+DEFAULT_RUNS = 3
+MIN_COST_CONSTANT = 1.0e-6
+COST_CONSTANTS = ["seq_page_cost", "random_page_cost", "cpu_tuple_cost", "cpu_operator_cost"]
+SEQUENTIAL_PAGE_NODES = ["Seq Scan", "Bitmap Heap Scan"]
+RANDOM_PAGE_NODES = ["Index Scan", "Index Only Scan", "Bitmap Index Scan"]
+QUALIFIER_KEYS = ["Filter", "Join Filter", "Hash Cond", "Merge Cond", "Index Cond", "Recheck Cond"]
+REMOVED_ROW_KEYS = ["Rows Removed by Filter", "Rows Removed by Join Filter", "Rows Removed by Index Recheck"]
+INPUT_OPERATOR_NODES = ["Aggregate", "Group", "Hash", "Unique", "SetOp", "WindowAgg"]
+BLOCK_KEYS = ["Shared Hit Blocks", "Shared Read Blocks", "Local Hit Blocks", "Local Read Blocks"]
+
+# Parallel workers and JIT compilation add time that the cost constants do not model
+CALIBRATION_SETTINGS = {"max_parallel_workers_per_gather": 0, "jit": "off"}
+
+
+def explain_analyze(processor, query) -> dict:
+    """Executes a query with EXPLAIN (ANALYZE, BUFFERS) and rolls back whatever it changed.
+
+    Args:
+        processor (QueryProcessor): Processor connected to the database to calibrate.
+        query (str): Query of the benchmark.
+
+    Returns:
+        dict: The plan, with the actual times, rows and buffers of each node.
+    """
+    processor.cursor = processor.conn.cursor()
+    try:
+        processor.change_local_settings(CALIBRATION_SETTINGS)
+        processor.cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query)
+        return processor.cursor.fetchone()[0][0]["Plan"]
+    finally:
+        processor.conn.rollback()
+
+
+def node_samples(plan) -> list:
+    """Breaks an analyzed plan down into the work done by each node, in the units of the cost constants:
+    pages read sequentially, pages read at random, tuples processed and operators evaluated,
+    against the time spent in the node itself. Times, rows and buffers of a node include its children
+    and, except for buffers, are averaged over its loops, so both are undone here.
+
+    Args:
+        plan (dict): Plan from EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON).
+
+    Returns:
+        list: (features, exclusive time in milliseconds) pairs, one per node that was executed.
+    """
+    samples = []
+    stack = [plan]
+    while stack:
+        node = stack.pop()
+        children = node.get("Plans", [])
+        stack.extend(children)
+
+        loops = node.get("Actual Loops", 0)
+        if loops == 0:
+            continue
+
+        time_spent = node["Actual Total Time"] * loops
+        time_spent -= sum(child["Actual Total Time"] * child.get("Actual Loops", 0) for child in children)
+        blocks = sum(node.get(key, 0) for key in BLOCK_KEYS)
+        blocks -= sum(child.get(key, 0) for child in children for key in BLOCK_KEYS)
+        blocks = max(0, blocks)
+
+        tuples = (node["Actual Rows"] + sum(node.get(key, 0) for key in REMOVED_ROW_KEYS)) * loops
+        input_rows = sum(child["Actual Rows"] * child.get("Actual Loops", 0) for child in children)
+        operators = tuples * sum(1 for key in QUALIFIER_KEYS if key in node)
+        if node["Node Type"] == "Sort":
+            # The planner charges two operators per comparison, N log2 N comparisons for N rows
+            operators += 2 * input_rows * np.log2(max(2, input_rows))
+        elif node["Node Type"] in INPUT_OPERATOR_NODES:
+            operators += input_rows
+
+        features = [
+            blocks if node["Node Type"] in SEQUENTIAL_PAGE_NODES else 0,
+            blocks if node["Node Type"] in RANDOM_PAGE_NODES else 0,
+            tuples,
+            operators,
+        ]
+        samples.append((features, max(0.0, time_spent)))
+    return samples
+
+
+def fit_cost_constants(samples) -> dict:
+    """Fits the time of each node as a linear combination of its work by least squares, and expresses
+    the time of each unit of work relative to a sequential page, as the planner does with seq_page_cost = 1.
+    Constants that come out negative, which happens when the benchmark barely exercises them, are clipped.
+
+    Args:
+        samples (list): (features, time) pairs from node_samples.
+
+    Returns:
+        dict: The recommended cost constants, the milliseconds per cost unit and the fit of the model.
+    """
+    features = np.array([sample[0] for sample in samples], dtype=float)
+    times = np.array([sample[1] for sample in samples], dtype=float)
+
+    # Each column is scaled to at most 1 so that pages and operators, of very different magnitudes, fit alike
+    scale = features.max(axis=0)
+    scale[scale == 0] = 1.0
+    coefficients, _, rank, _ = np.linalg.lstsq(features / scale, times, rcond=None)
+    coefficients = coefficients / scale
+
+    predicted = features @ coefficients
+    total = ((times - times.mean()) ** 2).sum()
+    r2 = 1.0 - ((times - predicted) ** 2).sum() / total if total > 0 else 0.0
+
+    coefficients = np.maximum(coefficients, 0.0)
+    if coefficients[0] > 0:
+        ms_per_unit = coefficients[0] / DEFAULT_SEQ_PAGE_COST
+    else:
+        # Without sequential pages in the benchmark, the tuple cost keeps its default instead
+        ms_per_unit = coefficients[2] / DEFAULT_CPU_TUPLE_COST if coefficients[2] > 0 else 1.0
+
+    recommended = {name: max(MIN_COST_CONSTANT, float(coefficient / ms_per_unit))
+                   for name, coefficient in zip(COST_CONSTANTS, coefficients)}
+    recommended.update(ms_per_cost_unit=float(ms_per_unit), r2=float(r2), rank=int(rank), num_samples=len(samples))
+    return recommended
+
+
+def calibrate(processor, queries, runs=DEFAULT_RUNS) -> dict:
+    """Runs the benchmark and fits the cost constants to it.
+
+    Args:
+        processor (QueryProcessor): Processor connected to the database to calibrate.
+        queries (list): Queries of the benchmark.
+        runs (int, optional): Number of times each query is executed. Defaults to DEFAULT_RUNS.
+
+    Returns:
+        dict: The recommended cost constants, with the statistics of the fit and the queries that failed.
+    """
+    samples = []
+    failed = []
+    for index, query in enumerate(queries):
+        for run in range(runs):
+            try:
+                plan = explain_analyze(processor, query)
+            except Exception as error:
+                failed.append({"query": query, "error": str(error)})
+                break
+            samples += node_samples(plan)
+        print(f"[{index + 1}/{len(queries)}] {len(samples)} samples", file=sys.stderr)
+
+    if not samples:
+        return {"failed": failed}
+
+    calibration = fit_cost_constants(samples)
+    calibration["failed"] = failed
+    return calibration
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fit the planner cost constants to measured executions.")
+    parser.add_argument("paths", nargs="*", help=".sql files or directories of the benchmark, defaults to TPC-H queries")
+    parser.add_argument("-r", "--runs", type=int, default=DEFAULT_RUNS, help="number of executions of each query")
+    parser.add_argument("-t", "--target", default=DEFAULT_TARGET, choices=list(target_configs.keys()),
+                        help="PostgreSQL target to calibrate")
+    parser.add_argument("-o", "--output", default="calibration.json",
+                        help="file to write the recommended settings to, which the app explains with")
+    parser.add_argument("--dry-run", action="store_true", help="only print the recommended settings")
+    args = parser.parse_args(argv)
+
+    if args.paths:
+        queries = []
+        for file_name in find_query_files(args.paths):
+            with open(file_name) as query_file:
+                queries += split_statements(query_file.read())
+    else:
+        from loadtest import TPCH_QUERIES
+        queries = list(TPCH_QUERIES.values())
+
+    # EXPLAIN ANALYZE executes the queries, so only queries that read are calibrated with
+    queries = [query for query in queries if is_read_only(query)]
+
+    processor = QueryProcessor(target_configs[args.target])
+    calibration = calibrate(processor, queries, args.runs)
+    processor.stop_db_connection()
+
+    if "r2" not in calibration:
+        print("No query of the benchmark could be executed.", file=sys.stderr)
+        return 1
+
+    print(f"Fitted {calibration['num_samples']} nodes from {len(queries)} queries (R² {calibration['r2']:.3f}, "
+          f"{calibration['ms_per_cost_unit']:.4f} ms per cost unit, {len(calibration['failed'])} failed)")
+    for name in COST_CONSTANTS:
+        print(f"  {name}: {baseline_settings[name]} -> {calibration[name]:.6f}")
+    if calibration["rank"] < len(COST_CONSTANTS):
+        print("The benchmark does not exercise every cost constant, add queries with index scans and filters.")
+
+    if not args.dry_run:
+        calibration["generated_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        calibration["target"] = args.target
+        with open(args.output, "w") as calibration_file:
+            json.dump(calibration, calibration_file, indent=2)
+        print(f"Settings written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
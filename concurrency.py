@@ -0,0 +1,173 @@
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+PLAN_PRIORITY = 0
+EXECUTE_PRIORITY = 1
+ADMISSION_DEADLINE = 10.0
+LATENCY_TOLERANCE = 2.0
+LATENCY_SLACK = 0.01
+BASELINE_DRIFT = 1.01
+DECREASE_FACTOR = 0.9
+DECREASE_INTERVAL = 1.0
+
+
+class SingleFlight:
+    def __init__(self):
+        """Coalesces concurrent calls with the same key into a single call, whose result or exception
+        is shared by every caller waiting on it. Nothing is kept once the call returns, so a call made
+        after it finished runs again: results are never cached.
+        """
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, func) -> tuple:
+        """Calls func, unless a call with the same key is in flight, in which case its result is waited for.
+
+        Args:
+            key (hashable): Identifies calls that give the same result.
+            func (function): Function without arguments to call.
+
+        Returns:
+            tuple: The result of the call and whether it was shared with a call in flight.
+            The exception of the call is raised to every caller that waited on it.
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            shared = call is not None
+            if not shared:
+                call = Future()
+                self.calls[key] = call
+
+        if shared:
+            return call.result(), True
+
+        try:
+            result = func()
+        except BaseException as error:
+            call.set_exception(error)
+            raise
+        else:
+            call.set_result(result)
+        finally:
+            with self.lock:
+                del self.calls[key]
+        return result, False
+
+
+class Busy(Exception):
+    def __init__(self, retry_after):
+        """Raised when an operation waited for admission for longer than its deadline.
+
+        Args:
+            retry_after (int): Seconds after which the operation may be retried.
+        """
+        super().__init__("The database is busy, please try again in a moment.")
+        self.retry_after = retry_after
+
+
+class Admission:
+    def __init__(self):
+        """Admission of an operation, yielded by AdmissionController.admit. The latency of the operation is
+        the time it held its admission for, unless the operation sets it to the latency of the database alone,
+        e.g. that of the statements it executed, which does not depend on how much work the operation does.
+        """
+        self.latency = None
+
+
+class AdmissionController:
+    def __init__(self, max_limit, min_limit=1, deadline=ADMISSION_DEADLINE):
+        """Limits the number of concurrent operations on a database. Operations wait in a priority queue,
+        lowest priority first, and are shed with Busy once they waited for longer than the deadline.
+        The limit adapts to the latency of the database: it grows by one every limit operations that are as
+        fast as usual, and shrinks by DECREASE_FACTOR, at most once every DECREASE_INTERVAL seconds, when
+        operations take more than LATENCY_TOLERANCE times the usual latency of their priority,
+        plus LATENCY_SLACK seconds so that operations that are always quick do not shrink it.
+        The latency of an operation is that of its Admission.
+
+        Args:
+            max_limit (int): Highest limit, e.g. the number of connections.
+            min_limit (int, optional): Lowest limit. Defaults to 1.
+            deadline (float, optional): Seconds an operation waits before it is shed. Defaults to ADMISSION_DEADLINE.
+        """
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.deadline = deadline
+        self.limit = float(max_limit)
+        self.active = 0
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.baselines = {}
+        self.decreased = 0.0
+        self.num_admitted = 0
+        self.num_shed = 0
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def admit(self, priority):
+        """Waits for the turn of an operation for the duration of a with block.
+
+        Args:
+            priority (int): Priority of the operation, e.g. PLAN_PRIORITY or EXECUTE_PRIORITY.
+
+        Yields:
+            Admission: The admission of the operation, whose latency the operation may set.
+        """
+        entry = (priority, next(self.sequence))
+        with self.condition:
+            heapq.heappush(self.waiting, entry)
+            end = time.monotonic() + self.deadline
+            while self.waiting[0] != entry or self.active >= int(self.limit):
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    self.waiting.remove(entry)
+                    heapq.heapify(self.waiting)
+                    self.num_shed += 1
+                    self.condition.notify_all()
+                    raise Busy(max(1, int(self.deadline)))
+                self.condition.wait(remaining)
+            heapq.heappop(self.waiting)
+            self.active += 1
+            self.num_admitted += 1
+            # The next operation in the queue may also fit under the limit
+            self.condition.notify_all()
+
+        admission = Admission()
+        start = time.monotonic()
+        try:
+            yield admission
+        finally:
+            latency = admission.latency
+            self.release(priority, latency if latency is not None else time.monotonic() - start)
+
+    def release(self, priority, latency):
+        with self.condition:
+            self.active -= 1
+
+            # The usual latency is the lowest one seen, drifting up slowly to follow lasting changes
+            baseline = self.baselines.get(priority)
+            baseline = latency if baseline is None else min(latency, baseline * BASELINE_DRIFT)
+            self.baselines[priority] = baseline
+
+            now = time.monotonic()
+            if latency > baseline * LATENCY_TOLERANCE + LATENCY_SLACK:
+                if now - self.decreased >= DECREASE_INTERVAL:
+                    self.limit = max(self.min_limit, self.limit * DECREASE_FACTOR)
+                    self.decreased = now
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {
+                "limit": self.limit,
+                "max_limit": self.max_limit,
+                "active": self.active,
+                "waiting": len(self.waiting),
+                "admitted": self.num_admitted,
+                "shed": self.num_shed,
+            }
@@ -0,0 +1,18 @@
+import os
+import tempfile
+
+import pytest
+
+import loadtest
+
+
+@pytest.fixture(scope="session")
+def client():
+    """Test client of the app, explaining queries with the replay processors of the load test instead of a database."""
+    # The history and the shared cache of the app are kept out of the working directory and of running apps
+    state_dir = tempfile.mkdtemp()
+    os.environ.setdefault("PLAN_HISTORY_FILE", os.path.join(state_dir, "plan_history"))
+    os.environ.setdefault("SHARED_CACHE_FILE", os.path.join(state_dir, "shared_cache.bin"))
+    loadtest.install_replay()
+    from project import app
+    return app.test_client()
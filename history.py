@@ -0,0 +1,275 @@
+import base64
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import namedtuple
+
+HISTORY_LENGTH = 20
+REGRESSION_COST_THRESHOLD = 0.1
+HISTORY_BUSY_TIMEOUT = 30.0
+
+"""
+A QEP that was recorded for a query fingerprint.
+The plan is kept as compressed JSON so that it can be compared against later plans.
+"""
+PlanRecord = namedtuple("PlanRecord", ["timestamp", "total_cost", "shape_hash", "node_type_counts", "plan"])
+
+"""
+A change of plan shape for a query fingerprint that also increased its estimated cost.
+"""
+PlanRegression = namedtuple("PlanRegression", ["fingerprint", "query", "before", "after", "cost_increase", "diff"])
+
+
+def flatten_plan(plan: dict) -> list:
+    """
+        Flattens a query plan into a list of [parent index, fields] in pre-order, so that
+        deeply nested plans can be serialised without recursion
+    """
+    nodes = []
+    stack = [(plan, -1)]
+    while stack:
+        node, parent = stack.pop()
+        nodes.append([parent, {key: value for key, value in node.items() if key != "Plans"}])
+        for child in reversed(node.get("Plans", [])):
+            stack.append((child, len(nodes) - 1))
+    return nodes
+
+
+def unflatten_plan(nodes: list) -> dict:
+    """
+        Restores a query plan that was flattened with flatten_plan
+    """
+    plans = []
+    for parent, fields in nodes:
+        plans.append(dict(fields))
+        if parent >= 0:
+            plans[parent].setdefault("Plans", []).append(plans[-1])
+    return plans[0]
+
+
+def compress_plan(plan: dict) -> bytes:
+    """
+        Serialises a query plan into compact, compressed JSON
+    """
+    return zlib.compress(json.dumps(flatten_plan(plan), separators=(",", ":")).encode("utf-8"))
+
+
+def decompress_plan(data: bytes) -> dict:
+    """
+        Restores a query plan that was serialised with compress_plan
+    """
+    return unflatten_plan(json.loads(zlib.decompress(data).decode("utf-8")))
+
+
+def encode_record(record: PlanRecord) -> list:
+    """
+        Gets a plan record as a list that can be serialised to JSON, with its compressed plan in base64
+    """
+    return list(record[:-1]) + [base64.b64encode(record.plan).decode("ascii")]
+
+
+def decode_record(fields: list) -> PlanRecord:
+    """
+        Restores a plan record that was encoded with encode_record
+    """
+    return PlanRecord(*fields[:-1], base64.b64decode(fields[-1]))
+
+
+def encode_regression(regression: PlanRegression) -> str:
+    """
+        Serialises a plan regression into JSON
+    """
+    return json.dumps([regression.fingerprint, regression.query, encode_record(regression.before),
+                       encode_record(regression.after), regression.cost_increase, regression.diff],
+                      separators=(",", ":"))
+
+
+def decode_regression(text: str) -> PlanRegression:
+    """
+        Restores a plan regression that was serialised with encode_regression
+    """
+    fingerprint, query, before, after, cost_increase, diff = json.loads(text)
+    return PlanRegression(fingerprint, query, decode_record(before), decode_record(after), cost_increase, diff)
+
+
+class PlanHistory:
+    def __init__(self, file_name, history_length=HISTORY_LENGTH, cost_threshold=REGRESSION_COST_THRESHOLD):
+        """Opens the on-disk history of QEPs, keyed by query fingerprint.
+        Each fingerprint has its query, its most recent plans and the regressions found among them.
+        The history is an SQLite database in WAL mode, so that the worker processes of a prefork server
+        can read it while one of them records a plan, and each plan is recorded in a transaction of its own.
+
+        Args:
+            file_name (str): Path of the SQLite database storing the history.
+            history_length (int, optional): Number of plans and regressions kept per fingerprint.
+            Defaults to HISTORY_LENGTH.
+            cost_threshold (float, optional): Relative cost increase above which a change of plan shape
+            is a regression. Defaults to REGRESSION_COST_THRESHOLD.
+        """
+        self.file_name = file_name
+        self.history_length = history_length
+        self.cost_threshold = cost_threshold
+        self.lock = threading.Lock()
+        self.connection = None
+
+    @property
+    def db(self):
+        """
+            Connection to the database, which is only opened when it is first used,
+            so that the history can be created before forking worker processes.
+            Returns:
+                Connection: Connection to the database, shared by the threads of the process under self.lock.
+        """
+        if self.connection is None:
+            # Transactions are begun explicitly, so that recording a plan is a single write transaction
+            connection = sqlite3.connect(self.file_name, timeout=HISTORY_BUSY_TIMEOUT, isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS queries (fingerprint TEXT PRIMARY KEY, query TEXT)")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS records (id INTEGER PRIMARY KEY, fingerprint TEXT, timestamp REAL,"
+                " total_cost REAL, shape_hash TEXT, node_type_counts TEXT, plan BLOB)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS records_fingerprint ON records (fingerprint, id)")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS regressions (id INTEGER PRIMARY KEY, fingerprint TEXT, timestamp REAL,"
+                " regression TEXT)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS regressions_fingerprint ON regressions (fingerprint, id)")
+            connection.execute("CREATE INDEX IF NOT EXISTS regressions_timestamp ON regressions (timestamp)")
+            self.connection = connection
+        return self.connection
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def get_records(self, fingerprint: str) -> list:
+        rows = self.db.execute(
+            "SELECT timestamp, total_cost, shape_hash, node_type_counts, plan FROM records"
+            " WHERE fingerprint = ? ORDER BY id",
+            (fingerprint,),
+        )
+        return [PlanRecord(timestamp, total_cost, shape_hash, json.loads(node_type_counts), plan)
+                for timestamp, total_cost, shape_hash, node_type_counts, plan in rows]
+
+    def get(self, fingerprint: str) -> dict:
+        """Gets the history of a query fingerprint.
+
+        Args:
+            fingerprint (str): Fingerprint of the query.
+
+        Returns:
+            dict: The query, its recorded plans and regressions, or None if it was never recorded.
+        """
+        with self.lock:
+            row = self.db.execute("SELECT query FROM queries WHERE fingerprint = ?", (fingerprint,)).fetchone()
+            if row is None:
+                return None
+            regressions = self.db.execute(
+                "SELECT regression FROM regressions WHERE fingerprint = ? ORDER BY id", (fingerprint,)
+            )
+            return {
+                "query": row[0],
+                "records": self.get_records(fingerprint),
+                "regressions": [decode_regression(regression) for regression, in regressions],
+            }
+
+    def record(self, fingerprint: str, query: str, plan, compare) -> PlanRegression:
+        """Records a new QEP for a query fingerprint and checks it against the previous one.
+
+        Args:
+            fingerprint (str): Fingerprint of the query.
+            query (str): Query string that was entered by the user.
+            plan (QueryPlan): The QEP of the query.
+            compare (function): Function comparing the previous plan dict to the new plan dict,
+            returning the comparison strings (e.g. QueryProcessor.scan_tree).
+
+        Returns:
+            PlanRegression: The regression if the plan changed shape and got more expensive, otherwise None.
+        """
+        record = PlanRecord(
+            time.time(),
+            plan.query_plan["Total Cost"],
+            plan.shape_hash,
+            plan.node_type_counts,
+            compress_plan(plan.query_plan),
+        )
+
+        with self.lock:
+            # The previous plan is read in the write transaction, so that another process recording the same
+            # fingerprint meanwhile waits rather than compares against the same previous plan
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                previous = self.db.execute(
+                    "SELECT timestamp, total_cost, shape_hash, node_type_counts, plan FROM records"
+                    " WHERE fingerprint = ? ORDER BY id DESC LIMIT 1",
+                    (fingerprint,),
+                ).fetchone()
+                regression = None
+                if previous is not None:
+                    before = PlanRecord(*previous[:3], json.loads(previous[3]), previous[4])
+                    regression = self.detect_regression(fingerprint, query, before, record, compare)
+
+                self.db.execute("INSERT OR REPLACE INTO queries (fingerprint, query) VALUES (?, ?)",
+                                (fingerprint, query))
+                self.db.execute(
+                    "INSERT INTO records (fingerprint, timestamp, total_cost, shape_hash, node_type_counts, plan)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (fingerprint, record.timestamp, record.total_cost, record.shape_hash,
+                     json.dumps(record.node_type_counts), record.plan),
+                )
+                self.trim("records", fingerprint)
+                if regression is not None:
+                    self.db.execute("INSERT INTO regressions (fingerprint, timestamp, regression) VALUES (?, ?, ?)",
+                                    (fingerprint, record.timestamp, encode_regression(regression)))
+                    self.trim("regressions", fingerprint)
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+        return regression
+
+    def trim(self, table: str, fingerprint: str):
+        """Deletes all but the history_length most recent rows of a fingerprint from the records or regressions."""
+        self.db.execute(
+            f"DELETE FROM {table} WHERE fingerprint = ? AND id NOT IN"
+            f" (SELECT id FROM {table} WHERE fingerprint = ? ORDER BY id DESC LIMIT ?)",
+            (fingerprint, fingerprint, self.history_length),
+        )
+
+    def detect_regression(self, fingerprint, query, before: PlanRecord, after: PlanRecord, compare) -> PlanRegression:
+        """Checks whether a plan is a regression of the plan recorded before it.
+
+        Returns:
+            PlanRegression: The regression, or None if the shape is unchanged or the cost did not
+            increase above the threshold.
+        """
+        if before.shape_hash == after.shape_hash or before.total_cost <= 0:
+            return None
+
+        cost_increase = (after.total_cost - before.total_cost) / before.total_cost
+        if cost_increase <= self.cost_threshold:
+            return None
+
+        comparison = compare(decompress_plan(before.plan), decompress_plan(after.plan))
+        return PlanRegression(fingerprint, query, before, after, cost_increase, list(comparison.values()))
+
+    def regressions(self) -> list:
+        """Gets the regressions of every recorded query fingerprint.
+
+        Returns:
+            list: The regressions, most recent first.
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT regression FROM regressions ORDER BY timestamp DESC, id DESC")
+            return [decode_regression(regression) for regression, in rows]
+
+
+plan_history = PlanHistory(os.environ.get("PLAN_HISTORY_FILE", os.path.join(os.getcwd(), "plan_history.sqlite3")))
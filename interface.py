@@ -1,21 +1,73 @@
+import hashlib
+import io
+import json
 import os
 import time
+from collections import Counter
 from random import random
 
 import matplotlib.pyplot as plt
 import networkx as nx
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 from annotation import *
 
 
+DEFAULT_TARGET = "default"
+HOT_OPERATOR_LIMIT = 10
+DOCUMENT_VERSION = 1
+"""
+Typed fields of each node in the structured output of a QEP, with the attribute of the node and its default.
+"""
+DOCUMENT_FIELDS = {
+    "node_type": ("node_type", ""),
+    "relation_name": ("relation_name", ""),
+    "count": ("count", 1),
+    "startup_cost": ("startup_cost", 0.0),
+    "total_cost": ("total_cost", 0.0),
+    "plan_rows": ("plan_rows", 0),
+    "plan_width": ("plan_width", 0),
+    "exclusive_cost": ("exclusive_cost", 0.0),
+    "run_cost": ("run_cost", 0.0),
+    "cost_share": ("cost_share", 0.0),
+}
+STRING_FIELDS = ["node_type", "relation_name"]
+
+
 class Config:
-    def __init__(self):
-        self.POSTGRES_HOST = "localhost"
-        self.POSTGRES_PORT = 5432
-        self.POSTGRES_DBNAME = "TPC-H"
-        self.POSTGRES_USERNAME = "postgres"
-        self.POSTGRES_PASSWORD = "password123"
+    def __init__(self, host="localhost", port=5432, dbname="TPC-H", username="postgres", password="password123"):
+        self.POSTGRES_HOST = host
+        self.POSTGRES_PORT = port
+        self.POSTGRES_DBNAME = dbname
+        self.POSTGRES_USERNAME = username
+        self.POSTGRES_PASSWORD = password
         self.FLASK_ENV = "development"
 
+
+def load_target_configs() -> dict:
+    """Loads the named PostgreSQL targets that queries can be explained against.
+    The targets are read as a JSON object mapping each target name to its connection settings
+    (host, port, dbname, username, password), e.g. {"primary": {"port": 5432}, "replica": {"port": 5433}}.
+    Missing settings take the defaults of Config. The JSON is read from:
+    1. The file named by the POSTGRES_TARGETS_FILE environment variable
+    2. The POSTGRES_TARGETS environment variable
+    The default target is always available, unless a target of the same name replaces it.
+
+    Returns:
+        dict: Mapping of target name to its Config, with the default target first.
+    """
+    targets = {}
+    if os.environ.get("POSTGRES_TARGETS_FILE"):
+        with open(os.environ["POSTGRES_TARGETS_FILE"]) as targets_file:
+            targets.update(json.load(targets_file))
+    if os.environ.get("POSTGRES_TARGETS"):
+        targets.update(json.loads(os.environ["POSTGRES_TARGETS"]))
+
+    target_configs = {DEFAULT_TARGET: Config(**targets.pop(DEFAULT_TARGET, {}))}
+    for name, settings in targets.items():
+        target_configs[name] = Config(**settings)
+    return target_configs
+
 class Node:
     def __init__(self, query_plan, comparison):
         """Initialises a node with its relevant query plan.
@@ -29,10 +81,11 @@ class Node:
             query_plan (dict):  Query plan that is generated by PostgreSQL
         """
         self.plans = []
+        self.query_plan = query_plan
         for key in query_plan:
             setattr(self, key.lower().replace(" ", "_"), query_plan.get(key))
         explainer = Annotation.annotation_dict.get(self.node_type, default_annotation)
-        self.explanation = explainer(query_plan, comparison)
+        self.explanation = explainer(query_plan, comparison) + collapsed_annotation(query_plan)
 
     def __str__(self):
         """Overrides the __str__ method to represent the class objects as a string.
@@ -40,47 +93,85 @@ class Node:
         Returns:
             str: String representation of Node.
         """
+        if self.count > 1:
+            low, high = self.collapsed_cost_range
+            return f"{self.node_type} x{self.count}\ncost: {low}-{high}"
         return f"{self.node_type}\ncost: {self.total_cost}"
 
+    @property
+    def count(self) -> int:
+        """Number of nodes of the plan this node stands for, more than one if it was collapsed.
+
+        Returns:
+            int: Number of nodes.
+        """
+        return getattr(self, "collapsed_count", 1)
+
+    @property
+    def combined_total_cost(self) -> float:
+        """Total cost of all the nodes of the plan this node stands for.
+
+        Returns:
+            float: The total cost, summed over the nodes if it was collapsed.
+        """
+        return getattr(self, "collapsed_total_cost", self.total_cost)
+
 
 class QueryPlan:
     def __init__(self, query, comparison):
         """Initialises the root node with the root query plan.
         Constructs the graph and calculate attributes of the QEP:
-        1. Total cost
+        1. Total cost and the exclusive, startup and run cost of each node
         2. Plan rows
         3. Number of sequential scan nodes
         4. Number of index scan nodes
-        4. Explanation of the query plan
+        5. Number of parallel aware nodes and gather nodes
+        6. Number of parallel workers planned
+        7. Number of nodes of each node type
+        8. Hash of the shape of the plan
+        9. Operators ranked by their share of the total cost
+        10. Explanation of the query plan
 
         Args:
             query (dict): Query plan that is generated by PostgreSQL
         """
+        self.query_plan = query
         self.graph = nx.DiGraph()
         self.root = Node(query, comparison)
         self.construct_graph(self.root, comparison)
         self.total_cost = self.calculate_total_cost()
+        self.calculate_node_costs()
+        self.hot_operators = self.rank_hot_operators()
         self.plan_rows = self.calculate_plan_rows()
         self.num_seq_scan_nodes = self.calculate_num_nodes("Seq Scan")
         self.num_index_scan_nodes = self.calculate_num_nodes("Index Scan")
+        self.num_parallel_nodes = self.calculate_num_parallel_nodes()
+        self.num_gather_nodes = self.calculate_num_nodes("Gather") + self.calculate_num_nodes("Gather Merge")
+        self.workers_planned = self.calculate_workers_planned()
+        self.node_type_counts = self.calculate_node_type_counts()
+        self.shape_hash = self.calculate_shape_hash()
         self.explanation = self.create_explanation(self.root)
 
     def construct_graph(self, root, comparison):
-        """Constructs the graph recursively by forming an edge between each node
-        and each of its child nodes.
+        """Constructs the graph by forming an edge between each node and each of its child nodes.
+        The nodes are visited with an explicit stack, so that deep plans do not hit the recursion limit.
 
         Args:
             root (Node): The parent node.
         """
         self.graph.add_node(root)
-        for child in root.plans:
-            child_node = Node(child, comparison)
-            self.graph.add_edge(root, child_node)
-            self.construct_graph(child_node, comparison)
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            for child in node.plans:
+                child_node = Node(child, comparison)
+                self.graph.add_edge(node, child_node)
+                stack.append(child_node)
 
     def create_explanation(self, node: Node) -> str:
-        """Creates explanation of the entire QEP recursively by combining the explanations
-        for each node.
+        """Creates explanation of the entire QEP by combining the explanations for each node,
+        with the explanations of the child nodes before that of their parent.
+        The nodes are visited with an explicit stack, so that deep plans do not hit the recursion limit.
 
         Args:
             node (Node): Each node in the graph representing the QEP.
@@ -89,11 +180,29 @@ class QueryPlan:
             string: The complete explanation of the QEP.
         """
         result = []
-        for child in self.graph[node]:
-            result += self.create_explanation(child)
-        result += [node.explanation]
+        stack = [(node, False)]
+        while stack:
+            current, children_explained = stack.pop()
+            if children_explained:
+                result.append(current.explanation)
+            else:
+                stack.append((current, True))
+                for child in reversed(list(self.graph[current])):
+                    stack.append((child, False))
         return result
 
+    def append_annotations(self, annotate):
+        """Appends annotations to the explanation of each node once the QEP is explained,
+        e.g. from other plans of the query, and creates the explanation of the QEP again.
+
+        Args:
+            annotate (function): Gets the annotation to append from the query plan of a node,
+            or an empty string.
+        """
+        for node in self.graph.nodes:
+            node.explanation += annotate(node.query_plan)
+        self.explanation = self.create_explanation(self.root)
+
     def calculate_num_nodes(self, node_type: str) -> int:
         """Calculate the total number of nodes in the query with a specified node type.
 
@@ -106,44 +215,172 @@ class QueryPlan:
         num_nodes = 0
         for node in self.graph.nodes:
             if node.node_type == node_type:
-                num_nodes += 1
+                num_nodes += node.count
         return num_nodes
 
+    def calculate_num_parallel_nodes(self) -> int:
+        """Calculate the total number of nodes in the query that are executed by parallel workers.
+
+        Returns:
+            int: Number of parallel aware nodes.
+        """
+        num_nodes = 0
+        for node in self.graph.nodes:
+            if getattr(node, "parallel_aware", False):
+                num_nodes += node.count
+        return num_nodes
+
+    def calculate_workers_planned(self) -> int:
+        """Calculate the total number of parallel workers planned by the Gather and Gather Merge nodes.
+
+        Returns:
+            int: Number of parallel workers planned.
+        """
+        workers_planned = 0
+        for node in self.graph.nodes:
+            workers_planned += getattr(node, "workers_planned", 0) * node.count
+        return workers_planned
+
+    def calculate_node_type_counts(self) -> dict:
+        """Calculate the number of nodes of each node type in the query.
+
+        Returns:
+            dict: Mapping of node type to the number of nodes with that node type.
+        """
+        node_type_counts = Counter()
+        for node in self.graph.nodes:
+            node_type_counts[node.node_type] += node.count
+        return dict(node_type_counts)
+
+    def calculate_shape_hash(self) -> str:
+        """Calculate a hash of the shape of the QEP, i.e. the node types, the relations scanned
+        and how the nodes are arranged, ignoring costs and row estimates.
+        Each node is hashed together with the hashes of its children, starting from the leaves.
+
+        Returns:
+            str: Hex digest identifying the shape of the QEP.
+        """
+        node_hashes = {}
+        for node in reversed(list(nx.dfs_preorder_nodes(self.graph, self.root))):
+            node_hash = hashlib.sha1(f"{node.node_type}|{getattr(node, 'relation_name', '')}".encode("utf-8"))
+            for child in self.graph[node]:
+                node_hash.update(node_hashes[child])
+            node_hashes[node] = node_hash.digest()
+        return node_hashes[self.root].hex()[:16]
+
     def calculate_plan_rows(self) -> int:
-        """Calculate the total plan rows of the QEP via the summation of individual plan rows of each node.
+        """Calculate the total plan rows of the QEP, i.e. the rows returned by the root node.
+        The plan rows of the other nodes are rows passed between operators, not rows of the result.
 
         Returns:
             int: Total plan rows of QEP
         """
-        plan_rows = 0
-        for node in self.graph.nodes:
-            plan_rows += node.plan_rows
-        return plan_rows
+        return self.root.plan_rows
 
     def calculate_total_cost(self) -> int:
-        """Calculate the total cost of the QEP via the summation of individual cost of each node.
+        """Calculate the total cost of the QEP, i.e. the total cost of the root node.
+        The total cost of each node already includes the cost of its children, so the costs
+        of the nodes are not added up.
 
         Returns:
             int: Total cost of QEP
         """
-        total_cost = 0
+        return self.root.total_cost
+
+    def calculate_node_costs(self):
+        """Calculate the costs of each node in a single pass over the graph:
+        1. Exclusive cost: the total cost of the node without the total cost of its children
+        2. Run cost: the total cost of the node without its startup cost
+        3. Cost share: the exclusive cost of the node as a fraction of the total cost of the QEP
+
+        The exclusive cost is never negative, as nodes such as Limit stop their children early
+        and cost less than them. The costs of a collapsed node are those of all the nodes it stands for.
+        """
         for node in self.graph.nodes:
-            total_cost += node.total_cost
-        return total_cost
+            children_cost = sum(child.combined_total_cost for child in self.graph[node])
+            node.exclusive_cost = max(0.0, node.combined_total_cost - children_cost)
+            node.run_cost = node.combined_total_cost - getattr(node, "startup_cost", 0.0) * node.count
+            node.cost_share = node.exclusive_cost / self.total_cost if self.total_cost > 0 else 0.0
 
-    def save_graph_file(self, cwd) -> str:
-        """Renders the graph and save the figure as an .png file
-        in the 'static' folder.
-        The frontend then renders the image on the UI to visualise the QEP.
+    def rank_hot_operators(self, limit=HOT_OPERATOR_LIMIT) -> list:
+        """Rank the nodes by their exclusive cost.
+
+        Args:
+            limit (int, optional): Number of nodes to return. Defaults to HOT_OPERATOR_LIMIT.
 
         Returns:
-            str: File name of graph
+            list: The most expensive nodes, most expensive first.
+        """
+        return sorted(self.graph.nodes, key=lambda node: node.exclusive_cost, reverse=True)[:limit]
+
+    def to_columns(self) -> dict:
+        """Creates the structured output of the QEP: one column per field, with a value per node in pre-order,
+        so that each field name is written once however many nodes there are. Node ids are positions in
+        the columns, and the parent column holds the id of the parent of each node, -1 for the root.
+        Node types, relations and the text of the annotation tokens are written once in a table of strings,
+        and referred to by their position in it. The annotation of a node is a flat list of
+        (string position, style) pairs, rendered with render_html or render_text where it is shown.
+
+        Returns:
+            dict: The structured output, which serialises to compact JSON.
+        """
+        nodes = list(nx.dfs_preorder_nodes(self.graph, self.root))
+        ids = {node: index for index, node in enumerate(nodes)}
+        strings = {}
+
+        columns = {"parent": [-1] * len(nodes)}
+        for node in nodes:
+            for child in self.graph[node]:
+                columns["parent"][ids[child]] = ids[node]
+        for field, (attribute, default) in DOCUMENT_FIELDS.items():
+            values = [getattr(node, attribute, default) for node in nodes]
+            if field in STRING_FIELDS:
+                values = [strings.setdefault(value, len(strings)) for value in values]
+            columns[field] = values
+        columns["annotation"] = [
+            [value for text, style in annotation_tokens(node.explanation)
+             for value in (strings.setdefault(text, len(strings)), style)]
+            for node in nodes
+        ]
+
+        return {
+            "version": DOCUMENT_VERSION,
+            "total_cost": self.total_cost,
+            "shape_hash": self.shape_hash,
+            "strings": list(strings),
+            "nodes": columns,
+        }
+
+    def calculate_plan_hash(self) -> str:
+        """Calculate a hash of the whole QEP, i.e. every field of every node, which identifies its graph.
+        Like calculate_shape_hash, each node is hashed together with the hashes of its children,
+        starting from the leaves, so that deep plans do not hit the recursion limit.
+
+        Returns:
+            str: Hex digest identifying the QEP.
+        """
+        node_hashes = {}
+        for node in reversed(list(nx.dfs_preorder_nodes(self.graph, self.root))):
+            fields = {key: value for key, value in node.query_plan.items() if key != "Plans"}
+            node_hash = hashlib.sha1(json.dumps(fields, sort_keys=True, default=str).encode("utf-8"))
+            for child in self.graph[node]:
+                node_hash.update(node_hashes[child])
+            node_hashes[node] = node_hash.digest()
+        return node_hashes[self.root].hex()
+
+    def render_graph_bytes(self) -> bytes:
+        """Renders the graph as a .png image.
+        The nodes are coloured by their share of the total cost, from yellow to red.
+        The graph is drawn on its own figure rather than the global pyplot figure,
+        so that concurrent requests do not draw over each other.
+
+        Returns:
+            bytes: The .png image.
         """
-        graph_name = f"qep_{str(time.time())}.png"
-        dev_config = Config()
-        file_name = os.path.join(cwd, "static", graph_name)
         plot_formatter_position = get_tree_node_pos(self.graph, self.root)
         node_labels = {x: str(x) for x in self.graph.nodes}
+        figure = Figure()
+        FigureCanvasAgg(figure)
         nx.draw(
             self.graph,
             plot_formatter_position,
@@ -151,12 +388,34 @@ class QueryPlan:
             labels=node_labels,
             font_size=6,
             node_size=300,
-            node_color="skyblue",
+            node_color=[node.cost_share for node in self.graph.nodes],
+            cmap=plt.cm.YlOrRd,
+            vmin=0.0,
+            vmax=1.0,
             node_shape="s",
             alpha=1,
+            ax=figure.add_subplot(),
         )
-        plt.savefig(file_name)
-        plt.clf()
+        image = io.BytesIO()
+        figure.savefig(image, format="png")
+        return image.getvalue()
+
+    def save_graph_file(self, cwd, image=None) -> str:
+        """Renders the graph and save the figure as an .png file
+        in the 'static' folder.
+        The frontend then renders the image on the UI to visualise the QEP.
+
+        Args:
+            cwd (str): Folder containing the 'static' folder.
+            image (bytes, optional): Image already rendered with render_graph_bytes. Defaults to None.
+
+        Returns:
+            str: File name of graph
+        """
+        graph_name = f"qep_{str(time.time())}.png"
+        file_name = os.path.join(cwd, "static", graph_name)
+        with open(file_name, "wb") as graph_file:
+            graph_file.write(image if image is not None else self.render_graph_bytes())
         return graph_name
 
 
@@ -164,8 +423,8 @@ def get_tree_node_pos(G, root=None, width=1.0, height=1, vert_gap=0.1, vert_loc=
     """From Joel's answer at https://stackoverflow.com/a/29597209/2966723.
     Licensed under Creative Commons Attribution-Share Alike
 
-    Recursive program to define the positions. The recursion happens in _hierarchy_pos, which is called by get_tree_node_pos.
-    The main role of hierarchy_pos is to do a bit of testing to make sure the graph is appropriate before entering the recursion.
+    Program to define the positions. The positions are assigned in _hierarchy_pos, which is called by get_tree_node_pos.
+    The main role of hierarchy_pos is to do a bit of testing to make sure the graph is appropriate before assigning the positions.
 
     If the graph is a tree this will return the positions to plot this in a hierarchical layout.
 
@@ -198,10 +457,9 @@ def get_tree_node_pos(G, root=None, width=1.0, height=1, vert_gap=0.1, vert_loc=
         else:
             root = random.choice(list(G.nodes))
 
-    path_dict = dict(nx.all_pairs_shortest_path(G))
-    max_height = 0
-    for value in path_dict.values():
-        max_height = max(max_height, len(value))
+    # Every node of a tree reaches all of its nodes, so the longest of the shortest paths
+    # from any node covers the whole tree
+    max_height = G.number_of_nodes()
     vert_gap = height / max_height
 
     def _hierarchy_pos(
@@ -216,6 +474,7 @@ def get_tree_node_pos(G, root=None, width=1.0, height=1, vert_gap=0.1, vert_loc=
         min_dx=0.05,
     ):
         """Refer to get_tree_node_pos docstring for most arguments.
+        The branches are visited with an explicit stack, so that deep plans do not hit the recursion limit.
 
         Args:
             parent (Node, optional): Parent of the current branch. (Only affects it if non-directed). Defaults to None.
@@ -225,27 +484,34 @@ def get_tree_node_pos(G, root=None, width=1.0, height=1, vert_gap=0.1, vert_loc=
         """
 
         if pos is None:
-            pos = {root: (xcenter, vert_loc)}
-        else:
+            pos = {}
+        stack = [(root, parent, width, vert_loc, xcenter)]
+        while stack:
+            root, parent, width, vert_loc, xcenter = stack.pop()
             pos[root] = (xcenter, vert_loc)
-        children = list(G.neighbors(root))
-        if not isinstance(G, nx.DiGraph) and parent is not None:
-            children.remove(parent)
-        if len(children) != 0:
-            dx = max(min_dx, width / len(children))
-            nextx = xcenter - width / 2 - max(min_dx, dx / 2)
-            for child in children:
-                nextx += dx
-                pos = _hierarchy_pos(
-                    G,
-                    child,
-                    width=dx,
-                    vert_gap=vert_gap,
-                    vert_loc=vert_loc - vert_gap,
-                    xcenter=nextx,
-                    pos=pos,
-                    parent=root,
-                )
+            children = list(G.neighbors(root))
+            if not isinstance(G, nx.DiGraph) and parent is not None:
+                children.remove(parent)
+            if len(children) != 0:
+                dx = max(min_dx, width / len(children))
+                nextx = xcenter - width / 2 - max(min_dx, dx / 2)
+                for child in children:
+                    nextx += dx
+                    stack.append((child, root, dx, vert_loc - vert_gap, nextx))
         return pos
 
-    return _hierarchy_pos(G, root, width, vert_gap, vert_loc, xcenter)
\ No newline at end of file
+    return _hierarchy_pos(G, root, width, vert_gap, vert_loc, xcenter)
+
+
+def document_annotation(document, node_id) -> list:
+    """Gets the annotation tokens of a node from the structured output of a QEP.
+
+    Args:
+        document (dict): Structured output from QueryPlan.to_columns.
+        node_id (int): Id of the node.
+
+    Returns:
+        list: [text, style] tokens of the annotation.
+    """
+    flat = document["nodes"]["annotation"][node_id]
+    return [[document["strings"][flat[index]], flat[index + 1]] for index in range(0, len(flat), 2)]
@@ -0,0 +1,547 @@
+import argparse
+import itertools
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from random import Random
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+import numpy as np
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+from preprocessing import *
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_DURATION = 30
+SYNTHETIC_SIZES = [10, 100, 1000]
+PERCENTILES = [50, 95, 99]
+# Settings that the replayed database reports, in the units of pg_settings
+REPLAY_SETTINGS = {"work_mem": "4096", "hash_mem_multiplier": "2"}
+
+SYNTHETIC_MARKER = re.compile(r"/\*\s*synthetic:(\d+):(\d+)\s*\*/")
+SERVER_TIMING = re.compile(r"([\w-]+);dur=([\d.]+)")
+
+TPCH_RELATIONS = ["lineitem", "orders", "customer", "part", "partsupp", "supplier", "nation", "region"]
+
+TPCH_QUERIES = {
+    "Q1": "SELECT l_returnflag, l_linestatus, sum(l_quantity) AS sum_qty, sum(l_extendedprice) AS sum_base_price, "
+          "sum(l_extendedprice * (1 - l_discount)) AS sum_disc_price, avg(l_discount) AS avg_disc, count(*) AS count_order "
+          "FROM lineitem WHERE l_shipdate <= date '1998-12-01' - interval '90' day "
+          "GROUP BY l_returnflag, l_linestatus ORDER BY l_returnflag, l_linestatus",
+    "Q3": "SELECT l_orderkey, sum(l_extendedprice * (1 - l_discount)) AS revenue, o_orderdate, o_shippriority "
+          "FROM customer, orders, lineitem "
+          "WHERE c_mktsegment = 'BUILDING' AND c_custkey = o_custkey AND l_orderkey = o_orderkey "
+          "AND o_orderdate < date '1995-03-15' AND l_shipdate > date '1995-03-15' "
+          "GROUP BY l_orderkey, o_orderdate, o_shippriority ORDER BY revenue DESC, o_orderdate LIMIT 20",
+    "Q5": "SELECT n_name, sum(l_extendedprice * (1 - l_discount)) AS revenue "
+          "FROM customer, orders, lineitem, supplier, nation, region "
+          "WHERE c_custkey = o_custkey AND l_orderkey = o_orderkey AND l_suppkey = s_suppkey "
+          "AND c_nationkey = s_nationkey AND s_nationkey = n_nationkey AND n_regionkey = r_regionkey "
+          "AND r_name = 'ASIA' AND o_orderdate >= date '1994-01-01' AND o_orderdate < date '1995-01-01' "
+          "GROUP BY n_name ORDER BY revenue DESC",
+    "Q6": "SELECT sum(l_extendedprice * l_discount) AS revenue FROM lineitem "
+          "WHERE l_shipdate >= date '1994-01-01' AND l_shipdate < date '1995-01-01' "
+          "AND l_discount BETWEEN 0.05 AND 0.07 AND l_quantity < 24",
+    "Q10": "SELECT c_custkey, c_name, sum(l_extendedprice * (1 - l_discount)) AS revenue, c_acctbal, n_name "
+           "FROM customer, orders, lineitem, nation "
+           "WHERE c_custkey = o_custkey AND l_orderkey = o_orderkey AND o_orderdate >= date '1993-10-01' "
+           "AND o_orderdate < date '1994-01-01' AND l_returnflag = 'R' AND c_nationkey = n_nationkey "
+           "GROUP BY c_custkey, c_name, c_acctbal, n_name ORDER BY revenue DESC LIMIT 20",
+}
+
+
+def synthetic_plan(num_nodes, rng) -> dict:
+    """Generates a left-deep plan of hash joins and nested loops over the TPC-H relations, under an
+    aggregate and a sort, with about num_nodes nodes. The plan has the fields read by the annotations,
+    so that it goes through the same annotation and graph code as a plan from PostgreSQL.
+
+    Args:
+        num_nodes (int): Approximate number of nodes of the plan.
+        rng (Random): Random number generator deciding the operators, relations and costs.
+
+    Returns:
+        dict: The plan, in the format of the "Plan" field of EXPLAIN (FORMAT JSON).
+    """
+    def scan():
+        relation = rng.choice(TPCH_RELATIONS)
+        rows = rng.randint(1, 100000)
+        cost = rows * rng.uniform(0.01, 0.05)
+        if rng.random() < 0.5:
+            return {"Node Type": "Seq Scan", "Parallel Aware": False, "Relation Name": relation, "Alias": relation,
+                    "Startup Cost": 0.0, "Total Cost": cost, "Plan Rows": rows, "Plan Width": 8,
+                    "Filter": f"({relation[0]}_key > {rng.randint(0, 1000)})"}
+        return {"Node Type": "Index Scan", "Parallel Aware": False, "Scan Direction": "Forward",
+                "Index Name": f"{relation}_pkey", "Relation Name": relation, "Alias": relation,
+                "Startup Cost": 0.29, "Total Cost": cost, "Plan Rows": rows, "Plan Width": 8,
+                "Index Cond": f"({relation[0]}_key = {rng.randint(0, 1000)})"}
+
+    plan = scan()
+    for _ in range(max(0, (num_nodes - 4) // 3)):
+        inner = scan()
+        rows = max(1, (plan["Plan Rows"] + inner["Plan Rows"]) // 2)
+        condition = f"({rng.choice(TPCH_RELATIONS)}_key = {inner['Relation Name']}_key)"
+        if rng.random() < 0.7:
+            inner = {"Node Type": "Hash", "Parallel Aware": False, "Startup Cost": inner["Total Cost"],
+                     "Total Cost": inner["Total Cost"], "Plan Rows": inner["Plan Rows"], "Plan Width": 8,
+                     "Plans": [inner]}
+            plan = {"Node Type": "Hash Join", "Parallel Aware": False, "Join Type": "Inner",
+                    "Startup Cost": inner["Total Cost"], "Total Cost": plan["Total Cost"] + inner["Total Cost"] + rows * 0.01,
+                    "Plan Rows": rows, "Plan Width": 16, "Hash Cond": condition, "Plans": [plan, inner]}
+        else:
+            inner["Index Cond"] = condition
+            plan = {"Node Type": "Nested Loop", "Parallel Aware": False, "Join Type": "Inner",
+                    "Startup Cost": 0.0, "Total Cost": plan["Total Cost"] + inner["Total Cost"] * 2,
+                    "Plan Rows": rows, "Plan Width": 16, "Plans": [plan, inner]}
+
+    rows = max(1, plan["Plan Rows"] // 10)
+    plan = {"Node Type": "Aggregate", "Strategy": "Hashed", "Partial Mode": "Simple", "Parallel Aware": False,
+            "Startup Cost": plan["Total Cost"], "Total Cost": plan["Total Cost"] + rows * 0.02,
+            "Plan Rows": rows, "Plan Width": 16, "Group Key": ["key"], "Plans": [plan]}
+    return {"Node Type": "Sort", "Parallel Aware": False, "Startup Cost": plan["Total Cost"],
+            "Total Cost": plan["Total Cost"] + rows * 0.05, "Plan Rows": rows, "Plan Width": 16,
+            "Sort Key": ["key DESC"], "Plans": [plan]}
+
+
+def synthetic_query(num_nodes, seed) -> str:
+    """
+        Gets a query that the replay processor answers with synthetic_plan(num_nodes)
+    """
+    return f"/* synthetic:{num_nodes}:{seed} */ SELECT 1"
+
+
+class ReplayCursor:
+    def __init__(self, processor):
+        """Cursor answering the statements of a ReplayQueryProcessor without a database.
+        EXPLAIN statements return the recorded plan of the query, or a synthetic plan when the query
+        has a synthetic marker or was not recorded. Every other statement succeeds with a single row.
+        """
+        self.processor = processor
+        self.result = None
+
+    def execute(self, statement, parameters=None):
+        # Statements are timed like those of a TimedConnection
+        start = time.monotonic()
+        try:
+            self.replay(statement)
+        finally:
+            self.processor.connection.db_time += time.monotonic() - start
+            self.processor.connection.num_statements += 1
+
+    def replay(self, statement):
+        if not isinstance(statement, str):
+            # SET LOCAL statements composed with psycopg2.sql have no effect on a replayed plan
+            self.result = None
+            return
+
+        if statement.startswith("EXPLAIN"):
+            if self.processor.latency:
+                time.sleep(self.processor.latency)
+            query = statement[statement.index(")") + 1:].strip()
+            if query.startswith("EXECUTE"):
+                query = self.processor.prepared[query.split()[1]]
+            self.result = ([{"Plan": self.processor.replay_plan(query)}],)
+        elif statement.startswith("PREPARE"):
+            _, name, _, query = statement.split(None, 3)
+            self.processor.prepared[name] = query
+            self.result = None
+        elif statement.startswith("SET") or statement.startswith("DEALLOCATE"):
+            self.result = None
+        elif "pg_settings" in statement:
+            self.result = tuple(REPLAY_SETTINGS.items())
+        else:
+            self.result = (1,)
+
+    def fetchone(self):
+        return self.result
+
+    def fetchall(self):
+        return list(self.result or ())
+
+    def close(self):
+        pass
+
+
+class ReplayConnection:
+    def __init__(self, processor):
+        self.processor = processor
+        self.closed = False
+        self.server_version = GENERIC_PLAN_VERSION
+        self.db_time = 0.0
+        self.num_statements = 0
+
+    def get_transaction_status(self):
+        return TRANSACTION_STATUS_IDLE
+
+    def cursor(self, *args, **kwargs):
+        return ReplayCursor(self.processor)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class ReplayQueryProcessor(QueryProcessor):
+    def __init__(self, db_config, recorded_plans=None, latency=0.0):
+        """Query processor that replays recorded plans instead of querying PostgreSQL, so that the
+        app can be load tested without a database. Only the connection is replaced: validation,
+        AQPs, comparisons and annotations run exactly as they do against PostgreSQL.
+
+        Args:
+            db_config (Config): Connection settings, unused.
+            recorded_plans (dict, optional): Mapping of query fingerprint to its plan. Defaults to None.
+            latency (float, optional): Seconds each EXPLAIN takes, to simulate the database. Defaults to 0.
+        """
+        super().__init__(db_config)
+        self.recorded_plans = recorded_plans or {}
+        self.latency = latency
+        self.prepared = {}
+
+    @property
+    def conn(self):
+        if self.connection is None:
+            self.connection = ReplayConnection(self)
+        return self.connection
+
+    def replay_plan(self, query) -> dict:
+        match = SYNTHETIC_MARKER.search(query)
+        if match:
+            return synthetic_plan(int(match.group(1)), Random(int(match.group(2))))
+
+        fingerprint = fingerprint_query(query)
+        if fingerprint in self.recorded_plans:
+            return self.recorded_plans[fingerprint]
+        return synthetic_plan(SYNTHETIC_SIZES[0], Random(fingerprint))
+
+
+class ReplayQueryProcessorPool(QueryProcessorPool):
+    def __init__(self, db_config, recorded_plans=None, latency=0.0, max_size=DEFAULT_POOL_SIZE):
+        super().__init__(db_config, max_size)
+        self.recorded_plans = recorded_plans
+        self.latency = latency
+
+    def create_processor(self):
+        return ReplayQueryProcessor(self.db_config, self.recorded_plans, self.latency)
+
+
+def record_plans(queries, file_name, target=DEFAULT_TARGET):
+    """Explains the queries against a target and saves their QEPs for replay.
+
+    Args:
+        queries (list): Queries to record.
+        file_name (str): Path of the JSON file mapping query fingerprint to plan.
+        target (str, optional): Name of the target to explain against. Defaults to DEFAULT_TARGET.
+    """
+    recorded_plans = {}
+    with target_pools[target].acquire() as processor:
+        for query in queries:
+            plan = processor.explain_qep(query)
+            if plan is not None:
+                recorded_plans[fingerprint_query(query)] = plan.query_plan
+    with open(file_name, "w") as plans_file:
+        json.dump(recorded_plans, plans_file)
+
+
+def install_replay(recorded_plans=None, latency=0.0):
+    """
+        Replaces the pool of every target with a pool of replay processors
+    """
+    for name, config in target_configs.items():
+        target_pools[name] = ReplayQueryProcessorPool(config, recorded_plans, latency)
+
+
+def query_mix(mix, synthetic_sizes=None) -> list:
+    """Gets the queries sent by the load test.
+
+    Args:
+        mix (str): "tpch" for the TPC-H queries, "synthetic" for synthetic plans, or "mixed" for both.
+        synthetic_sizes (list, optional): Number of nodes of each synthetic plan. Defaults to SYNTHETIC_SIZES.
+
+    Returns:
+        list: (name, query) pairs.
+    """
+    if synthetic_sizes is None:
+        synthetic_sizes = SYNTHETIC_SIZES
+
+    queries = []
+    if mix in ("tpch", "mixed"):
+        queries += list(TPCH_QUERIES.items())
+    if mix in ("synthetic", "mixed"):
+        queries += [(f"synthetic-{size}", synthetic_query(size, size)) for size in synthetic_sizes]
+    return queries
+
+
+def parse_server_timing(header) -> dict:
+    """
+        Gets the duration in milliseconds of each stage reported in a Server-Timing header
+    """
+    return {name: float(duration) for name, duration in SERVER_TIMING.findall(header or "")}
+
+
+def in_process_sender():
+    """Sends requests to the app through a Flask test client per thread, without an HTTP server.
+
+    Returns:
+        function: Sends a query and returns the status code and the Server-Timing header.
+    """
+    from project import app
+
+    clients = threading.local()
+
+    def send(query):
+        if not hasattr(clients, "client"):
+            clients.client = app.test_client()
+        response = clients.client.post("/result", data={"queryText": query})
+        return response.status_code, response.headers.get("Server-Timing")
+
+    return send
+
+
+def http_sender(url):
+    """Sends requests to a running instance of the app over HTTP.
+
+    Args:
+        url (str): Base URL of the app, e.g. http://localhost:5000.
+
+    Returns:
+        function: Sends a query and returns the status code and the Server-Timing header.
+    """
+    endpoint = url.rstrip("/") + "/result"
+
+    def send(query):
+        request = Request(endpoint, data=urlencode({"queryText": query}).encode("utf-8"))
+        try:
+            with urlopen(request) as response:
+                response.read()
+                return response.status, response.headers.get("Server-Timing")
+        except HTTPError as error:
+            return error.code, error.headers.get("Server-Timing")
+
+    return send
+
+
+def run_load(send, queries, concurrency=DEFAULT_CONCURRENCY, duration=DEFAULT_DURATION, num_requests=None,
+             seed=0) -> tuple:
+    """Sends queries from concurrency threads until duration seconds have passed,
+    or until num_requests requests were sent if it is given.
+
+    Args:
+        send (function): Sends a query, from in_process_sender or http_sender.
+        queries (list): (name, query) pairs picked from at random for each request.
+        concurrency (int, optional): Number of concurrent clients. Defaults to DEFAULT_CONCURRENCY.
+        duration (float, optional): Seconds to send requests for. Defaults to DEFAULT_DURATION.
+        num_requests (int, optional): Number of requests to send instead of a duration. Defaults to None.
+        seed (int, optional): Seed of the choice of queries. Defaults to 0.
+
+    Returns:
+        tuple: The result of every request and the elapsed seconds.
+    """
+    counter = itertools.count()
+    results = []
+    lock = threading.Lock()
+    start = time.perf_counter()
+    deadline = start + duration
+
+    def client(index):
+        rng = Random(seed + index)
+        while True:
+            if num_requests is not None:
+                if next(counter) >= num_requests:
+                    return
+            elif time.perf_counter() >= deadline:
+                return
+
+            name, query = rng.choice(queries)
+            request_start = time.perf_counter()
+            try:
+                status, server_timing = send(query)
+            except Exception as error:
+                status, server_timing = None, None
+                print(f"Request for {name} failed: {error}", file=sys.stderr)
+            latency = time.perf_counter() - request_start
+
+            with lock:
+                results.append({"query": name, "status": status, "latency": latency * 1000,
+                                "stages": parse_server_timing(server_timing)})
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(client, range(concurrency)))
+    return results, time.perf_counter() - start
+
+
+def latency_summary(latencies) -> dict:
+    """
+        Gets the mean, percentiles and maximum of latencies in milliseconds
+    """
+    latencies = np.array(latencies, dtype=float)
+    if latencies.size == 0:
+        return {}
+    summary = {"mean": float(latencies.mean()), "max": float(latencies.max())}
+    for percentile, value in zip(PERCENTILES, np.percentile(latencies, PERCENTILES)):
+        summary[f"p{percentile}"] = float(value)
+    return summary
+
+
+def summarise_load(results, elapsed) -> dict:
+    """Summarises a load test into its throughput, latency percentiles and the latency of each stage
+    of handling a request, overall and per query.
+
+    Args:
+        results (list): Result of every request, from run_load.
+        elapsed (float): Seconds the load test took.
+
+    Returns:
+        dict: The summary.
+    """
+    succeeded = [result for result in results if result["status"] == 200]
+
+    stages = {}
+    for result in succeeded:
+        for stage, duration in result["stages"].items():
+            stages.setdefault(stage, []).append(duration)
+
+    queries = {}
+    for result in succeeded:
+        queries.setdefault(result["query"], []).append(result["latency"])
+
+    return {
+        "num_requests": len(results),
+        "num_errors": len(results) - len(succeeded),
+        "elapsed": elapsed,
+        "throughput": len(succeeded) / elapsed if elapsed else 0.0,
+        "latency": latency_summary([result["latency"] for result in succeeded]),
+        "stages": {stage: latency_summary(durations) for stage, durations in stages.items()},
+        "queries": {name: latency_summary(latencies) for name, latencies in sorted(queries.items())},
+    }
+
+
+def compare_summaries(previous, current) -> list:
+    """Compares the throughput and latencies of two load tests.
+
+    Returns:
+        list: (metric, previous value, current value, relative change) tuples.
+    """
+    rows = [("throughput", previous["throughput"], current["throughput"])]
+    for statistic in ["mean"] + [f"p{percentile}" for percentile in PERCENTILES]:
+        rows.append((f"latency {statistic}", previous["latency"].get(statistic), current["latency"].get(statistic)))
+    for stage in current["stages"]:
+        if stage in previous["stages"]:
+            rows.append((f"{stage} p95", previous["stages"][stage]["p95"], current["stages"][stage]["p95"]))
+
+    return [(metric, before, after, (after - before) / before if before else None)
+            for metric, before, after in rows if before is not None and after is not None]
+
+
+def print_summary(summary):
+    print(f"{summary['num_requests']} requests, {summary['num_errors']} errors in {summary['elapsed']:.2f}s "
+          f"({summary['throughput']:.2f} requests/s)")
+    latency = summary["latency"]
+    if latency:
+        print(f"Latency (ms): mean {latency['mean']:.2f}, p50 {latency['p50']:.2f}, "
+              f"p95 {latency['p95']:.2f}, p99 {latency['p99']:.2f}, max {latency['max']:.2f}")
+    print("Stages (ms):")
+    for stage, stage_latency in summary["stages"].items():
+        print(f"  {stage}: p50 {stage_latency['p50']:.2f}, p95 {stage_latency['p95']:.2f}, "
+              f"p99 {stage_latency['p99']:.2f}")
+    print("Queries (ms):")
+    for name, query_latency in summary["queries"].items():
+        print(f"  {name}: p50 {query_latency['p50']:.2f}, p95 {query_latency['p95']:.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the explain endpoint and report its latency.")
+    parser.add_argument("--url", help="base URL of a running app, instead of calling the app in process")
+    parser.add_argument("--replay", nargs="?", const="", metavar="PLANS",
+                        help="replay plans instead of querying PostgreSQL, optionally from a file saved with --record")
+    parser.add_argument("--replay-latency", type=float, default=0.0, help="milliseconds each replayed EXPLAIN takes")
+    parser.add_argument("--record", metavar="PLANS", help="save the plans of the TPC-H queries for --replay and exit")
+    parser.add_argument("-m", "--mix", default="tpch", choices=["tpch", "synthetic", "mixed"], help="queries to send")
+    parser.add_argument("--synthetic-sizes", type=int, nargs="+", default=SYNTHETIC_SIZES,
+                        help="number of nodes of the synthetic plans")
+    parser.add_argument("-c", "--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="number of concurrent clients")
+    parser.add_argument("-d", "--duration", type=float, default=DEFAULT_DURATION, help="seconds to send requests for")
+    parser.add_argument("-n", "--requests", type=int, help="number of requests to send instead of a duration")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the choice of queries")
+    parser.add_argument("-l", "--label", default=time.strftime("%Y%m%d-%H%M%S"), help="label of this run")
+    parser.add_argument("-o", "--output", help="file to save the results to, defaults to loadtest-<label>.json")
+    parser.add_argument("--compare", help="results of a previous run to compare against")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="explain every request instead of serving repeated queries from the shared cache")
+    args = parser.parse_args(argv)
+
+    if args.record:
+        record_plans(list(TPCH_QUERIES.values()), args.record)
+        print(f"Recorded {len(TPCH_QUERIES)} plans to {args.record}")
+        return 0
+
+    if args.mix != "tpch" and args.replay is None:
+        parser.error("synthetic plans are only available with --replay")
+
+    if args.url:
+        if args.replay is not None:
+            parser.error("--replay only applies to the app in process, not to --url")
+        send = http_sender(args.url)
+    else:
+        # Keep the plans of the load test out of the plan history and the shared cache of the app
+        state_dir = tempfile.mkdtemp()
+        os.environ.setdefault("PLAN_HISTORY_FILE", os.path.join(state_dir, "plan_history"))
+        os.environ.setdefault("SHARED_CACHE_FILE", os.path.join(state_dir, "shared_cache.bin"))
+        if args.no_cache:
+            os.environ["SHARED_CACHE"] = "off"
+        if args.replay is not None:
+            recorded_plans = {}
+            if args.replay:
+                with open(args.replay) as plans_file:
+                    recorded_plans = json.load(plans_file)
+            install_replay(recorded_plans, args.replay_latency / 1000)
+        send = in_process_sender()
+
+    graphs = set(os.listdir(os.path.join(os.getcwd(), "static")))
+    results, elapsed = run_load(send, query_mix(args.mix, args.synthetic_sizes), args.concurrency,
+                                args.duration, args.requests, args.seed)
+    if not args.url:
+        # The graphs rendered by the app during the load test are not needed
+        for graph in set(os.listdir(os.path.join(os.getcwd(), "static"))) - graphs:
+            if graph.startswith("qep_"):
+                os.remove(os.path.join(os.getcwd(), "static", graph))
+
+    summary = summarise_load(results, elapsed)
+    print_summary(summary)
+
+    output = args.output or f"loadtest-{args.label}.json"
+    with open(output, "w") as output_file:
+        json.dump({
+            "label": args.label,
+            "generated_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "config": {"url": args.url, "replay": args.replay, "replay_latency": args.replay_latency,
+                       "mix": args.mix, "concurrency": args.concurrency, "duration": args.duration,
+                       "requests": args.requests, "seed": args.seed},
+            "summary": summary,
+            "results": results,
+        }, output_file, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as previous_file:
+            previous = json.load(previous_file)
+        print(f"Compared to {previous['label']}:")
+        for metric, before, after, change in compare_summaries(previous["summary"], summary):
+            change = f"{change:+.1%}" if change is not None else "n/a"
+            print(f"  {metric}: {before:.2f} -> {after:.2f} ({change})")
+
+    return 1 if summary["num_errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
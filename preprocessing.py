@@ -1,29 +1,520 @@
-from psycopg2 import connect, sql
+import hashlib
+import json
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from json.decoder import scanstring
+
+from psycopg2 import connect, extensions, sql
+from psycopg2.extensions import TRANSACTION_STATUS_INERROR
+from psycopg2.extras import register_default_json
 from functools import wraps
 from interface import *
+from concurrency import EXECUTE_PRIORITY, PLAN_PRIORITY, AdmissionController
 
 DEFAULT_SEQ_PAGE_COST = 1.0
 DEFAULT_RAND_PAGE_COST = 4.0
+DEFAULT_CPU_TUPLE_COST = 0.01
+DEFAULT_CPU_OPERATOR_COST = 0.0025
+DEFAULT_PARALLEL_SETUP_COST = 1000.0
+DEFAULT_PARALLEL_TUPLE_COST = 0.1
+PARALLEL_WORKER_COUNTS = [0, 1, 2, 4, 8]
+DEFAULT_POOL_SIZE = 4
+DISABLE_COST = 1.0e10
+COLLAPSE_MIN_REPEATS = 3
+SHAPE_FIELDS = ["Node Type", "Parent Relationship", "Join Type", "Strategy", "Partial Mode", "Scan Direction"]
+GENERIC_PLAN_VERSION = 160000
+HASH_MEM_VERSION = 130000
+WORK_MEM_SIZES = [64, 256, 1024, 4096, 16384, 65536, 262144, 1048576]
+HASH_MEM_MULTIPLIERS = [1.0, 2.0, 4.0]
+TUPLE_HEADER_SIZE = 24
+HASH_TUPLE_OVERHEAD = 16
+READ_ONLY_STATEMENTS = ("select", "with", "values", "table")
+JOIN_NODES = ["Hash Join", "Merge Join", "Nested Loop"]
+OPERATOR_SWITCHES = {
+    "Hash Join": "enable_hashjoin",
+    "Merge Join": "enable_mergejoin",
+    "Nested Loop": "enable_nestloop",
+    "Seq Scan": "enable_seqscan",
+    "Index Scan": "enable_indexscan",
+    "Index Only Scan": "enable_indexonlyscan",
+    "Bitmap Heap Scan": "enable_bitmapscan",
+    "Sort": "enable_sort",
+}
 
 """ cost = ( #blocks * seq_page_cost ) + ( #records * cpu_tuple_cost ) + ( #records * cpu_filter_cost )"""
 
+JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+JSON_NUMBER = re.compile(r"-?(?:0|[1-9]\d*)(\.\d+)?([eE][-+]?\d+)?")
+JSON_CONSTANTS = {"true": True, "false": False, "null": None}
+PARAMETER = re.compile(r"\$(\d+)")
+
+"""
+Parses the JSON output of EXPLAIN.
+Plans are parsed with the json module, falling back to an iterative parser when the plan is
+nested too deeply for it (e.g. long chains of nested loops).
+Args:
+    text (string): JSON document returned by PostgreSQL.
+Returns:
+    list: The parsed EXPLAIN output.
+"""
+
+
+def parse_plan_json(text):
+    try:
+        return json.loads(text)
+    except RecursionError:
+        return parse_json_iteratively(text)
+
+
+"""
+Parses a JSON document with an explicit stack of the containers that are still open,
+so that the nesting depth is not limited by the recursion limit.
+Args:
+    text (string): JSON document.
+Returns:
+    The parsed JSON value.
+"""
+
+
+def parse_json_iteratively(text):
+    containers = []
+    keys = []
+    index = 0
+
+    while True:
+        index = JSON_WHITESPACE.match(text, index).end()
+        char = text[index]
+
+        # Open a new object or array, unless it is empty
+        if char == "{" or char == "[":
+            index = JSON_WHITESPACE.match(text, index + 1).end()
+            if text[index] == ("}" if char == "{" else "]"):
+                value = {} if char == "{" else []
+                index += 1
+            else:
+                containers.append({} if char == "{" else [])
+                keys.append(None)
+                if char == "{":
+                    keys[-1], index = parse_json_key(text, index)
+                continue
+        elif char == '"':
+            value, index = scanstring(text, index + 1)
+        elif char == "-" or char.isdigit():
+            match = JSON_NUMBER.match(text, index)
+            value = float(match.group()) if match.group(1) or match.group(2) else int(match.group())
+            index = match.end()
+        else:
+            for constant, constant_value in JSON_CONSTANTS.items():
+                if text.startswith(constant, index):
+                    value = constant_value
+                    index += len(constant)
+                    break
+            else:
+                raise ValueError(f"Unexpected character {char!r} at position {index}")
+
+        # Add the value to its container, closing every container that ends after it
+        while True:
+            if not containers:
+                return value
+            if keys[-1] is None:
+                containers[-1].append(value)
+            else:
+                containers[-1][keys[-1]] = value
+
+            index = JSON_WHITESPACE.match(text, index).end()
+            char = text[index]
+            index += 1
+            if char == ",":
+                if keys[-1] is not None:
+                    keys[-1], index = parse_json_key(text, index)
+                break
+            value = containers.pop()
+            keys.pop()
+
+
+def parse_json_key(text, index):
+    """
+        Parses the key of an object member and the colon after it
+        Returns:
+            tuple: the key and the index of its value
+    """
+    index = JSON_WHITESPACE.match(text, index).end()
+    key, index = scanstring(text, index + 1)
+    index = JSON_WHITESPACE.match(text, index).end()
+    return key, index + 1
+
+"""
+Computes the fingerprint of a query, so that queries which only differ in their
+literals, whitespace or letter case are grouped together.
+Args:
+    query (string): Query string that was entered by the user.
+Returns:
+    string: Hex digest identifying the normalised query.
+"""
+
+
+def fingerprint_query(query):
+    normalised = re.sub(r"--[^\n]*|/\*.*?\*/", " ", query, flags=re.S)
+    normalised = re.sub(r"'(?:[^']|'')*'", "?", normalised)
+    normalised = re.sub(r"\b\d+(?:\.\d+)?\b", "?", normalised)
+    normalised = " ".join(normalised.lower().split()).rstrip(";").strip()
+    return hashlib.sha1(normalised.encode("utf-8")).hexdigest()[:16]
+
+
+"""
+Gives each node of a plan a key that matches the equivalent node in another plan of the same relations:
+scans are keyed by their relation, joins by the set of relations they join, and other nodes
+by their node type and the set of relations below them. The relations of a node collapsed by collapse_plan
+are all the relations it stands for, so that the nodes above it get the same keys as in the plan before it
+was collapsed.
+Args:
+    plan (dict): Query plan that is generated by PostgreSQL.
+Returns:
+    list: (node, key) pairs in pre-order.
+"""
+
+
+def plan_alignment_keys(plan):
+    preorder = []
+    stack = [plan]
+    while stack:
+        node = stack.pop()
+        preorder.append(node)
+        stack.extend(reversed(node.get("Plans", [])))
+
+    # Collect the relations below each node, starting from the leaves
+    relations = {}
+    for node in reversed(preorder):
+        node_relations = {node["Relation Name"]} if node.get("Relation Name") else set()
+        node_relations.update(node.get("Collapsed Relations", []))
+        for child in node.get("Plans", []):
+            node_relations |= relations[id(child)]
+        relations[id(node)] = frozenset(node_relations)
+
+    keys = []
+    for node in preorder:
+        if node.get("Relation Name"):
+            category = "Scan"
+        elif node["Node Type"] in JOIN_NODES:
+            category = "Join"
+        else:
+            category = node["Node Type"]
+        keys.append((node, (category, relations[id(node)])))
+    return keys
+
+
+"""
+Collapses sibling subtrees of the same shape, such as the scans of the partitions of a table under an Append,
+into a single node standing for all of them, so that annotating, laying out and rendering a plan depends
+on the number of distinct shapes rather than the number of nodes.
+Subtrees have the same shape when their nodes have the same SHAPE_FIELDS and are arranged the same way,
+whatever relations they scan. Each node of a collapsed subtree is the node of the first subtree, with:
+    Collapsed Count: number of nodes it stands for
+    Collapsed Total Cost: sum of their total costs
+    Collapsed Cost Range: lowest and highest of their total costs
+    Collapsed Plan Rows: sum of their plan rows
+    Collapsed Relations: relations they scan
+Args:
+    plan (dict): Query plan that is generated by PostgreSQL.
+    min_repeats (int): Number of siblings of the same shape from which they are collapsed.
+Returns:
+    dict: The collapsed plan. The plan itself is left unchanged.
+"""
+
+
+def collapse_plan(plan, min_repeats=COLLAPSE_MIN_REPEATS):
+    preorder = []
+    stack = [plan]
+    while stack:
+        node = stack.pop()
+        preorder.append(node)
+        stack.extend(reversed(node.get("Plans", [])))
+
+    # Number the shapes of the subtrees starting from the leaves, so that equal shapes get equal numbers
+    shapes = {}
+    shape_ids = {}
+    for node in reversed(preorder):
+        shape = (tuple(node.get(field) for field in SHAPE_FIELDS),
+                 tuple(shape_ids[id(child)] for child in node.get("Plans", [])))
+        shape_ids[id(node)] = shapes.setdefault(shape, len(shapes))
+
+    # Each collapsed node is built from the group of nodes it stands for, which all have the same shape
+    root = {}
+    stack = [([plan], root)]
+    while stack:
+        group, collapsed = stack.pop()
+        collapsed.update((key, value) for key, value in group[0].items() if key != "Plans")
+        if len(group) > 1:
+            costs = [node["Total Cost"] for node in group]
+            collapsed["Collapsed Count"] = len(group)
+            collapsed["Collapsed Total Cost"] = sum(costs)
+            collapsed["Collapsed Cost Range"] = [min(costs), max(costs)]
+            collapsed["Collapsed Plan Rows"] = sum(node["Plan Rows"] for node in group)
+            relations = list(dict.fromkeys(node["Relation Name"] for node in group if node.get("Relation Name")))
+            if relations:
+                collapsed["Collapsed Relations"] = relations
+
+        children = group[0].get("Plans", [])
+        if not children:
+            continue
+
+        # Siblings of the same shape are grouped when there are at least min_repeats of them
+        positions = {}
+        for position, child in enumerate(children):
+            positions.setdefault(shape_ids[id(child)], []).append(position)
+
+        collapsed["Plans"] = []
+        for position, child in enumerate(children):
+            same_shape = positions[shape_ids[id(child)]]
+            if len(same_shape) >= min_repeats:
+                if same_shape[0] != position:
+                    continue
+                child_group = [node["Plans"][index] for index in same_shape for node in group]
+            else:
+                child_group = [node["Plans"][position] for node in group]
+            collapsed["Plans"].append({})
+            stack.append((child_group, collapsed["Plans"][-1]))
+
+    return root
+
+
+"""
+Gets the planner switch (enable_*) that disables the operator of a node.
+Args:
+    node (dict): A node of a query plan.
+Returns:
+    string: Name of the switch, or None if the operator cannot be disabled.
+"""
+
+
+def operator_switch(node):
+    if node["Node Type"] == "Aggregate" and node.get("Strategy") == "Hashed":
+        return "enable_hashagg"
+    return OPERATOR_SWITCHES.get(node["Node Type"])
+
+
+"""
+Finds the operators of a plan that use work_mem and spill to disk beyond it: sorts, hashes of hash joins,
+and aggregates and set operations by hashing. Each one is identified across the plans of the same query by
+its node type, strategy, keys and the relations it reads from, as a JSON string so that results keyed by
+operator can be cached as JSON.
+Args:
+    plan (dict): Query plan that is generated by PostgreSQL.
+Returns:
+    list: (node, key) pairs in pre-order.
+"""
+
+
+def memory_operators(plan):
+    operators = []
+    for node, (_, relations) in plan_alignment_keys(plan):
+        node_type = node["Node Type"]
+        strategy = node.get("Strategy")
+        if node_type in ("Sort", "Hash") or (node_type in ("Aggregate", "SetOp") and strategy in ("Hashed", "Mixed")):
+            keys = node.get("Sort Key", node.get("Group Key", []))
+            operators.append((node, json.dumps([node_type, strategy, keys, sorted(relations)])))
+    return operators
+
+
+"""
+Estimates the memory that an operator found by memory_operators needs to run without spilling to disk.
+When the plan was analyzed, this is the memory it used, times the number of batches it was split into if it
+spilled. Otherwise it is estimated as the planner does, from the rows and width it expects and the size of
+a tuple header. Hashes may use hash_mem_multiplier times work_mem, so they need that much less work_mem.
+Args:
+    node (dict): The node of the operator.
+    hash_mem_multiplier (float): hash_mem_multiplier that the operator runs with.
+Returns:
+    dict: The memory and the work_mem needed in kB, and whether the operator spilled, None if it did not run.
+"""
+
+
+def memory_requirement(node, hash_mem_multiplier):
+    hashed = node["Node Type"] != "Sort"
+    width = -(-node["Plan Width"] // 8) * 8
+    tuple_size = width + TUPLE_HEADER_SIZE + (HASH_TUPLE_OVERHEAD if hashed else 0)
+    memory = node.get("Actual Rows", node["Plan Rows"]) * tuple_size / 1024
+    spilled = None
+
+    if "Sort Space Type" in node:
+        spilled = node["Sort Space Type"] == "Disk"
+        # Sorted tuples take less space on disk than in memory, so the estimate is kept when it is larger
+        memory = max(memory, node["Sort Space Used"]) if spilled else node["Sort Space Used"]
+    elif "Peak Memory Usage" in node:
+        batches = max(node.get("Hash Batches", 1), node.get("HashAgg Batches", 1), 1)
+        spilled = batches > 1 or node.get("Disk Usage", 0) > 0
+        memory = node["Peak Memory Usage"] * batches
+
+    min_work_mem = memory / hash_mem_multiplier if hashed else memory
+    return {"memory": int(-(-memory // 1)), "min_work_mem": max(64, int(-(-min_work_mem // 1))), "spilled": spilled}
+
+
+"""
+Describes an operator found by memory_operators, e.g. "Hash Join (Hashed) on customer, orders".
+Args:
+    key (string): Key of the operator.
+Returns:
+    string: Description of the operator.
+"""
+
+
+def memory_operator_label(key):
+    node_type, strategy, _, relations = json.loads(key)
+    label = f"{node_type} ({strategy})" if strategy else node_type
+    return f"{label} on {', '.join(relations)}" if relations else label
+
+
+"""
+Annotates the operators of a QEP that use work_mem with the work_mem they need to run in memory.
+Args:
+    plan (QueryPlan): The QEP.
+    sweep (dict): Result of QueryProcessor.work_mem_sweep for the query.
+"""
+
+
+def annotate_work_mem(plan, sweep):
+    operators = {id(node): key for node, key in memory_operators(plan.query_plan)}
+
+    def annotate(query_plan):
+        requirement = sweep["operators"].get(operators.get(id(query_plan)))
+        if requirement is None:
+            return ""
+        return work_mem_annotation(requirement["min_work_mem"], sweep["work_mem"])
+
+    plan.append_annotations(annotate)
+
+
+"""
+Annotates each node of a QEP with the comparisons of QueryProcessor.explain_operator_choice that explain it,
+which are indexed by the plan_alignment_keys key of the node rather than by its condition, so that nodes
+without a condition, such as merge joins, get theirs and nodes of the same relation do not get each other's.
+Args:
+    plan (QueryPlan): The QEP.
+    comparisons (dict): Comparisons of the AQPs of the query.
+"""
+
+
+def annotate_operator_choices(plan, comparisons):
+    keys = {id(node): key for node, key in plan_alignment_keys(plan.query_plan)}
+
+    def annotate(query_plan):
+        comparison = comparisons.get(keys[id(query_plan)])
+        return " " + comparison if comparison is not None else ""
+
+    plan.append_annotations(annotate)
+
+
+"""
+Checks whether a query only reads, so that executing it with EXPLAIN ANALYZE changes nothing.
+Args:
+    query (string): Query string that was entered by the user.
+Returns:
+    bool: Whether the query is a SELECT, WITH, VALUES or TABLE statement.
+"""
+
+
+def is_read_only(query):
+    return query.lstrip().lower().startswith(READ_ONLY_STATEMENTS)
+
+
+"""
+Loads the planner cost constants that the QEP is explained with, as recommended by calibration.py.
+Constants that are not calibrated keep PostgreSQL's defaults.
+Args:
+    file_name (string): Path of the calibration file.
+Returns:
+    dict: Mapping of setting name to its value.
+"""
+
+
+def load_calibration(file_name):
+    settings = {
+        "seq_page_cost": DEFAULT_SEQ_PAGE_COST,
+        "random_page_cost": DEFAULT_RAND_PAGE_COST,
+        "cpu_tuple_cost": DEFAULT_CPU_TUPLE_COST,
+        "cpu_operator_cost": DEFAULT_CPU_OPERATOR_COST,
+    }
+    if os.path.exists(file_name):
+        with open(file_name) as calibration_file:
+            calibration = json.load(calibration_file)
+        settings.update((name, float(calibration[name])) for name in settings if name in calibration)
+    return settings
+
+
+"""
+Counts the parameters ($1, $2, ...) of a parameterized query.
+Args:
+    query (string): Query string that was entered by the user.
+Returns:
+    int: The highest parameter number, 0 if the query is not parameterized.
+"""
+
+
+def count_parameters(query):
+    # Parameters inside string literals and comments are not parameters
+    query = re.sub(r"--[^\n]*|/\*.*?\*/|'(?:[^']|'')*'", " ", query, flags=re.S)
+    return max((int(number) for number in PARAMETER.findall(query)), default=0)
+
+
+"""
+Parses the samples of parameter values of a parameterized query, one JSON array of values per line.
+Args:
+    text (string): Samples that were entered by the user.
+    num_parameters (int): Number of parameters of the query.
+Returns:
+    dict: Output dict consisting of the samples, error status and error message.
+"""
+
+
+def parse_parameter_sets(text, num_parameters):
+    output = {"parameter_sets": [], "error": False, "error_message": ""}
+
+    for number, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            parameters = json.loads(line)
+        except ValueError:
+            parameters = None
+        if not isinstance(parameters, list) or len(parameters) != num_parameters:
+            output["error"] = True
+            output["error_message"] = f"Line {number} of the parameters is not a JSON array of {num_parameters} values."
+            return output
+        output["parameter_sets"].append(parameters)
+
+    return output
+
+
 """
 Check if the query is valid.
+Parameterized queries are prepared instead of executed, as they cannot be executed without parameters.
 Args:
     query (string): Query string that was entered by the user.
+    processor (QueryProcessor): Processor to validate with, defaults to the shared query_processor.
 Returns:
     dict: Output dict consisting of error status and error message.
 """
 
 
-def validate(query):
+def validate(query, processor=None):
     output = {"query": query, "error": False, "error_message": ""}
 
+    if processor is None:
+        processor = query_processor
+
     if not len(query):
         output["error"] = True
         output["error_message"] = "Query is empty."
 
-    if not query_processor.query_valid(query):
+    valid = processor.prepare_valid(query) if count_parameters(query) else processor.query_valid(query)
+    if not valid:
         output["error"] = True
         output["error_message"] = "Query is invalid."
         return output
@@ -80,10 +571,49 @@ class SimplifiedPlan:
         return self.cost - cost
 
 
+class TimedConnection(extensions.connection):
+    def __init__(self, *args, **kwargs):
+        """
+            Connection that counts the statements executed by its cursors and the time they took,
+            i.e. the time spent waiting for the database only
+        """
+        super().__init__(*args, **kwargs)
+        self.db_time = 0.0
+        self.num_statements = 0
+
+    def cursor(self, *args, **kwargs):
+        kwargs.setdefault("cursor_factory", TimedCursor)
+        return super().cursor(*args, **kwargs)
+
+
+class TimedCursor(extensions.cursor):
+    def execute(self, query, vars=None):
+        start = time.monotonic()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self.connection.db_time += time.monotonic() - start
+            self.connection.num_statements += 1
+
+
 class QueryProcessor:
     def __init__(self, db_config):
-        self.conn = self.start_db_connection(db_config)
-        self.cursor = self.conn.cursor()
+        self.db_config = db_config
+        self.connection = None
+        self.cursor = None
+
+    @property
+    def conn(self):
+        """
+            Connection to the database, which is only established when it is first used,
+            so that processors can be created before forking worker processes.
+            Returns:
+                connection: Connection to the database.
+        """
+        if self.connection is None:
+            self.connection = self.start_db_connection(self.db_config)
+            register_default_json(self.connection, loads=parse_plan_json)
+        return self.connection
 
     def start_db_connection(self, db_config):
         """
@@ -97,8 +627,20 @@ class QueryProcessor:
             password=db_config.POSTGRES_PASSWORD,
             host=db_config.POSTGRES_HOST,
             port=db_config.POSTGRES_PORT,
+            connection_factory=TimedConnection,
         )
 
+    def statement_time(self) -> tuple:
+        """
+            Gets the time spent executing statements on the connection and their number, as counted by
+            TimedConnection, both zero while the connection is not established
+            Returns:
+                tuple: Seconds spent executing statements and number of statements
+        """
+        if self.connection is None:
+            return 0.0, 0
+        return self.connection.db_time, self.connection.num_statements
+
     def single_transaction(func):
         """
             Decorator to create cursor each time the function is called.
@@ -121,46 +663,343 @@ class QueryProcessor:
 
         return inner_func
 
+    def read_only_transaction(func):
+        """
+            Decorator to create cursor each time the function is called, and run the function in a
+            read-only transaction that is always rolled back, for functions that may execute the user's query.
+            PostgreSQL rejects any write in the transaction, including those of data-modifying WITH clauses.
+            Args:
+                func (function): Function to be wrapped
+            Returns:
+                function: Wrapped function
+        """
+
+        @wraps(func)
+        def inner_func(self, *args, **kwargs):
+            try:
+                self.cursor = self.conn.cursor()
+                self.cursor.execute("SET TRANSACTION READ ONLY")
+                return func(self, *args, **kwargs)
+            except Exception as error:
+                print(f"Exception encountered, rolling back: {error}")
+            finally:
+                self.conn.rollback()
+
+        return inner_func
+
     def stop_db_connection(self):
-        self.conn.close()
-        self.cursor.close()
+        if self.connection is None:
+            return
+        self.connection.close()
+        self.connection = None
+        self.cursor = None
 
     def change_parameters(self, seq_page, rand_page):
         self.cursor.execute("SET seq_page_cost TO " + str(seq_page))
         self.cursor.execute("SET random_page_cost TO " + str(rand_page))
 
+    def change_local_settings(self, settings: dict):
+        """
+            Changes planner settings for the current transaction only, so that they are
+            reverted once the transaction commits or rolls back.
+            Args:
+                settings (dict): Mapping of setting name to its value
+        """
+        for name, value in settings.items():
+            self.cursor.execute(
+                sql.SQL("SET LOCAL {} TO {}").format(sql.Identifier(name), sql.Literal(str(value)))
+            )
+
     @single_transaction
-    def explain(self, query: str) -> QueryPlan:
+    def explain(self, query: str, collapse: bool = True) -> QueryPlan:
         """
             Gets execution plan of statement from PostgreSQL
             Args:
                 query (str): Query string that was entered by the user.
+                collapse (bool): Whether to collapse sibling subtrees of the same shape, see collapse_plan.
             Returns:
                 QueryPlan: An object consisting of all the necessary information in the QEP
                 to be displayed to the user.
         """
         query_explainer = "EXPLAIN (FORMAT JSON, SETTINGS ON) " + query
         # Do default settings first
-        qep_plan: dict = self.execute_query(query_explainer, DEFAULT_SEQ_PAGE_COST, DEFAULT_RAND_PAGE_COST)
+        self.change_local_settings(baseline_settings)
+        qep_plan: dict = self.execute_query(query_explainer, baseline_settings["seq_page_cost"],
+                                            baseline_settings["random_page_cost"])
+
+        # Combine the dictionaries
+        comparison_dict = {}
+        for comparison in self.aqp_comparisons(query_explainer, qep_plan):
+            comparison_dict = self.add_comparisons(comparison_dict, comparison)
+
+        if collapse:
+            qep_plan = collapse_plan(qep_plan)
+        plan = QueryPlan(qep_plan, comparison_dict)
+        annotate_operator_choices(plan, comparison_dict)
+        return plan
+
+    def explain_progressively(self, query: str, collapse: bool = True):
+        """
+            Gets execution plan of statement from PostgreSQL like explain, but yields each result as soon
+            as it is available instead of waiting for every AQP. The transaction is handled here rather than
+            by single_transaction, as it stays open between the results.
+            Args:
+                query (str): Query string that was entered by the user.
+                collapse (bool): Whether to collapse sibling subtrees of the same shape, see collapse_plan.
+            Yields:
+                tuple: ("qep", QueryPlan) for the QEP without comparisons, then ("comparison", dict) for
+                the comparisons of each AQP, then ("plan", QueryPlan) for the QEP with every comparison.
+        """
+        query_explainer = "EXPLAIN (FORMAT JSON, SETTINGS ON) " + query
+        self.cursor = self.conn.cursor()
+        try:
+            self.change_local_settings(baseline_settings)
+            qep_plan: dict = self.execute_query(query_explainer, baseline_settings["seq_page_cost"],
+                                                baseline_settings["random_page_cost"])
+            collapsed_plan = collapse_plan(qep_plan) if collapse else qep_plan
+            yield "qep", QueryPlan(collapsed_plan, {})
 
+            comparison_dict = {}
+            for comparison in self.aqp_comparisons(query_explainer, qep_plan):
+                comparison_dict = self.add_comparisons(comparison_dict, comparison)
+                yield "comparison", comparison
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+
+        plan = QueryPlan(collapsed_plan, comparison_dict)
+        annotate_operator_choices(plan, comparison_dict)
+        yield "plan", plan
+
+    def aqp_comparisons(self, query_explainer, qep_plan: dict):
+        """
+            Gets an AQP at a time and compares it with the QEP: first the AQPs with higher page costs,
+            then the operator-forcing AQPs, one per operator used by the QEP.
+            Args:
+                query_explainer (str): Query string (with the EXPLAIN statement)
+                qep_plan (dict): the best Query Execution Plan
+            Yields:
+                dict: comparisons of an AQP, indexed like scan_tree, or like explain_operator_choice
+                for the operator-forcing AQPs
+        """
         # First AQP
-        aqp_plan1: dict = self.execute_query(query_explainer, DEFAULT_SEQ_PAGE_COST + 10,
-                                             DEFAULT_RAND_PAGE_COST + 2)
-        comparison1 = self.scan_tree(qep_plan, aqp_plan1)
+        aqp_plan1: dict = self.execute_query(query_explainer, baseline_settings["seq_page_cost"] + 10,
+                                             baseline_settings["random_page_cost"] + 2)
+        yield self.scan_tree(qep_plan, aqp_plan1)
 
         # Second AQP
-        aqp_plan2: dict = self.execute_query(query_explainer, DEFAULT_SEQ_PAGE_COST + 5,
-                                             DEFAULT_RAND_PAGE_COST)
+        aqp_plan2: dict = self.execute_query(query_explainer, baseline_settings["seq_page_cost"] + 5,
+                                             baseline_settings["random_page_cost"])
+        yield self.scan_tree(qep_plan, aqp_plan2)
 
-        # Do the comparisons
-        comparison2 = self.scan_tree(qep_plan, aqp_plan2)
+        # Operator-forcing AQPs, one per operator used by the QEP
+        for switch, aqp_plan in self.forced_plans(query_explainer, qep_plan):
+            yield self.explain_operator_choice(qep_plan, aqp_plan, switch)
 
-        # Combine the dictionaries
-        comparison_dict = {}
-        comparison_dict = self.add_comparisons(comparison_dict, comparison1)
-        comparison_dict = self.add_comparisons(comparison_dict, comparison2)
+    def forced_plans(self, query_explainer, qep_plan: dict):
+        """
+            Gets an AQP for each planner switch of the operators used by the QEP, with that switch off.
+            This takes one EXPLAIN per distinct switch, so at most one per entry of OPERATOR_SWITCHES
+            and enable_hashagg.
+            Args:
+                query_explainer (str): Query string (with the EXPLAIN statement)
+                qep_plan (dict): the best Query Execution Plan
+            Yields:
+                tuple: (switch, AQP) pairs, each explained when it is needed
+        """
+        switches = []
+        for node, _ in plan_alignment_keys(qep_plan):
+            switch = operator_switch(node)
+            if switch is not None and switch not in switches:
+                switches.append(switch)
+
+        for switch in switches:
+            # Settings made with SET LOCAL last until the end of the transaction, so every switch
+            # other than the one being forced off is turned back on
+            settings = dict(baseline_settings)
+            settings.update({name: "off" if name == switch else "on" for name in switches})
+            yield switch, self.execute_query_with_settings(query_explainer, settings)
+
+    def explain_operator_choice(self, qep: dict, aqp: dict, switch: str) -> dict:
+        """
+        Explains why each operator of the QEP that is disabled by a switch was chosen, by comparing it to
+        the operator the AQP uses for the same relations with that switch off
+        Args:
+            qep: the best Query Execution Plan
+            aqp: the Alternate Query Plan with the switch off
+            switch: name of the planner switch that was turned off
+        Returns:
+            dict: comparisons indexed by the plan_alignment_keys key of the QEP node they explain,
+            which annotate_operator_choices appends to the annotation of that node
+        """
+        # The planner charges DISABLE_COST for each disabled operator it could not avoid, which is not
+        # part of the estimated cost of the plan
+        qep_cost = qep["Total Cost"]
+        aqp_cost = max(qep_cost, aqp["Total Cost"] % DISABLE_COST)
+        increase = (aqp_cost - qep_cost) / qep_cost * 100 if qep_cost > 0 else 0.0
+
+        alternatives = {}
+        for node, key in plan_alignment_keys(aqp):
+            alternatives.setdefault(key, node)
+
+        comparisons = {}
+        for node, key in plan_alignment_keys(qep):
+            if operator_switch(node) != switch:
+                continue
+
+            alternative = alternatives.get(key)
+            if alternative is None:
+                comparison_string = f"Without {node['Node Type']} ({switch} off), the plan cost rises " \
+                                    f"from {qep_cost} to {aqp_cost} (+{increase:.1f}%)."
+            elif alternative["Node Type"] == node["Node Type"]:
+                comparison_string = f"{node['Node Type']} is kept even with {switch} off, " \
+                                    f"as the planner has no alternative for this step."
+            else:
+                comparison_string = f"{node['Node Type']} was chosen over {alternative['Node Type']}, " \
+                                    f"which would raise the plan cost from {qep_cost} to {aqp_cost} (+{increase:.1f}%)."
+
+            # Scans of the same relation share their key, and their comparison says the same thing once
+            if comparison_string in comparisons.get(key, ""):
+                continue
+            comparisons = self.add_comparisons(comparisons, {key: comparison_string})
+
+        return comparisons
+
+    @single_transaction
+    def explain_qep(self, query: str, collapse: bool = True) -> QueryPlan:
+        """
+            Gets only the execution plan of statement from PostgreSQL, without any AQP
+            Args:
+                query (str): Query string that was entered by the user.
+                collapse (bool): Whether to collapse sibling subtrees of the same shape, see collapse_plan.
+            Returns:
+                QueryPlan: The QEP, without any AQP comparison in its explanation.
+        """
+        query_explainer = "EXPLAIN (FORMAT JSON, SETTINGS ON) " + query
+        qep_plan: dict = self.execute_query_with_settings(query_explainer, baseline_settings)
+        if collapse:
+            qep_plan = collapse_plan(qep_plan)
+        return QueryPlan(qep_plan, {})
+
+    @single_transaction
+    def parallel_sweep(self, query: str, worker_counts=None,
+                       setup_cost=DEFAULT_PARALLEL_SETUP_COST,
+                       tuple_cost=DEFAULT_PARALLEL_TUPLE_COST) -> list:
+        """
+            Gets the estimated cost of the query for each number of parallel workers per gather
+            Args:
+                query (str): Query string that was entered by the user.
+                worker_counts (list): Values of max_parallel_workers_per_gather to plan with
+                setup_cost (float): parallel_setup_cost to plan with
+                tuple_cost (float): parallel_tuple_cost to plan with
+            Returns:
+                list: a dict per worker count with the estimated cost and the parallelism of the plan
+        """
+        if worker_counts is None:
+            worker_counts = PARALLEL_WORKER_COUNTS
+        query_explainer = "EXPLAIN (FORMAT JSON, SETTINGS ON) " + query
+
+        sweep = []
+        for workers in worker_counts:
+            plan: dict = self.execute_query_with_settings(query_explainer, dict(
+                baseline_settings,
+                max_parallel_workers_per_gather=workers,
+                parallel_setup_cost=setup_cost,
+                parallel_tuple_cost=tuple_cost,
+            ))
+            query_plan = QueryPlan(collapse_plan(plan), {})
+            sweep.append({
+                "max_workers": workers,
+                "total_cost": plan["Total Cost"],
+                "workers_planned": query_plan.workers_planned,
+                "parallel_nodes": query_plan.num_parallel_nodes,
+            })
+        return sweep
+
+    @read_only_transaction
+    def work_mem_sweep(self, query: str, work_mem_sizes=None, multipliers=None, analyze: bool = False) -> dict:
+        """
+            Plans the query for each work_mem and hash_mem_multiplier, to find where the planner switches between
+            hashed and sorted aggregates and where sorts and hashes start to spill to disk
+            Args:
+                query (str): Query string that was entered by the user.
+                work_mem_sizes (list): Values of work_mem in kB to plan with, smallest first
+                multipliers (list): Values of hash_mem_multiplier to plan with, along with the current one
+                analyze (bool): Whether to execute the query with EXPLAIN ANALYZE, which is only done for queries
+                that only read, to measure whether the operators spilled rather than estimate it. The sweep runs
+                in a read-only transaction that is rolled back, so a query that writes fails rather than changes
+                any data
+            Returns:
+                dict: a dict per setting with the estimated cost, the aggregate strategies and the number of
+                operators that spill, the memory needed by each operator that uses work_mem, and the smallest
+                work_mem with which none of them spills, all at the current hash_mem_multiplier
+        """
+        if work_mem_sizes is None:
+            work_mem_sizes = WORK_MEM_SIZES
+        if multipliers is None:
+            multipliers = HASH_MEM_MULTIPLIERS
+        analyze = analyze and is_read_only(query)
+        query_explainer = ("EXPLAIN (ANALYZE, FORMAT JSON) " if analyze else "EXPLAIN (FORMAT JSON) ") + query
+
+        self.cursor.execute("SELECT name, setting FROM pg_settings WHERE name IN ('work_mem', 'hash_mem_multiplier')")
+        current = dict(self.cursor.fetchall())
+        if self.conn.server_version >= HASH_MEM_VERSION:
+            current_multiplier = float(current["hash_mem_multiplier"])
+            multipliers = sorted(set(multipliers) | {current_multiplier})
+        else:
+            # Before hash_mem_multiplier, hashes were limited by work_mem alone
+            current_multiplier = 1.0
+            multipliers = [None]
 
-        return QueryPlan(qep_plan, comparison_dict)
+        rows = []
+        operators = {}
+        for multiplier in multipliers:
+            previous_shape = None
+            for work_mem in work_mem_sizes:
+                settings = dict(baseline_settings, work_mem=f"{work_mem}kB")
+                if multiplier is not None:
+                    settings["hash_mem_multiplier"] = multiplier
+                plan: dict = self.execute_query_with_settings(query_explainer, settings)
+
+                strategies = Counter()
+                num_spilled = 0
+                for node, key in memory_operators(plan):
+                    requirement = memory_requirement(node, multiplier or 1.0)
+                    spilled = requirement["spilled"]
+                    if spilled is None:
+                        spilled = requirement["min_work_mem"] > work_mem
+                    num_spilled += spilled
+                    if multiplier in (current_multiplier, None):
+                        # The operator is described by the plan with the most work_mem it appears in
+                        requirement = memory_requirement(node, current_multiplier)
+                        operators[key] = dict(requirement, label=memory_operator_label(key))
+                for node, _ in plan_alignment_keys(plan):
+                    if node["Node Type"] == "Aggregate":
+                        strategies[node.get("Strategy", "Plain")] += 1
+
+                shape = tuple((node["Node Type"], node.get("Strategy")) for node, _ in plan_alignment_keys(plan))
+                rows.append({
+                    "work_mem": work_mem,
+                    "hash_mem_multiplier": multiplier,
+                    "total_cost": plan["Total Cost"],
+                    "hashed_aggregates": strategies["Hashed"] + strategies["Mixed"],
+                    "sorted_aggregates": strategies["Sorted"],
+                    "spilled": num_spilled,
+                    "plan_changed": previous_shape is not None and shape != previous_shape,
+                })
+                previous_shape = shape
+
+        in_memory = [row["work_mem"] for row in rows
+                     if row["hash_mem_multiplier"] in (current_multiplier, None) and row["spilled"] == 0]
+        return {
+            "rows": rows,
+            "operators": operators,
+            "work_mem": int(current["work_mem"]),
+            "hash_mem_multiplier": current_multiplier,
+            "min_work_mem": min(in_memory, default=None),
+            "analyzed": analyze,
+        }
 
     @single_transaction
     def query_valid(self, query: str):
@@ -179,6 +1018,113 @@ class QueryProcessor:
             return False
         return True
 
+    @single_transaction
+    def prepare_valid(self, query: str):
+        """
+           Prepares a parameterized query to validate it, without executing it
+           Args:
+               query (str): Query string with parameters
+           Returns:
+               bool: Whether the query is valid.
+        """
+        name = self.prepare(query)
+        self.cursor.execute(f"DEALLOCATE {name}")
+        return True
+
+    @single_transaction
+    def explain_parameterized(self, query: str, parameter_sets=None, collapse: bool = True) -> dict:
+        """
+            Gets the generic plan of a parameterized query, which the plan cache reuses for any parameters,
+            and the custom plan for each sample of parameters, and compares each custom plan with the generic plan.
+            The generic plan comes from EXPLAIN (GENERIC_PLAN) on PostgreSQL 16 and later, and otherwise
+            from the prepared statement with plan_cache_mode set to force_generic_plan.
+            Args:
+                query (str): Query string with parameters
+                parameter_sets (list): Samples of parameter values, each a list with a value per parameter
+                collapse (bool): Whether to collapse sibling subtrees of the same shape, see collapse_plan.
+            Returns:
+                dict: The generic plan, the custom plan of each sample and whether the plan cache would
+                switch to the generic plan.
+        """
+        if parameter_sets is None:
+            parameter_sets = []
+        settings = dict(baseline_settings)
+
+        name = self.prepare(query)
+        try:
+            if self.conn.server_version >= GENERIC_PLAN_VERSION:
+                generic_plan = self.execute_query_with_settings("EXPLAIN (FORMAT JSON, GENERIC_PLAN) " + query, settings)
+            else:
+                # The values do not change a generic plan, but EXECUTE needs one per parameter
+                parameters = parameter_sets[0] if parameter_sets else [None] * count_parameters(query)
+                generic_plan = self.execute_prepared(name, parameters,
+                                                     dict(settings, plan_cache_mode="force_generic_plan"))
+
+            custom_plans = [
+                self.execute_prepared(name, parameters, dict(settings, plan_cache_mode="force_custom_plan"))
+                for parameters in parameter_sets
+            ]
+        finally:
+            # Prepared statements last until the end of the session, so they are deallocated explicitly
+            if self.conn.get_transaction_status() == TRANSACTION_STATUS_INERROR:
+                self.conn.rollback()
+            self.cursor.execute(f"DEALLOCATE {name}")
+
+        generic = QueryPlan(collapse_plan(generic_plan) if collapse else generic_plan, {})
+        custom = []
+        for parameters, custom_plan in zip(parameter_sets, custom_plans):
+            comparisons = self.scan_tree(custom_plan, generic_plan, "Generic plan")
+            plan = QueryPlan(collapse_plan(custom_plan) if collapse else custom_plan, comparisons)
+            custom.append({
+                "parameters": parameters,
+                "plan": plan,
+                "total_cost": plan.total_cost,
+                "cost_difference": generic.total_cost - plan.total_cost,
+                "same_shape": plan.shape_hash == generic.shape_hash,
+                "differences": list(comparisons.values()),
+            })
+
+        # With plan_cache_mode set to auto, the plan cache switches to the generic plan once it is estimated
+        # to be no more expensive than the average custom plan
+        average_custom_cost = sum(item["total_cost"] for item in custom) / len(custom) if custom else None
+        generic_chosen = average_custom_cost is not None and generic.total_cost <= average_custom_cost
+        return {
+            "generic": generic,
+            "custom": custom,
+            "average_custom_cost": average_custom_cost,
+            "generic_chosen": generic_chosen,
+            "num_different_shapes": sum(1 for item in custom if not item["same_shape"]),
+        }
+
+    def prepare(self, query: str) -> str:
+        """
+            Prepares a query under a unique name, so that concurrent sessions do not clash
+            Args:
+                query (str): Query string with parameters
+            Returns:
+                str: Name of the prepared statement
+        """
+        name = f"explain_{uuid.uuid4().hex}"
+        self.cursor.execute(f"PREPARE {name} AS {query}")
+        return name
+
+    def execute_prepared(self, name, parameters, settings: dict) -> dict:
+        """
+        Explains the execution of a prepared statement with the given parameters and planner settings
+        Args:
+            name (str): Name of the prepared statement
+            parameters (list): A value per parameter
+            settings (dict): Mapping of planner setting name to its value
+        Returns:
+            dict: results of the EXPLAIN function and what plans were selected
+        """
+        self.change_local_settings(settings)
+        placeholders = ", ".join(["%s"] * len(parameters))
+        self.cursor.execute(f"EXPLAIN (FORMAT JSON, SETTINGS ON) EXECUTE {name} ({placeholders})", list(parameters))
+        plan = self.cursor.fetchone()
+        query_plan_dict: dict = plan[0][0]["Plan"]
+        return query_plan_dict
+
     def execute_query(self, query, seq_cost, rand_cost) -> dict:
         """
         Executes query with different cost plans
@@ -191,51 +1137,86 @@ class QueryProcessor:
         """
         self.change_parameters(seq_cost, rand_cost)
         self.cursor.execute(query)
-        plan = self.cursor.fetchall()
-        query_plan_dict: dict = plan[0][0][0]["Plan"]
+        plan = self.cursor.fetchone()
+        query_plan_dict: dict = plan[0][0]["Plan"]
+        return query_plan_dict
+
+    def execute_query_with_settings(self, query, settings: dict) -> dict:
+        """
+        Executes query with the given planner settings for the current transaction
+        Args:
+            query (str): Query string (with the EXPLAIN statement)
+            settings (dict): Mapping of planner setting name to its value
+        Returns:
+            dict: results of the EXPLAIN function and what plans were selected
+        """
+        self.change_local_settings(settings)
+        self.cursor.execute(query)
+        plan = self.cursor.fetchone()
+        query_plan_dict: dict = plan[0][0]["Plan"]
         return query_plan_dict
 
-    def scan_tree(self, qep: dict, aqp: dict) -> dict:
+    def scan_tree(self, qep: dict, aqp: dict, label: str = "AQP") -> dict:
         """
         Scan the entire tree to find the differences
         Args:
             qep: the best Query Execution Plan
             aqp: a Alternate Query Plan
+            label: name of the alternate plan used in the comparison text
 
         Returns:
             dict: comparisons that were indexed
         """
         comparisons = {}
 
-        # Check if qep and aqp has "plans"
-        qep_plans = qep.get("Plans")
-        aqp_plans = aqp.get("Plans")
-
-        if qep_plans is not None and aqp_plans is not None:
-            # Scan plans
-            for qep_plan, aqp_plan in zip(qep_plans, aqp_plans):
-                result = self.scan_tree(qep_plan, aqp_plan)
-                # Update any results if any
-                if len(result) > 0:
-                    comparisons.update(result)
-
-        # Scan through current plan to check whether there are differences
-        comparison_string, condition = self.compare_query_plan(qep, aqp)
-
-        if comparison_string is not None:
-            hash_value = " "
-            # Use the condition as the hash (key)
-            if len(condition) > 0:
-                if type(condition) is dict:
-                    dict_values = list(condition.values())
-                    hash_value = dict_values[0]
-                elif type(condition) is list:
-                    hash_value = condition[0][0]
-            # Place into dictionary
-            comparisons[hash_value] = comparison_string
+        # Visit the pairs of plans with an explicit stack, comparing the children before their parent
+        stack = [(qep, aqp, False)]
+        while stack:
+            qep_node, aqp_node, children_scanned = stack.pop()
+
+            if not children_scanned:
+                stack.append((qep_node, aqp_node, True))
+
+                # Check if qep and aqp has "plans"
+                qep_plans = qep_node.get("Plans")
+                aqp_plans = aqp_node.get("Plans")
+
+                if qep_plans is not None and aqp_plans is not None:
+                    # Scan plans
+                    for qep_plan, aqp_plan in reversed(list(zip(qep_plans, aqp_plans))):
+                        stack.append((qep_plan, aqp_plan, False))
+                continue
+
+            # Scan through current plan to check whether there are differences
+            comparison_string, condition = self.compare_query_plan(qep_node, aqp_node, label)
+
+            if comparison_string is not None:
+                # Place into dictionary
+                comparisons[self.comparison_key(condition)] = comparison_string
 
         return comparisons
 
+    def comparison_key(self, condition) -> str:
+        """
+        Gets the key a comparison of a node is indexed by, i.e. the value of its condition
+        Args:
+            condition: the condition of the node, as retrieved by retrieve_plans
+        Returns:
+            str: the key of the comparison, " " if the node has no condition
+        """
+        hash_value = " "
+        # Use the condition as the hash (key)
+        if len(condition) > 0:
+            if type(condition) is dict:
+                dict_values = list(condition.values())
+                hash_value = dict_values[0]
+            elif type(condition) is list:
+                hash_value = condition[0][0]
+        # Lists such as sort and group keys are used as tuples, so that they can be hashed
+        if type(hash_value) is list:
+            hash_value = tuple(hash_value)
+        return hash_value
+
     def add_comparisons(self, comparison_dict: dict, comparison: dict) -> dict:
         """
         Adds the comparison dictionary and compares whether to add to a list
@@ -249,7 +1230,7 @@ class QueryProcessor:
             if comparison_dict.get(key) is not None:
                 # Writes the new comparison to the back of the current string
                 cur_comparison = comparison_dict[key]
-                new_comparison = cur_comparison + comparison[key]
+                new_comparison = cur_comparison + " " + comparison[key]
                 comparison_dict[key] = new_comparison
             else:
                 comparison_dict[key] = comparison[key]
@@ -281,15 +1262,15 @@ class QueryProcessor:
 
         return SimplifiedPlan(node, value, cost)
 
-    def compare_query_plan(self, qep: dict, aqp: dict):
+    def compare_query_plan(self, qep: dict, aqp: dict, label: str = "AQP"):
         # Retrieve the current plan and place into a class
         qep_simple = self.retrieve_plans(qep)
         aqp_simple = self.retrieve_plans(aqp)
 
         # Compare the results and check whether they are the same
-        return self.compare_item(qep_simple, aqp_simple), qep_simple.condition
+        return self.compare_item(qep_simple, aqp_simple, label), qep_simple.condition
 
-    def compare_item(self, qep_item: SimplifiedPlan, aqp_item: SimplifiedPlan):
+    def compare_item(self, qep_item: SimplifiedPlan, aqp_item: SimplifiedPlan, label: str = "AQP"):
         # Check whether it is of the same type (Scan / Join)
         if qep_item.compare_node(aqp_item):
             # If cost is the same, skip and ignore
@@ -309,13 +1290,158 @@ class QueryProcessor:
                 # Check that the Node Type are the same
                 if qep_item.compare_type(aqp_item):
                     if len(aqp_values) > 0:
-                        return f"AQP chooses to do {aqp_item.node} on {aqp_values[0]} that increases cost by {diff}."
+                        return f"{label} chooses to do {aqp_item.node} on {aqp_values[0]} that increases cost by {diff}."
                     if len(qep_values) > 0:
-                        return f"AQP chooses to do {aqp_item.node} on {qep_values[0]} that increases cost by {diff}."
+                        return f"{label} chooses to do {aqp_item.node} on {qep_values[0]} that increases cost by {diff}."
 
         return None
 
 
+class QueryProcessorPool:
+    def __init__(self, db_config, max_size=DEFAULT_POOL_SIZE):
+        """
+            Pool of query processors connected to the same database, each with its own connection.
+            Connections are only opened when no idle processor is available, up to max_size.
+            Processors are only handed out once the admission controller admits the operation,
+            so that the load on the database stays under its adaptive limit.
+            Args:
+                db_config (Config): Connection settings of the database
+                max_size (int): Maximum number of connections
+        """
+        self.db_config = db_config
+        self.max_size = max_size
+        self.size = 0
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.admission = AdmissionController(max_size)
+
+    @contextmanager
+    def acquire(self, priority=PLAN_PRIORITY):
+        """
+            Borrows a query processor for the duration of a with block.
+            Waits for the operation to be admitted and for a processor to be returned when all connections are in use.
+            Args:
+                priority (int): PLAN_PRIORITY for operations that only plan queries, EXECUTE_PRIORITY for
+                operations that execute them, which wait behind the former
+            Returns:
+                QueryProcessor: A processor that is not used by any other thread
+            Raises:
+                Busy: The operation waited for longer than the admission deadline
+        """
+        with self.admission.admit(priority) as admission:
+            processor = self.checkout()
+            start_time, start_count = processor.statement_time()
+            try:
+                yield processor
+            finally:
+                # The latency of the database is that of the statements of the operation, as the time the
+                # processor is held for also depends on the number of statements and the work done between them
+                end_time, end_count = processor.statement_time()
+                if end_count > start_count:
+                    admission.latency = (end_time - start_time) / (end_count - start_count)
+                self.release(processor)
+
+    def checkout(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            can_connect = self.size < self.max_size
+            if can_connect:
+                self.size += 1
+
+        if not can_connect:
+            return self.idle.get()
+
+        try:
+            return self.create_processor()
+        except Exception:
+            with self.lock:
+                self.size -= 1
+            raise
+
+    def create_processor(self):
+        return QueryProcessor(self.db_config)
+
+    def release(self, processor):
+        # Drop processors whose connection was closed, so that a new connection replaces them
+        if processor.connection is not None and processor.connection.closed:
+            with self.lock:
+                self.size -= 1
+            return
+        self.idle.put(processor)
+
+    def close(self):
+        while True:
+            try:
+                processor = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            processor.stop_db_connection()
+            with self.lock:
+                self.size -= 1
+
+
+"""
+Explains a query against several targets concurrently, each on a connection from its own pool.
+Args:
+    query (string): Query string that was entered by the user.
+    targets (list): Names of the targets in target_pools.
+Returns:
+    dict: Mapping of target name to the QueryPlan of the query on that target.
+"""
+
+
+def explain_targets(query, targets):
+    def explain_target(target):
+        with target_pools[target].acquire() as processor:
+            return processor.explain(query)
+
+    with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+        plans = executor.map(explain_target, targets)
+        return dict(zip(targets, plans))
+
+
+"""
+Compares the plans of a query across targets against the plan of the first target.
+Args:
+    plans (dict): Mapping of target name to QueryPlan, as returned by explain_targets.
+Returns:
+    list: a dict per target with its cost, the difference in cost from the first target,
+    whether the plan has the same shape and the differences in its plan.
+"""
+
+
+def compare_targets(plans):
+    targets = list(plans.keys())
+    baseline = plans[targets[0]]
+
+    comparison = []
+    for target in targets:
+        plan = plans[target]
+        if plan is None:
+            comparison.append({"target": target, "error": True})
+            continue
+
+        total_cost = plan.query_plan["Total Cost"]
+        differences = {}
+        if target != targets[0] and baseline is not None:
+            differences = query_processor.scan_tree(baseline.query_plan, plan.query_plan, target)
+
+        comparison.append({
+            "target": target,
+            "error": False,
+            "total_cost": total_cost,
+            "cost_difference": total_cost - baseline.query_plan["Total Cost"] if baseline is not None else None,
+            "same_shape": baseline is not None and plan.shape_hash == baseline.shape_hash,
+            "node_type_counts": plan.node_type_counts,
+            "differences": list(differences.values()),
+        })
+    return comparison
+
+
 def __main__():
     plan1 = query_processor.explain(
         "SELECT l_orderkey, sum(l_extendedprice * (1 - l_discount)) as revenue, o_orderdate, o_shippriority " +
@@ -324,11 +1450,16 @@ def __main__():
         "GROUP BY l_orderkey, o_orderdate, o_shippriority " +
         "ORDER BY revenue desc, o_orderdate LIMIT 20")
 
-    print(plan1.explanation)
+    print([render_text(item) for item in plan1.explanation])
 
     return
 
 
-query_config = Config()
+baseline_settings = load_calibration(os.environ.get("CALIBRATION_FILE", os.path.join(os.getcwd(), "calibration.json")))
+target_configs = load_target_configs()
+query_config = target_configs[DEFAULT_TARGET]
 query_processor = QueryProcessor(query_config)
-__main__()
+target_pools = {name: QueryProcessorPool(config) for name, config in target_configs.items()}
+
+if __name__ == "__main__":
+    __main__()
@@ -0,0 +1,137 @@
+import cProfile
+import io
+import os
+import pstats
+import re
+import threading
+import time
+import uuid
+from functools import wraps
+
+from flask import abort, current_app, request, send_from_directory
+
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN")
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(os.getcwd(), "profiles"))
+PROFILE_RATE = 6
+PROFILE_PERIOD = 60
+PROFILE_LIMIT = 50
+PROFILE_HEADER = "X-Profile"
+PROFILE_PARAMETER = "profile"
+
+PROFILE_ID = re.compile(r"^[0-9a-f]{32}$")
+
+
+class RateLimiter:
+    def __init__(self, rate=PROFILE_RATE, period=PROFILE_PERIOD):
+        """Token bucket allowing rate events per period seconds, with bursts of up to rate events.
+
+        Args:
+            rate (int, optional): Number of events allowed per period. Defaults to PROFILE_RATE.
+            period (int, optional): Length of the period in seconds. Defaults to PROFILE_PERIOD.
+        """
+        self.rate = rate
+        self.period = period
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.period)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class Profiler:
+    def __init__(self, token=PROFILE_TOKEN, profile_dir=PROFILE_DIR, limiter=None, limit=PROFILE_LIMIT):
+        """Profiles the requests that ask for it with cProfile and saves each profile as a pstats file
+        named after the id of the request. Profiling is off unless a token is configured, and a request
+        is only profiled when it carries that token in the X-Profile header or the profile parameter.
+
+        Args:
+            token (str, optional): Token that requests must carry to be profiled. Defaults to PROFILE_TOKEN.
+            profile_dir (str, optional): Directory the profiles are saved in. Defaults to PROFILE_DIR.
+            limiter (RateLimiter, optional): Limit on the number of profiled requests. Defaults to PROFILE_RATE
+            per PROFILE_PERIOD.
+            limit (int, optional): Number of profiles kept, the oldest being deleted. Defaults to PROFILE_LIMIT.
+        """
+        self.token = token
+        self.profile_dir = profile_dir
+        self.limiter = limiter or RateLimiter()
+        self.limit = limit
+        # cProfile cannot profile two threads at once, so only one request is profiled at a time
+        self.running = threading.Lock()
+
+    def requested(self) -> bool:
+        return self.token in (request.headers.get(PROFILE_HEADER), request.args.get(PROFILE_PARAMETER))
+
+    def profiled(self, view):
+        """Decorator profiling a view for the requests that ask for it.
+        The id of the profile is returned in the X-Profile-Id header of the response.
+        Requests over the rate limit, or made while another request is profiled, are served without profiling.
+        Without a token the view is returned as is, so that profiling costs nothing when it is off.
+        """
+        if not self.token:
+            return view
+
+        @wraps(view)
+        def inner_func(*args, **kwargs):
+            if not self.requested() or not self.limiter.allow():
+                return view(*args, **kwargs)
+            if not self.running.acquire(blocking=False):
+                return view(*args, **kwargs)
+
+            profile_id = uuid.uuid4().hex
+            profile = cProfile.Profile()
+            try:
+                response = profile.runcall(view, *args, **kwargs)
+            finally:
+                self.running.release()
+                self.save(profile_id, profile)
+
+            # Views may return strings, so the response is built by Flask before adding the header
+            response = current_app.make_response(response)
+            response.headers["X-Profile-Id"] = profile_id
+            return response
+
+        return inner_func
+
+    def save(self, profile_id, profile):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        profile.dump_stats(os.path.join(self.profile_dir, f"{profile_id}.pstats"))
+
+        profiles = sorted(
+            (entry for entry in os.scandir(self.profile_dir) if entry.name.endswith(".pstats")),
+            key=lambda entry: entry.stat().st_mtime,
+        )
+        for entry in profiles[:-self.limit]:
+            os.remove(entry.path)
+
+    def download(self, profile_id):
+        """Serves a saved profile, as the pstats file or as text sorted by cumulative time with format=text.
+
+        Args:
+            profile_id (str): Id of the profile from the X-Profile-Id header.
+
+        Returns:
+            Response: The profile.
+        """
+        if not self.token or not self.requested() or not PROFILE_ID.match(profile_id):
+            abort(404)
+        file_name = f"{profile_id}.pstats"
+        if not os.path.exists(os.path.join(self.profile_dir, file_name)):
+            abort(404)
+
+        if request.args.get("format") == "text":
+            output = io.StringIO()
+            stats = pstats.Stats(os.path.join(self.profile_dir, file_name), stream=output)
+            stats.sort_stats("cumulative").print_stats(50)
+            return output.getvalue(), 200, {"Content-Type": "text/plain"}
+        return send_from_directory(self.profile_dir, file_name, as_attachment=True)
+
+
+profiler = Profiler()
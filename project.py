@@ -1,53 +1,537 @@
+import json
 import os
+import time
+from contextlib import contextmanager
 
-from flask import Flask, redirect, render_template, request, url_for
+from flask import Flask, Response, abort, jsonify, make_response, redirect, render_template, request, \
+    stream_with_context, url_for
 
 from preprocessing import *
 from annotation import *
+from concurrency import Busy, SingleFlight
+from history import plan_history
+from profiling import profiler
+from rewrites import compare_rewrites
+from sharedcache import SHARED_CACHE_TTL, SharedCache
 
 app = Flask(__name__)
+app.add_template_filter(format_kilobytes, "kilobytes")
+app.add_template_filter(render_html, "annotation")
 cwd = os.getcwd()
+explain_flights = SingleFlight()
+shared_cache = SharedCache()
+
+
+class StageTimer:
+    def __init__(self):
+        """Times the stages of handling a request, to report them in the Server-Timing header."""
+        self.durations = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[name] = self.durations.get(name, 0.0) + time.perf_counter() - start
+
+    def respond(self, body):
+        """Creates the response with the duration of each stage in milliseconds in its Server-Timing header.
+
+        Args:
+            body (str): The rendered page.
+
+        Returns:
+            Response: The response to return from the endpoint.
+        """
+        response = make_response(body)
+        response.headers["Server-Timing"] = ", ".join(
+            f"{name};dur={duration * 1000:.2f}" for name, duration in self.durations.items()
+        )
+        return response
+
 # GET endpoint for '/'
 @app.route("/", methods=["GET"])
 def home():
-    return render_template("index.html")
+    return render_template("index.html", targets=list(target_pools.keys()))
 
 
 # GET and POST endpoint for '/result'
 @app.route("/result", methods=["POST", "GET"])
+@profiler.profiled
 def explain():
     if request.method == "GET":
         return redirect("/")
 
     query = request.form["queryText"]
-    output = validate(query)
+    options = {
+        "parameter_sets": request.form.get("parameterSets", ""),
+        # Sibling subtrees of the same shape are collapsed unless the plan is expanded
+        "collapse": not request.form.get("expandPlan"),
+        "parallel_sweep": bool(request.form.get("parallelSweep")),
+        "work_mem_sweep": bool(request.form.get("workMemSweep")),
+        "work_mem_analyze": bool(request.form.get("workMemAnalyze")),
+        # Explain against every selected target when more than one is selected
+        "targets": tuple(target for target in request.form.getlist("targets") if target in target_pools),
+    }
 
-    if output["error"]:
-        error = "Query is invalid."
+    # Identical requests made while the query is being explained wait for that explanation instead.
+    # They are keyed by the query itself rather than its fingerprint, as literals change the plan.
+    timer = StageTimer()
+    start = time.perf_counter()
+    html_context, shared = explain_flights.do((query, tuple(options.items())),
+                                              lambda: cached_explain_context(query, options, timer))
+    if shared:
+        timer.durations["coalesced"] = time.perf_counter() - start
 
-        if output["error_message"]:
-            error = output["error_message"]
+    with timer.stage("render"):
+        page = render_template("index.html", **html_context)
+    return timer.respond(page)
+
+
+def cached_explain_context(query, options, timer) -> dict:
+    """Gets the context of the result page from the cache shared by the worker processes,
+    or makes it with explain_context and caches it as JSON. The page itself is rendered by each request.
+
+    Args:
+        query (str): Query string that was entered by the user.
+        options (dict): Options of explain_context.
+        timer (StageTimer): Timer of the stages of the request.
+
+    Returns:
+        dict: Context of the result page.
+    """
+    key = "result:" + json.dumps([query, options], sort_keys=True)
+    with timer.stage("shared_cache"):
+        html_context = shared_cache.get_object(key)
+        # The graph is cached on its own and may have been evicted first, the page is then made again
+        if html_context is not None and html_context.get("graph_key") \
+                and not shared_cache.contains(html_context["graph_key"]):
+            html_context = None
+    if html_context is None:
+        html_context = explain_context(query, options, timer)
+        # Invalid queries are not cached, they may be valid once the schema changes
+        if "explanation" in html_context:
+            with timer.stage("shared_cache"):
+                shared_cache.put_object(key, html_context)
+    return html_context
+
+
+def graph_url(plan) -> tuple:
+    """Renders the graph of a plan into the cache shared by the worker processes, unless one of them already did.
+    Graphs too large for the cache are saved in the 'static' folder instead.
+
+    Args:
+        plan (QueryPlan): The QEP.
+
+    Returns:
+        tuple: URL of the graph, and its key in the cache or None if it was saved in the 'static' folder.
+    """
+    plan_hash = plan.calculate_plan_hash()
+    key = "graph:" + plan_hash
+    if not shared_cache.contains(key):
+        image = plan.render_graph_bytes()
+        if not shared_cache.put(key, image):
+            return url_for("static", filename=plan.save_graph_file(cwd, image)), None
+    return url_for("graph", plan_hash=plan_hash), key
+
+
+def hot_operator_rows(plan) -> list:
+    """Gets the figures of the hot operators of a plan, without the nodes themselves,
+    so that the context of the result page stays small when it is cached.
+
+    Args:
+        plan (QueryPlan): The QEP.
+
+    Returns:
+        list: A dict per hot operator, most expensive first.
+    """
+    return [
+        {"node_type": node.node_type, "relation_name": getattr(node, "relation_name", ""),
+         "count": node.count, "exclusive_cost": node.exclusive_cost,
+         "startup_cost": node.startup_cost, "run_cost": node.run_cost,
+         "cost_share": node.cost_share}
+        for node in plan.hot_operators
+    ]
+
+
+def regression_summary(regression) -> dict:
+    """Gets a plan regression without the plans it compares, which can be serialised to JSON.
 
-        html_context = {
-            "query": error,
-            "explanation_1": [error],
-        }
+    Args:
+        regression (PlanRegression): The regression.
+
+    Returns:
+        dict: The regression, with the time, cost, shape and node types of the plans before and after it.
+    """
+    return {
+        "fingerprint": regression.fingerprint,
+        "query": regression.query,
+        "before": {"timestamp": regression.before.timestamp, "total_cost": regression.before.total_cost,
+                   "shape_hash": regression.before.shape_hash,
+                   "node_type_counts": regression.before.node_type_counts},
+        "after": {"timestamp": regression.after.timestamp, "total_cost": regression.after.total_cost,
+                  "shape_hash": regression.after.shape_hash,
+                  "node_type_counts": regression.after.node_type_counts},
+        "cost_increase": regression.cost_increase,
+        "diff": regression.diff,
+    }
 
-        return render_template("index.html", **html_context)
 
-    plan = query_processor.explain(output["query"])
+def plan_context(plan) -> dict:
+    """Gets the figures of a plan shown under Query Info.
 
-    html_context = {
-        "query": query,
-        "graph": plan.save_graph_file(cwd),
-        "explanation": plan.explanation,
+    Args:
+        plan (QueryPlan): The QEP.
+
+    Returns:
+        dict: Context of the result page.
+    """
+    return {
         "total_cost": int(plan.total_cost),
         "total_plan_rows": int(plan.plan_rows),
         "total_seq_scan": int(plan.num_seq_scan_nodes),
         "total_index_scan": int(plan.num_index_scan_nodes),
+        "total_parallel_nodes": int(plan.num_parallel_nodes),
+        "total_workers_planned": int(plan.workers_planned),
     }
 
-    return render_template("index.html", **html_context)
+
+def error_context(error) -> dict:
+    """Gets the context of the result page for a query that could not be explained.
+
+    Args:
+        error (str): The error to show.
+
+    Returns:
+        dict: Context of the result page.
+    """
+    return {
+        "query": error,
+        "explanation_1": [error],
+        "targets": list(target_pools.keys()),
+    }
+
+
+def explain_context(query, options, timer) -> dict:
+    """Validates, explains and annotates a query, records its plan and renders its graph.
+
+    Args:
+        query (str): Query string that was entered by the user.
+        options (dict): The parameter sets, whether to collapse the plan, whether to sweep parallel workers
+        and the targets to compare, from the form.
+        timer (StageTimer): Timer of the stages of the request.
+
+    Returns:
+        dict: Context of the result page.
+    """
+    # Validation executes the query, except for parameterized queries which are only prepared
+    priority = PLAN_PRIORITY if count_parameters(query) else EXECUTE_PRIORITY
+    with timer.stage("validate"), target_pools[DEFAULT_TARGET].acquire(priority) as processor:
+        output = validate(query, processor)
+
+    # Parameterized queries are explained with their generic plan and a custom plan per sample of parameters
+    parameters = None
+    num_parameters = count_parameters(query)
+    if not output["error"] and num_parameters:
+        parameters = parse_parameter_sets(options["parameter_sets"], num_parameters)
+        output.update(error=parameters["error"], error_message=parameters["error_message"])
+
+    if output["error"]:
+        error = "Query is invalid."
+
+        if output["error_message"]:
+            error = output["error_message"]
+
+        return error_context(error)
+
+    collapse = options["collapse"]
+    regression = None
+    with target_pools[DEFAULT_TARGET].acquire() as processor:
+        with timer.stage("explain"):
+            if parameters is not None:
+                parameterized = processor.explain_parameterized(output["query"], parameters["parameter_sets"],
+                                                                collapse=collapse)
+                plan = parameterized["generic"] if parameterized is not None else None
+            else:
+                plan = processor.explain(output["query"], collapse=collapse)
+
+        # The database may still reject the query when it is explained, e.g. with a sample of the wrong type
+        if plan is None:
+            if parameters is not None:
+                return error_context("Query could not be explained with these parameters.")
+            return error_context("Query could not be explained.")
+
+        # Expanded plans have a different shape from the collapsed plans in the history, so they are not recorded
+        if collapse:
+            with timer.stage("history"):
+                regression = plan_history.record(fingerprint_query(output["query"]), output["query"], plan,
+                                                 lambda before, after: processor.scan_tree(before, after, "New plan"))
+
+        if options["parallel_sweep"] and parameters is None:
+            with timer.stage("parallel_sweep"):
+                parallel_sweep = processor.parallel_sweep(output["query"])
+
+    if options["work_mem_sweep"] and parameters is None:
+        # An analyzed sweep executes the query, so it is admitted after the operations that only plan queries
+        analyze = options["work_mem_analyze"] and is_read_only(output["query"])
+        priority = EXECUTE_PRIORITY if analyze else PLAN_PRIORITY
+        with timer.stage("work_mem_sweep"), target_pools[DEFAULT_TARGET].acquire(priority) as processor:
+            work_mem_sweep = processor.work_mem_sweep(output["query"], analyze=analyze)
+        if work_mem_sweep is not None:
+            annotate_work_mem(plan, work_mem_sweep)
+
+    with timer.stage("graph"):
+        graph, graph_key = graph_url(plan)
+
+    html_context = dict(
+        plan_context(plan),
+        query=query,
+        graph=graph,
+        graph_key=graph_key,
+        explanation=plan.explanation,
+        hot_operators=hot_operator_rows(plan),
+        targets=list(target_pools.keys()),
+    )
+
+    if regression is not None:
+        html_context["regression"] = regression_summary(regression)
+
+    if options["parallel_sweep"] and parameters is None:
+        html_context["parallel_sweep"] = parallel_sweep
+
+    if options["work_mem_sweep"] and parameters is None:
+        html_context["work_mem_sweep"] = work_mem_sweep
+
+    if parameters is not None:
+        # The plans themselves are left out, the page only shows their costs
+        html_context["parameterized"] = dict(
+            parameterized,
+            generic={"total_cost": parameterized["generic"].total_cost},
+            custom=[{key: value for key, value in row.items() if key != "plan"} for row in parameterized["custom"]],
+        )
+
+    targets = list(options["targets"])
+    if len(targets) > 1 and parameters is None:
+        with timer.stage("targets"):
+            html_context["target_comparison"] = compare_targets(explain_targets(output["query"], targets))
+
+    return html_context
+
+
+def sse_event(event, data) -> str:
+    """
+        Formats a Server-Sent Event with JSON data
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream_events(query, collapse):
+    """Explains a query like explain_context, yielding each result as a Server-Sent Event as soon as it is
+    available: the QEP with its annotations after the first EXPLAIN, the comparisons of each AQP, the
+    annotations with every comparison, then the graph. Any error ends the stream with a "failed" event.
+
+    Args:
+        query (str): Query string that was entered by the user.
+        collapse (bool): Whether to collapse sibling subtrees of the same shape.
+
+    Yields:
+        str: The events.
+    """
+    try:
+        if count_parameters(query):
+            yield sse_event("failed", {"message": "Submit parameterized queries to explain them with their parameters."})
+            return
+
+        if not query.strip():
+            yield sse_event("failed", {"message": "Query is empty."})
+            return
+
+        # The query is not validated by executing it first, which would delay the first event by a whole
+        # execution: the first EXPLAIN rejects invalid queries just as well
+        with target_pools[DEFAULT_TARGET].acquire() as processor:
+            for stage, result in processor.explain_progressively(query, collapse):
+                if stage == "qep":
+                    yield sse_event("qep", dict(
+                        plan_context(result),
+                        explanation=[annotation_tokens(item) for item in result.explanation],
+                        hot_operators=hot_operator_rows(result),
+                    ))
+                elif stage == "comparison":
+                    if result:
+                        yield sse_event("comparison", {"comparisons": [str(value) for value in result.values()]})
+                else:
+                    plan = result
+                    yield sse_event("explanation",
+                                    {"explanation": [annotation_tokens(item) for item in plan.explanation]})
+
+            if collapse:
+                regression = plan_history.record(fingerprint_query(query), query, plan,
+                                                 lambda before, after: processor.scan_tree(before, after, "New plan"))
+                if regression is not None:
+                    yield sse_event("regression", {"before": regression.before.total_cost,
+                                                   "after": regression.after.total_cost,
+                                                   "cost_increase": regression.cost_increase,
+                                                   "diff": regression.diff})
+
+        yield sse_event("graph", {"url": graph_url(plan)[0]})
+        yield sse_event("done", {})
+    except Busy as error:
+        yield sse_event("failed", {"message": str(error)})
+    except Exception as error:
+        # The client waits for "done" or "failed", so the stream never ends without either
+        print(f"Exception encountered while streaming: {error}")
+        yield sse_event("failed", {"message": "Query could not be explained."})
+
+
+# GET endpoint for '/stream'
+@app.route("/stream", methods=["GET"])
+def stream():
+    query = request.args.get("queryText", "")
+    collapse = not request.args.get("expandPlan")
+    return Response(stream_with_context(stream_events(query, collapse)), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def explain_document(query, collapse) -> dict:
+    """Validates and explains a query into the structured output of its QEP,
+    without AQP comparisons across targets, sweeps or plan history.
+
+    Args:
+        query (str): Query string that was entered by the user.
+        collapse (bool): Whether to collapse sibling subtrees of the same shape.
+
+    Returns:
+        dict: The structured output from QueryPlan.to_columns, or the error if the query could not be explained.
+    """
+    if count_parameters(query):
+        return {"error": "Submit parameterized queries to explain them with their parameters."}
+
+    with target_pools[DEFAULT_TARGET].acquire(EXECUTE_PRIORITY) as processor:
+        output = validate(query, processor)
+    if output["error"]:
+        return {"error": output["error_message"] or "Query is invalid."}
+
+    with target_pools[DEFAULT_TARGET].acquire() as processor:
+        plan = processor.explain(output["query"], collapse=collapse)
+    if plan is None:
+        return {"error": "Query could not be explained."}
+    return plan.to_columns()
+
+
+def select_document(document, fields, annotations) -> dict:
+    """Keeps the requested columns of the structured output of a QEP, and renders its annotations if requested.
+
+    Args:
+        document (dict): Structured output from QueryPlan.to_columns.
+        fields (list): Columns to keep along with the parent column, or None for every column.
+        annotations (str): "tokens" to keep the annotation tokens, "html" or "text" to render them.
+
+    Returns:
+        dict: The selected structured output.
+    """
+    nodes = document["nodes"]
+    selected = {"parent": nodes["parent"]}
+    selected.update((field, nodes[field]) for field in fields or nodes if field in nodes)
+    if "annotation" in selected and annotations != "tokens":
+        render = render_html if annotations == "html" else render_text
+        selected["annotation"] = [str(render(document_annotation(document, node_id)))
+                                  for node_id in range(len(nodes["parent"]))]
+    return dict(document, nodes=selected)
+
+
+# GET and POST endpoint for '/api/explain'
+@app.route("/api/explain", methods=["GET", "POST"])
+def api_explain():
+    query = request.values.get("queryText", "")
+    collapse = not request.values.get("expandPlan")
+    fields = request.values.get("fields")
+    annotations = request.values.get("annotations", "tokens")
+    if annotations not in ("tokens", "html", "text"):
+        return jsonify({"error": "annotations must be tokens, html or text."}), 400
+
+    key = "document:" + json.dumps([query, collapse])
+    encoded = shared_cache.get(key)
+    if encoded is None:
+        try:
+            document, _ = explain_flights.do(("document", query, collapse), lambda: explain_document(query, collapse))
+        except Busy as error:
+            # Clients of the API get JSON rather than the page of the busy error handler
+            return jsonify({"error": str(error)}), 503, {"Retry-After": str(error.retry_after)}
+        if "error" in document:
+            return jsonify(document), 400
+        encoded = json.dumps(document, separators=(",", ":")).encode("utf-8")
+        shared_cache.put(key, encoded)
+
+    # The whole structured output is sent as it was cached, without decoding it
+    if not fields and annotations == "tokens":
+        return Response(encoded, mimetype="application/json")
+    return jsonify(select_document(json.loads(encoded), fields.split(",") if fields else None, annotations))
+
+
+# Response for requests shed by admission control
+@app.errorhandler(Busy)
+def busy(error):
+    page = render_template("index.html", query=str(error), explanation_1=[str(error)],
+                           targets=list(target_pools.keys()))
+    return page, 503, {"Retry-After": str(error.retry_after)}
+
+
+# GET and POST endpoint for '/rewrites'
+@app.route("/rewrites", methods=["POST", "GET"])
+def rewrites():
+    if request.method == "GET":
+        return render_template("rewrites.html", queries=["", ""])
+
+    queries = [query for query in request.form.getlist("queryText") if query.strip()]
+    if len(queries) < 2:
+        return render_template("rewrites.html", queries=queries + [""] * (2 - len(queries)),
+                               error="Enter the query and at least one rewrite.")
+
+    return render_template("rewrites.html", queries=queries, result=compare_rewrites(queries))
+
+
+# GET endpoint for '/regressions'
+@app.route("/regressions", methods=["GET"])
+def regressions():
+    return render_template("regressions.html", regressions=plan_history.regressions())
+
+
+# GET endpoint for '/regressions.json'
+@app.route("/regressions.json", methods=["GET"])
+def regressions_json():
+    return jsonify([regression_summary(regression) for regression in plan_history.regressions()])
+
+
+# GET endpoint for '/profiles/<profile_id>'
+@app.route("/profiles/<profile_id>", methods=["GET"])
+def profile(profile_id):
+    return profiler.download(profile_id)
+
+
+# GET endpoint for '/graphs/<plan_hash>.png'
+@app.route("/graphs/<plan_hash>.png", methods=["GET"])
+def graph(plan_hash):
+    image = shared_cache.get("graph:" + plan_hash)
+    if image is None:
+        abort(404)
+    response = make_response(image)
+    response.headers["Content-Type"] = "image/png"
+    # The graph of a plan hash never changes, only the plan cached for a query does
+    response.headers["Cache-Control"] = f"public, max-age={SHARED_CACHE_TTL}"
+    return response
+
+
+# GET endpoint for '/cache.json'
+@app.route("/cache.json", methods=["GET"])
+def cache():
+    return jsonify(shared_cache.stats())
+
+
+# GET endpoint for '/admission.json'
+@app.route("/admission.json", methods=["GET"])
+def admission():
+    return jsonify({name: pool.admission.stats() for name, pool in target_pools.items()})
 
 
 if __name__ == "__main__":
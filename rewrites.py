@@ -0,0 +1,176 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import networkx as nx
+
+from preprocessing import *
+
+REWRITE_CACHE_SIZE = 128
+REWRITE_CACHE_TTL = 300
+
+
+class RewriteCache:
+    def __init__(self, max_size=REWRITE_CACHE_SIZE, ttl=REWRITE_CACHE_TTL):
+        """Least recently used cache of the comparisons between a query and one of its rewrites,
+        keyed by the pair of query fingerprints.
+        A cached comparison is only reused for the exact same pair of queries, within ttl seconds.
+
+        Args:
+            max_size (int, optional): Number of comparisons kept. Defaults to REWRITE_CACHE_SIZE.
+            ttl (int, optional): Seconds a comparison stays valid. Defaults to REWRITE_CACHE_TTL.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, baseline_query, rewrite_query) -> dict:
+        key = (fingerprint_query(baseline_query), fingerprint_query(rewrite_query))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry["queries"] != (baseline_query, rewrite_query) or time.time() - entry["created"] > self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry["comparison"]
+
+    def put(self, baseline_query, rewrite_query, comparison):
+        key = (fingerprint_query(baseline_query), fingerprint_query(rewrite_query))
+        with self.lock:
+            self.entries[key] = {"queries": (baseline_query, rewrite_query), "created": time.time(),
+                                 "comparison": comparison}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+def alignment_keys(plan: QueryPlan) -> dict:
+    """Gives each node of a plan a key that matches the equivalent node in the plan of an unrelated query,
+    as given by plan_alignment_keys.
+
+    Returns:
+        dict: Mapping of node to its key, in pre-order.
+    """
+    keys = {id(node): key for node, key in plan_alignment_keys(plan.query_plan)}
+    return {node: keys[id(node.query_plan)] for node in nx.dfs_preorder_nodes(plan.graph, plan.root)}
+
+
+def compare_rewrite(baseline: QueryPlan, rewrite: QueryPlan, label: str) -> dict:
+    """Aligns the plan of a rewrite with the plan of the baseline query, and compares each pair of
+    operators with the SimplifiedPlan comparison used for AQPs.
+
+    Args:
+        baseline (QueryPlan): Plan of the baseline query.
+        rewrite (QueryPlan): Plan of the rewrite.
+        label (str): Name of the rewrite used in the comparison text.
+
+    Returns:
+        dict: The total costs, their difference and a row per operator with its exclusive cost in each plan.
+    """
+    baseline_keys = alignment_keys(baseline)
+    rewrite_keys = alignment_keys(rewrite)
+
+    unmatched = {}
+    for node, key in rewrite_keys.items():
+        unmatched.setdefault(key, deque()).append(node)
+
+    pairs = []
+    for node, key in baseline_keys.items():
+        candidates = unmatched.get(key)
+        pairs.append((node, candidates.popleft() if candidates else None))
+    for candidates in unmatched.values():
+        pairs += [(None, node) for node in candidates]
+
+    operators = []
+    for baseline_node, rewrite_node in pairs:
+        node = baseline_node or rewrite_node
+        keys = baseline_keys if baseline_node is not None else rewrite_keys
+        baseline_cost = baseline_node.exclusive_cost if baseline_node is not None else 0.0
+        rewrite_cost = rewrite_node.exclusive_cost if rewrite_node is not None else 0.0
+
+        comparison = None
+        if baseline_node is not None and rewrite_node is not None:
+            baseline_item = query_processor.retrieve_plans(baseline_node.query_plan)
+            rewrite_item = query_processor.retrieve_plans(rewrite_node.query_plan)
+            comparison = query_processor.compare_item(baseline_item, rewrite_item, label) \
+                or query_processor.compare_item(rewrite_item, baseline_item, "Baseline")
+
+        operators.append({
+            "baseline_operator": baseline_node.node_type if baseline_node is not None else None,
+            "rewrite_operator": rewrite_node.node_type if rewrite_node is not None else None,
+            "relations": sorted(keys[node][1]),
+            "baseline_cost": baseline_cost,
+            "rewrite_cost": rewrite_cost,
+            "cost_difference": rewrite_cost - baseline_cost,
+            "comparison": comparison,
+        })
+
+    return {
+        "baseline_cost": baseline.total_cost,
+        "rewrite_cost": rewrite.total_cost,
+        "cost_difference": rewrite.total_cost - baseline.total_cost,
+        "operators": operators,
+    }
+
+
+"""
+Explains a query and its rewrites concurrently and compares each rewrite against the first query.
+Comparisons are cached per pair of fingerprints, so the queries of cached pairs are not explained again.
+Args:
+    queries (list): The query followed by its rewrites.
+    target (string): Name of the target in target_pools to explain against.
+Returns:
+    dict: The total cost of each query, the comparison of each rewrite and the index of the cheapest query.
+"""
+
+
+def compare_rewrites(queries, target=DEFAULT_TARGET):
+    comparisons = [None] + [rewrite_cache.get(queries[0], query) for query in queries[1:]]
+    needed = [index for index in range(1, len(queries)) if comparisons[index] is None]
+    if needed:
+        needed = [0] + needed
+
+    def explain_query(index):
+        with target_pools[target].acquire(EXECUTE_PRIORITY) as processor:
+            if validate(queries[index], processor)["error"]:
+                return None
+            return processor.explain_qep(queries[index])
+
+    plans = {}
+    if needed:
+        with ThreadPoolExecutor(max_workers=len(needed)) as executor:
+            plans = dict(zip(needed, executor.map(explain_query, needed)))
+
+    results = [{"query": query, "error": False} for query in queries]
+    for index in needed[1:]:
+        if plans[0] is None or plans[index] is None:
+            continue
+        comparisons[index] = compare_rewrite(plans[0], plans[index], f"Rewrite {index}")
+        rewrite_cache.put(queries[0], queries[index], comparisons[index])
+
+    # The cost of the baseline comes from its plan, or from any cached comparison when it was not explained
+    if plans.get(0) is not None:
+        results[0]["total_cost"] = plans[0].total_cost
+    else:
+        cached = [comparison for comparison in comparisons[1:] if comparison is not None]
+        results[0]["error"] = len(cached) == 0
+        if cached:
+            results[0]["total_cost"] = cached[0]["baseline_cost"]
+
+    for index in range(1, len(queries)):
+        if comparisons[index] is None:
+            results[index]["error"] = True
+        else:
+            results[index]["total_cost"] = comparisons[index]["rewrite_cost"]
+            results[index]["comparison"] = comparisons[index]
+
+    valid = [index for index in range(len(queries)) if not results[index]["error"]]
+    winner = min(valid, key=lambda index: results[index]["total_cost"]) if valid else None
+    return {"queries": results, "winner": winner}
+
+
+rewrite_cache = RewriteCache()
@@ -0,0 +1,284 @@
+import hashlib
+import json
+import mmap
+import os
+import stat
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Without fcntl (Windows) there is no prefork server to share the cache with, the thread lock is enough
+    fcntl = None
+
+# The default file is in a directory of the temporary folder that only the user running the app can enter
+SHARED_CACHE_DIR = os.path.join(tempfile.gettempdir(), f"qep_shared_cache-{os.getuid() if hasattr(os, 'getuid') else 0}")
+SHARED_CACHE_FILE = os.environ.get("SHARED_CACHE_FILE", os.path.join(SHARED_CACHE_DIR, "cache.bin"))
+SHARED_CACHE_SLOTS = int(os.environ.get("SHARED_CACHE_SLOTS", 128))
+SHARED_CACHE_SLOT_SIZE = int(os.environ.get("SHARED_CACHE_SLOT_SIZE", 256 * 1024))
+SHARED_CACHE_TTL = int(os.environ.get("SHARED_CACHE_TTL", 300))
+SHARED_CACHE_ENABLED = os.environ.get("SHARED_CACHE", "on") != "off"
+SHARED_CACHE_WAYS = 8
+READ_ATTEMPTS = 3
+
+MAGIC = b"QEPCACHE"
+"""
+File header: magic, number of slots and size of the data of each slot.
+"""
+FILE_HEADER = struct.Struct("<8sII")
+"""
+Slot header: sequence number, which is odd while the slot is written, SHA-1 of the key,
+time it was written, time it was last read and length of the data that follows it.
+"""
+SLOT_HEADER = struct.Struct("<Q20sddI")
+SEQUENCE = struct.Struct("<Q")
+LAST_USED = struct.Struct("<d")
+LAST_USED_OFFSET = SEQUENCE.size + 20 + 8
+
+
+def check_private(path, st):
+    """Checks that a file or directory belongs to the user running the app and that no one else can write to it,
+    since every process mapping the cache trusts what it reads from it.
+
+    Args:
+        path (str): Path of the file or directory.
+        st (os.stat_result): Its status.
+
+    Raises:
+        PermissionError: The file or directory belongs to another user or is writable by others.
+    """
+    if not hasattr(os, "getuid"):
+        return
+    if st.st_uid != os.getuid() or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise PermissionError(f"{path} must belong to the user running the app and be writable by it only")
+
+
+class SharedCache:
+    def __init__(self, file_name=SHARED_CACHE_FILE, num_slots=SHARED_CACHE_SLOTS, slot_size=SHARED_CACHE_SLOT_SIZE,
+                 ttl=SHARED_CACHE_TTL, ways=SHARED_CACHE_WAYS, enabled=SHARED_CACHE_ENABLED):
+        """Cache of byte strings in a memory-mapped file, shared by every process that maps the same file,
+        such as the workers of a prefork server. The file is divided in fixed-size slots, and a key can only be
+        kept in the SHARED_CACHE_WAYS slots of its bucket, the least recently read of which is evicted to make room.
+
+        Reads take no lock: each slot has a sequence number that writers make odd for the duration of a write,
+        so a reader copies the slot and retries when the sequence number was odd or changed meanwhile.
+        Writers lock the bucket they write to, with fcntl across processes and a thread lock within a process.
+
+        Args:
+            file_name (str, optional): File to map. Defaults to SHARED_CACHE_FILE.
+            num_slots (int, optional): Number of slots, rounded up to a whole number of buckets.
+            Defaults to SHARED_CACHE_SLOTS.
+            slot_size (int, optional): Largest value in bytes. Defaults to SHARED_CACHE_SLOT_SIZE.
+            ttl (int, optional): Seconds after which a value is stale. Defaults to SHARED_CACHE_TTL.
+            ways (int, optional): Number of slots per bucket. Defaults to SHARED_CACHE_WAYS.
+            enabled (bool, optional): Whether to cache at all. When it does not, no file is mapped and every lookup
+            misses. Defaults to SHARED_CACHE_ENABLED, i.e. unless the SHARED_CACHE environment variable is "off".
+        """
+        self.ways = ways
+        self.num_buckets = max(1, -(-num_slots // ways))
+        self.num_slots = self.num_buckets * ways
+        self.slot_size = slot_size
+        self.slot_stride = SLOT_HEADER.size + slot_size
+        self.ttl = ttl
+        self.size = FILE_HEADER.size + self.num_slots * self.slot_stride
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.lock = threading.Lock()
+
+        self.file_name = file_name
+        self.map = None
+        if not enabled:
+            return
+        if os.path.dirname(os.path.abspath(file_name)) == SHARED_CACHE_DIR:
+            os.makedirs(SHARED_CACHE_DIR, mode=0o700, exist_ok=True)
+            directory = os.lstat(SHARED_CACHE_DIR)
+            if not stat.S_ISDIR(directory.st_mode) or directory.st_mode & 0o077:
+                raise PermissionError(f"{SHARED_CACHE_DIR} must be a directory that only its owner can enter")
+            check_private(SHARED_CACHE_DIR, directory)
+        self.fd = os.open(file_name, os.O_RDWR | os.O_CREAT | getattr(os, "O_NOFOLLOW", 0), 0o600)
+        check_private(file_name, os.fstat(self.fd))
+        with self.locked(0, FILE_HEADER.size):
+            header = os.read(self.fd, FILE_HEADER.size)
+            if header != FILE_HEADER.pack(MAGIC, self.num_slots, slot_size) or os.fstat(self.fd).st_size != self.size:
+                # A new file, or one laid out differently: every slot is emptied
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, self.size)
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                os.write(self.fd, FILE_HEADER.pack(MAGIC, self.num_slots, slot_size))
+        self.map = mmap.mmap(self.fd, self.size)
+
+    @contextmanager
+    def locked(self, start, length):
+        """Locks a range of the file for the duration of a with block, against other threads and processes.
+
+        Args:
+            start (int): Offset of the range.
+            length (int): Length of the range.
+        """
+        with self.lock:
+            if fcntl is None:
+                yield
+                return
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, length, start)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, length, start)
+
+    def bucket_slots(self, digest) -> range:
+        bucket = int.from_bytes(digest[:8], "little") % self.num_buckets
+        return range(bucket * self.ways, (bucket + 1) * self.ways)
+
+    def slot_offset(self, slot) -> int:
+        return FILE_HEADER.size + slot * self.slot_stride
+
+    def read_slot(self, slot, digest):
+        """Copies the value of a slot if it holds the key, without locking.
+
+        Args:
+            slot (int): Index of the slot.
+            digest (bytes): SHA-1 of the key.
+
+        Returns:
+            bytes: The value, or None if the slot holds another key, a stale value or is being written.
+        """
+        offset = self.slot_offset(slot)
+        for attempt in range(READ_ATTEMPTS):
+            sequence, slot_digest, created, last_used, length = SLOT_HEADER.unpack_from(self.map, offset)
+            if sequence % 2:
+                time.sleep(0)
+                continue
+            if slot_digest != digest or time.time() - created > self.ttl:
+                return None
+            start = offset + SLOT_HEADER.size
+            value = self.map[start:start + length]
+            if SEQUENCE.unpack_from(self.map, offset)[0] == sequence:
+                # Recording the read is a hint for eviction, so a lost update is harmless
+                LAST_USED.pack_into(self.map, offset + LAST_USED_OFFSET, time.time())
+                return value
+        return None
+
+    def get(self, key: str):
+        """Looks a value up.
+
+        Args:
+            key (str): Key of the value.
+
+        Returns:
+            bytes: The value, or None if it is not cached.
+        """
+        if self.map is None:
+            self.misses += 1
+            return None
+        digest = hashlib.sha1(key.encode("utf-8")).digest()
+        for slot in self.bucket_slots(digest):
+            value = self.read_slot(slot, digest)
+            if value is not None:
+                self.hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    def contains(self, key: str) -> bool:
+        """Checks whether a value is cached, without copying it.
+
+        Args:
+            key (str): Key of the value.
+
+        Returns:
+            bool: Whether a value that is not stale is cached under the key.
+        """
+        if self.map is None:
+            return False
+        digest = hashlib.sha1(key.encode("utf-8")).digest()
+        for slot in self.bucket_slots(digest):
+            _, slot_digest, created, _, _ = SLOT_HEADER.unpack_from(self.map, self.slot_offset(slot))
+            if slot_digest == digest and time.time() - created <= self.ttl:
+                return True
+        return False
+
+    def put(self, key: str, value: bytes) -> bool:
+        """Stores a value in the slot of its bucket that holds the same key, or is empty, or was read least recently.
+
+        Args:
+            key (str): Key of the value.
+            value (bytes): Value to store.
+
+        Returns:
+            bool: Whether the value was stored, which it is not when it is larger than a slot.
+        """
+        if self.map is None or len(value) > self.slot_size:
+            return False
+
+        digest = hashlib.sha1(key.encode("utf-8")).digest()
+        slots = self.bucket_slots(digest)
+        with self.locked(self.slot_offset(slots.start), self.ways * self.slot_stride):
+            victim = None
+            victim_last_used = None
+            for slot in slots:
+                _, slot_digest, created, last_used, _ = SLOT_HEADER.unpack_from(self.map, self.slot_offset(slot))
+                if slot_digest == digest or created == 0:
+                    victim = slot
+                    break
+                if victim is None or last_used < victim_last_used:
+                    victim, victim_last_used = slot, last_used
+
+            offset = self.slot_offset(victim)
+            sequence = SEQUENCE.unpack_from(self.map, offset)[0]
+            SEQUENCE.pack_into(self.map, offset, sequence + 1)
+            now = time.time()
+            self.map[offset + SLOT_HEADER.size:offset + SLOT_HEADER.size + len(value)] = value
+            SLOT_HEADER.pack_into(self.map, offset, sequence + 1, digest, now, now, len(value))
+            SEQUENCE.pack_into(self.map, offset, sequence + 2)
+            self.stores += 1
+        return True
+
+    def get_object(self, key: str):
+        value = self.get(key)
+        return json.loads(value) if value is not None else None
+
+    def put_object(self, key: str, obj) -> bool:
+        """Stores an object as JSON, unless it cannot be serialised to JSON.
+        Objects are never pickled, so that reading the cache cannot run code.
+
+        Args:
+            key (str): Key of the object.
+            obj (object): Object to store.
+
+        Returns:
+            bool: Whether the object was stored.
+        """
+        try:
+            value = json.dumps(obj, separators=(",", ":")).encode("utf-8")
+        except (TypeError, ValueError):
+            return False
+        return self.put(key, value)
+
+    def stats(self) -> dict:
+        """Counts the slots in use, for all processes, and the hits and misses of this process.
+
+        Returns:
+            dict: Statistics of the cache.
+        """
+        used = 0
+        for slot in range(self.num_slots if self.map is not None else 0):
+            if SLOT_HEADER.unpack_from(self.map, self.slot_offset(slot))[2] > 0:
+                used += 1
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.map is not None,
+            "file": self.file_name,
+            "slots": self.num_slots,
+            "slot_size": self.slot_size,
+            "used": used,
+            "pid": os.getpid(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
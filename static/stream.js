@@ -0,0 +1,132 @@
+// Explains the query over Server-Sent Events from /stream, showing each result as soon as it arrives
+document.getElementById("btnStream").addEventListener("click", function () {
+  var query = document.getElementById("queryTextArea").value;
+  var params = new URLSearchParams({ queryText: query });
+  if (document.getElementById("expandPlan").checked) {
+    params.set("expandPlan", "1");
+  }
+
+  document.getElementById("result").hidden = true;
+  document.getElementById("streamResult").hidden = false;
+  ["streamInfo", "streamHotOperators", "streamComparisons", "streamExplanation"].forEach(function (id) {
+    document.getElementById(id).innerHTML = "";
+  });
+  document.getElementById("streamRegression").hidden = true;
+  document.getElementById("streamGraph").hidden = true;
+
+  var status = document.getElementById("streamStatus");
+  status.textContent = "Validating and explaining the query...";
+  var source = new EventSource("/stream?" + params.toString());
+
+  function listItem(parent, text) {
+    var item = document.createElement("li");
+    item.textContent = text;
+    document.getElementById(parent).appendChild(item);
+    return item;
+  }
+
+  // Annotations arrive as [text, style] tokens, style being a combination of BOLD and ITALIC
+  var BOLD = 1;
+  var ITALIC = 2;
+
+  function annotationItem(parent, tokens) {
+    var item = listItem(parent, "");
+    tokens.forEach(function (token) {
+      var node = document.createTextNode(token[0]);
+      if (token[1] & BOLD) {
+        var bold = document.createElement("b");
+        bold.appendChild(node);
+        node = bold;
+      }
+      if (token[1] & ITALIC) {
+        var italic = document.createElement("em");
+        italic.appendChild(node);
+        node = italic;
+      }
+      item.appendChild(node);
+    });
+  }
+
+  function cell(row, text) {
+    var td = document.createElement("td");
+    td.textContent = text;
+    row.appendChild(td);
+  }
+
+  function showExplanation(explanation) {
+    document.getElementById("streamExplanation").innerHTML = "";
+    explanation.forEach(function (tokens) {
+      annotationItem("streamExplanation", tokens);
+    });
+  }
+
+  source.addEventListener("qep", function (event) {
+    var data = JSON.parse(event.data);
+    status.textContent = "Comparing with alternative plans...";
+    [
+      ["Total Cost", data.total_cost],
+      ["Total no. of index scans", data.total_index_scan],
+      ["Total no. of sequential scans", data.total_seq_scan],
+      ["Total no. of rows", data.total_plan_rows],
+      ["Total no. of parallel nodes", data.total_parallel_nodes],
+      ["Total no. of parallel workers planned", data.total_workers_planned],
+    ].forEach(function (info) {
+      var item = document.createElement("li");
+      item.textContent = info[0] + ": " + info[1];
+      document.getElementById("streamInfo").appendChild(item);
+    });
+    data.hot_operators.forEach(function (node) {
+      var row = document.createElement("tr");
+      cell(row, node.node_type + (node.relation_name ? " on " + node.relation_name : "") +
+        (node.count > 1 ? " (x" + node.count + ")" : ""));
+      cell(row, node.exclusive_cost.toFixed(2));
+      cell(row, node.startup_cost);
+      cell(row, node.run_cost.toFixed(2));
+      cell(row, (node.cost_share * 100).toFixed(1) + "%");
+      document.getElementById("streamHotOperators").appendChild(row);
+    });
+    showExplanation(data.explanation);
+  });
+
+  source.addEventListener("comparison", function (event) {
+    JSON.parse(event.data).comparisons.forEach(function (comparison) {
+      listItem("streamComparisons", comparison);
+    });
+  });
+
+  source.addEventListener("explanation", function (event) {
+    status.textContent = "Rendering the plan...";
+    showExplanation(JSON.parse(event.data).explanation);
+  });
+
+  source.addEventListener("regression", function (event) {
+    var data = JSON.parse(event.data);
+    var alert = document.getElementById("streamRegression");
+    alert.textContent = "Plan regression detected: the plan changed shape and its estimated cost rose from " +
+      data.before + " to " + data.after + " (+" + (data.cost_increase * 100).toFixed(1) + "%).";
+    alert.hidden = false;
+  });
+
+  source.addEventListener("graph", function (event) {
+    var graph = document.getElementById("streamGraph");
+    graph.src = JSON.parse(event.data).url;
+    graph.hidden = false;
+  });
+
+  source.addEventListener("done", function () {
+    status.textContent = "";
+    source.close();
+  });
+
+  source.addEventListener("failed", function (event) {
+    status.textContent = JSON.parse(event.data).message;
+    source.close();
+  });
+
+  source.onerror = function () {
+    if (source.readyState !== EventSource.CLOSED) {
+      status.textContent = "The connection to the server was lost.";
+      source.close();
+    }
+  };
+});
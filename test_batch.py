@@ -0,0 +1,22 @@
+from batch import split_statements
+
+
+def test_split_statements():
+    assert split_statements("SELECT 'a;b'; SELECT 'it''s;' ;\n\n") == ["SELECT 'a;b'", "SELECT 'it''s;'"]
+
+
+def test_split_statements_skips_comments():
+    assert split_statements("-- customer's orders\nSELECT 1;\nSELECT 2;") == ["-- customer's orders\nSELECT 1",
+                                                                               "SELECT 2"]
+    assert split_statements("/* it's /* nested; */ still; */ SELECT 1; SELECT 2") == [
+        "/* it's /* nested; */ still; */ SELECT 1", "SELECT 2"]
+
+
+def test_split_statements_skips_dollar_quotes():
+    assert split_statements("SELECT $$a;b$$; SELECT 3") == ["SELECT $$a;b$$", "SELECT 3"]
+    assert split_statements("SELECT $fn$ $$; '; $fn$; SELECT 3") == ["SELECT $fn$ $$; '; $fn$", "SELECT 3"]
+
+
+def test_split_statements_skips_identifiers_and_escapes():
+    assert split_statements('SELECT 1 AS "a;b"; SELECT E\'it\\\'s;\'; SELECT $1') == [
+        'SELECT 1 AS "a;b"', "SELECT E'it\\'s;'", "SELECT $1"]
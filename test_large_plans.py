@@ -0,0 +1,125 @@
+import json
+from random import Random
+
+import pytest
+
+import loadtest
+from history import flatten_plan, unflatten_plan
+from interface import QueryPlan, get_tree_node_pos
+from preprocessing import *
+
+# synthetic_plan makes about 9 nodes for every 10 asked for, so this is a plan of over 50,000 nodes,
+# nested far deeper than the recursion limit
+PLAN_SIZE = 56000
+MIN_NODES = 50000
+SEED = 28
+
+
+def plan_json(plan) -> str:
+    """Serialises a plan as the JSON output of EXPLAIN without recursion, since json.dumps cannot nest this deep.
+
+    Args:
+        plan (dict): The plan.
+
+    Returns:
+        str: The JSON document.
+    """
+    parts = ['[{"Plan": ']
+    stack = [plan]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            parts.append(item)
+            continue
+        children = item.get("Plans", [])
+        text = json.dumps({key: value for key, value in item.items() if key != "Plans"})
+        if not children:
+            parts.append(text)
+            continue
+        parts.append(text[:-1] + ', "Plans": [')
+        stack.append("]}")
+        for index, child in enumerate(reversed(children)):
+            if index:
+                stack.append(", ")
+            stack.append(child)
+    parts.append("}]")
+    return "".join(parts)
+
+
+def deepest_node(plan) -> dict:
+    """Follows the first child of each node down to a leaf, i.e. the first scan of a left-deep plan."""
+    while plan.get("Plans"):
+        plan = plan["Plans"][0]
+    return plan
+
+
+@pytest.fixture(scope="module")
+def plan():
+    return loadtest.synthetic_plan(PLAN_SIZE, Random(SEED))
+
+
+@pytest.fixture(scope="module")
+def query_plan(plan):
+    return QueryPlan(plan, {})
+
+
+@pytest.fixture(scope="module")
+def processor():
+    return loadtest.ReplayQueryProcessor(target_configs[DEFAULT_TARGET])
+
+
+def test_query_plan(plan, query_plan):
+    num_nodes = len(flatten_plan(plan))
+    assert num_nodes >= MIN_NODES
+    assert query_plan.graph.number_of_nodes() == num_nodes
+    assert sum(query_plan.node_type_counts.values()) == num_nodes
+    assert query_plan.total_cost == plan["Total Cost"]
+    assert query_plan.explanation
+
+
+def test_get_tree_node_pos(query_plan):
+    positions = get_tree_node_pos(query_plan.graph, query_plan.root)
+
+    assert len(positions) == query_plan.graph.number_of_nodes()
+    for parent, child in query_plan.graph.edges:
+        assert positions[child][1] < positions[parent][1]
+
+
+def test_parse_json_iteratively(plan):
+    text = plan_json(plan)
+
+    with pytest.raises(RecursionError):
+        json.loads(text)
+    assert flatten_plan(parse_json_iteratively(text)[0]["Plan"]) == flatten_plan(plan)
+    assert flatten_plan(parse_plan_json(text)[0]["Plan"]) == flatten_plan(plan)
+
+
+def test_scan_tree(plan, processor):
+    assert processor.scan_tree(plan, plan) == {}
+
+    # The only difference between the plans is a costlier scan at the bottom of the tree
+    aqp = unflatten_plan(flatten_plan(plan))
+    leaf = deepest_node(aqp)
+    leaf["Node Type"] = "Index Scan" if leaf["Node Type"] == "Seq Scan" else "Seq Scan"
+    leaf["Total Cost"] += 100.0
+    assert processor.scan_tree(plan, aqp)
+
+
+def test_calculate_plan_hash(plan, query_plan):
+    assert query_plan.calculate_plan_hash() == QueryPlan(unflatten_plan(flatten_plan(plan)), {}).calculate_plan_hash()
+
+    changed = unflatten_plan(flatten_plan(plan))
+    deepest_node(changed)["Total Cost"] += 1.0
+    assert query_plan.calculate_plan_hash() != QueryPlan(changed, {}).calculate_plan_hash()
+
+
+def test_result(client, monkeypatch):
+    # Drawing 50,000 nodes takes minutes, while laying them out is covered by test_get_tree_node_pos
+    monkeypatch.setattr(QueryPlan, "render_graph_bytes", lambda self: b"\x89PNG\r\n\x1a\n")
+
+    query = loadtest.synthetic_query(PLAN_SIZE, SEED)
+    response = client.post("/result", data={"queryText": query, "expandPlan": "on"})
+
+    assert response.status_code == 200
+    assert b"could not be explained" not in response.data
+    assert b"/graphs/" in response.data
@@ -0,0 +1,78 @@
+import pytest
+
+from annotation import render_text
+from interface import QueryPlan
+from preprocessing import *
+
+
+def scan(relation, cost=10.0):
+    return {"Node Type": "Seq Scan", "Parallel Aware": False, "Relation Name": relation, "Alias": relation,
+            "Startup Cost": 0.0, "Total Cost": cost, "Plan Rows": 100, "Plan Width": 8}
+
+
+def join(node_type, plans, cost=100.0, **fields):
+    return dict({"Node Type": node_type, "Parallel Aware": False, "Join Type": "Inner", "Startup Cost": 0.0,
+                 "Total Cost": cost, "Plan Rows": 100, "Plan Width": 16, "Plans": plans}, **fields)
+
+
+@pytest.fixture
+def processor():
+    # Comparing plans never connects to the database
+    return QueryProcessor(target_configs[DEFAULT_TARGET])
+
+
+def node_explanations(plan) -> dict:
+    return {(node.node_type, getattr(node, "relation_name", "")): render_text(node.explanation)
+            for node in plan.graph.nodes}
+
+
+def test_operator_choice_of_join_without_condition(processor):
+    # A nested loop without a join filter has no condition to key its comparison by
+    qep = join("Nested Loop", [scan("orders"), scan("customer")])
+    aqp = join("Hash Join", [scan("orders"), {"Node Type": "Hash", "Parallel Aware": False, "Startup Cost": 10.0,
+                                              "Total Cost": 10.0, "Plan Rows": 100, "Plan Width": 8,
+                                              "Plans": [scan("customer")]}], cost=150.0)
+
+    comparisons = processor.explain_operator_choice(qep, aqp, "enable_nestloop")
+    plan = QueryPlan(qep, comparisons)
+    annotate_operator_choices(plan, comparisons)
+
+    explanations = node_explanations(plan)
+    assert "Nested Loop was chosen over Hash Join" in explanations[("Nested Loop", "")]
+    assert "chosen over" not in explanations[("Seq Scan", "orders")]
+    assert "Nested Loop was chosen over Hash Join" in render_text("".join(plan.explanation))
+
+
+def test_operator_choice_of_scan_stays_on_its_node(processor):
+    qep = join("Merge Join", [scan("orders"), scan("customer")], **{"Merge Cond": "(o_custkey = c_custkey)"})
+    aqp = join("Merge Join", [scan("orders", cost=50.0), scan("customer")], cost=140.0,
+               **{"Merge Cond": "(o_custkey = c_custkey)"})
+    aqp["Plans"][0]["Node Type"] = "Index Scan"
+
+    comparisons = processor.explain_operator_choice(qep, aqp, "enable_seqscan")
+    plan = QueryPlan(qep, comparisons)
+    annotate_operator_choices(plan, comparisons)
+
+    explanations = node_explanations(plan)
+    assert "Seq Scan was chosen over Index Scan" in explanations[("Seq Scan", "orders")]
+    assert "Seq Scan was chosen over Index Scan" not in explanations[("Seq Scan", "customer")]
+    assert "Seq Scan was chosen over Index Scan" not in explanations[("Merge Join", "")]
+
+
+def test_work_mem_of_hash_above_collapsed_partitions():
+    partitions = [scan(f"orders_p{index}") for index in range(5)]
+    append = {"Node Type": "Append", "Parallel Aware": False, "Startup Cost": 0.0, "Total Cost": 50.0,
+              "Plan Rows": 500, "Plan Width": 8, "Plans": partitions}
+    hash_node = {"Node Type": "Hash", "Parallel Aware": False, "Startup Cost": 50.0, "Total Cost": 50.0,
+                 "Plan Rows": 500, "Plan Width": 8, "Plans": [append]}
+    qep = join("Hash Join", [scan("customer"), hash_node], **{"Hash Cond": "(c_custkey = o_custkey)"})
+
+    # The sweep plans are not collapsed, while the QEP of the result page is
+    operators = {key: {"min_work_mem": 8192, "memory": 8192, "spilled": None}
+                 for _, key in memory_operators(qep)}
+    plan = QueryPlan(collapse_plan(qep), {})
+    assert len(plan.graph.nodes) < len(plan_alignment_keys(qep))
+    annotate_work_mem(plan, {"operators": operators, "work_mem": 4096})
+
+    explanations = node_explanations(plan)
+    assert "needs at least 8MB to run in memory" in explanations[("Hash", "")]
@@ -0,0 +1,43 @@
+import json
+
+import loadtest
+from preprocessing import QueryProcessor
+
+
+def stream_events(client, query) -> list:
+    response = client.get("/stream", query_string={"queryText": query})
+    assert response.status_code == 200
+    events = []
+    for message in response.get_data(as_text=True).split("\n\n"):
+        if message:
+            event, data = message.split("\n")
+            events.append((event[len("event: "):], json.loads(data[len("data: "):])))
+    return events
+
+
+def test_stream_sends_qep_without_executing_query(client, monkeypatch):
+    def query_valid(self, query):
+        raise AssertionError("the query was executed")
+
+    monkeypatch.setattr(QueryProcessor, "query_valid", query_valid)
+
+    events = stream_events(client, loadtest.synthetic_query(20, 41))
+
+    assert events[0][0] == "qep"
+    assert events[-1][0] == "done"
+
+
+def test_stream_fails_on_error(client, monkeypatch):
+    def explain_progressively(self, query, collapse=True):
+        yield "comparison", {}
+        raise RuntimeError("connection lost")
+
+    monkeypatch.setattr(QueryProcessor, "explain_progressively", explain_progressively)
+
+    events = stream_events(client, loadtest.synthetic_query(20, 42))
+
+    assert events[-1] == ("failed", {"message": "Query could not be explained."})
+
+
+def test_stream_fails_on_empty_query(client):
+    assert stream_events(client, " ") == [("failed", {"message": "Query is empty."})]
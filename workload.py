@@ -0,0 +1,258 @@
+import argparse
+import json
+import re
+import sys
+
+import numpy as np
+
+from preprocessing import *
+
+PG_STAT_STATEMENTS_BATCH_SIZE = 1000
+DEFAULT_TOP_N = 50
+SEQ_SCAN_NODES = ["Seq Scan"]
+INDEX_SCAN_NODES = ["Index Scan", "Index Only Scan", "Bitmap Heap Scan"]
+
+LOG_STATEMENT = re.compile(r"(?:duration: ([\d.]+) ms\s+)?(?:statement|execute [^:]*): (.*)$")
+
+
+def stream_pg_stat_statements(processor):
+    """Streams the statements recorded by the pg_stat_statements extension through a server-side cursor,
+    so that the statistics are never held in memory all at once.
+
+    Args:
+        processor (QueryProcessor): Processor connected to the database with pg_stat_statements installed.
+
+    Yields:
+        tuple: The query, the number of calls and the mean execution time in milliseconds.
+    """
+    # The mean execution time column was renamed in PostgreSQL 13
+    mean_time = "mean_exec_time" if processor.conn.server_version >= 130000 else "mean_time"
+    try:
+        with processor.conn.cursor(name="workload_statements") as cursor:
+            cursor.itersize = PG_STAT_STATEMENTS_BATCH_SIZE
+            cursor.execute(f"SELECT query, calls, {mean_time} FROM pg_stat_statements")
+            for query, calls, mean in cursor:
+                yield query, calls, mean
+    finally:
+        processor.conn.rollback()
+
+
+def stream_log_file(file_name):
+    """Streams the statements logged in a PostgreSQL log file (log_statement or log_min_duration_statement),
+    joining the continuation lines of statements that span several lines.
+
+    Args:
+        file_name (str): Path of the log file.
+
+    Yields:
+        tuple: The query, a single call and its duration in milliseconds (0 if it was not logged).
+    """
+    query = None
+    duration = 0.0
+    with open(file_name, errors="replace") as log_file:
+        for line in log_file:
+            line = line.rstrip("\n")
+            if query is not None and line.startswith("\t"):
+                query += "\n" + line[1:]
+                continue
+
+            if query is not None:
+                yield query, 1, duration
+                query = None
+
+            match = LOG_STATEMENT.search(line)
+            if match:
+                duration = float(match.group(1) or 0.0)
+                query = match.group(2)
+
+    if query is not None:
+        yield query, 1, duration
+
+
+def deduplicate_statements(statements) -> dict:
+    """Groups statements by fingerprint, adding up their calls and time.
+
+    Args:
+        statements (iterable): Tuples of query, number of calls and mean time in milliseconds.
+
+    Returns:
+        dict: Mapping of fingerprint to its query, calls and total time.
+    """
+    workload = {}
+    for query, calls, mean_time in statements:
+        fingerprint = fingerprint_query(query)
+        entry = workload.setdefault(fingerprint, {"query": query, "calls": 0, "total_time": 0.0})
+        entry["calls"] += calls
+        entry["total_time"] += calls * mean_time
+    return workload
+
+
+def top_statements(workload: dict, top_n=DEFAULT_TOP_N) -> list:
+    """Ranks the statements by calls × mean time, i.e. the total time spent on them,
+    then by calls for logs without durations.
+
+    Returns:
+        list: The top_n (fingerprint, statement) pairs.
+    """
+    return sorted(workload.items(), key=lambda item: (item[1]["total_time"], item[1]["calls"]),
+                  reverse=True)[:top_n]
+
+
+def explain_statements(processor, statements) -> tuple:
+    """Explains each statement, skipping those that cannot be explained. Only the QEP is needed, so no AQP is planned.
+    Parameterized statements, as recorded by pg_stat_statements, are explained with their generic plan.
+    Plans are not collapsed, so that every node of the plan is counted and costed.
+
+    Returns:
+        tuple: The (fingerprint, statement, QueryPlan) triples and the skipped statements with the reason.
+    """
+    explained = []
+    skipped = []
+    for fingerprint, statement in statements:
+        statement["generic_plan"] = count_parameters(statement["query"]) > 0
+        if statement["generic_plan"]:
+            parameterized = processor.explain_parameterized(statement["query"], collapse=False)
+            plan = parameterized["generic"] if parameterized is not None else None
+        else:
+            plan = processor.explain_qep(statement["query"], collapse=False)
+        if plan is None:
+            skipped.append({"fingerprint": fingerprint, "query": statement["query"], "reason": "explain failed"})
+            continue
+        explained.append((fingerprint, statement, plan))
+    return explained, skipped
+
+
+def summarise_workload(explained) -> dict:
+    """Aggregates the explained statements into operator, table and cost statistics.
+    Every node is weighted by the number of calls of its statement, and the node types and relations
+    are reduced with NumPy over flat arrays of the nodes of every plan.
+
+    Args:
+        explained (list): The (fingerprint, statement, QueryPlan) triples.
+
+    Returns:
+        dict: The workload statistics.
+    """
+    node_types = []
+    relations = []
+    exclusive_costs = []
+    weights = []
+    for _, statement, plan in explained:
+        for node in plan.graph.nodes:
+            node_types.append(node.node_type)
+            relations.append(getattr(node, "relation_name", ""))
+            exclusive_costs.append(node.exclusive_cost)
+            weights.append(statement["calls"])
+
+    if not node_types:
+        return {"num_statements": 0, "operators": [], "tables": [], "scans": {}, "cost_distribution": {}}
+
+    exclusive_costs = np.array(exclusive_costs, dtype=float)
+    weighted_costs = exclusive_costs * np.array(weights, dtype=float)
+    workload_cost = weighted_costs.sum()
+
+    # Operators and tables, ranked by their share of the weighted estimated cost
+    type_names, type_index = np.unique(np.array(node_types), return_inverse=True)
+    type_costs = np.bincount(type_index, weights=weighted_costs)
+    type_counts = np.bincount(type_index)
+    operators = [
+        {"node_type": str(type_names[i]), "count": int(type_counts[i]), "weighted_cost": float(type_costs[i]),
+         "share": float(type_costs[i] / workload_cost) if workload_cost else 0.0}
+        for i in np.argsort(-type_costs)
+    ]
+
+    relation_names, relation_index = np.unique(np.array(relations), return_inverse=True)
+    relation_costs = np.bincount(relation_index, weights=weighted_costs)
+    tables = [
+        {"relation": str(relation_names[i]), "weighted_cost": float(relation_costs[i]),
+         "share": float(relation_costs[i] / workload_cost) if workload_cost else 0.0}
+        for i in np.argsort(-relation_costs) if relation_names[i]
+    ]
+
+    # Sequential against index scans
+    num_seq_scans = int(type_counts[np.isin(type_names, SEQ_SCAN_NODES)].sum())
+    num_index_scans = int(type_counts[np.isin(type_names, INDEX_SCAN_NODES)].sum())
+    num_scans = num_seq_scans + num_index_scans
+
+    # Distribution of the estimated cost of the statements
+    total_costs = np.array([plan.query_plan["Total Cost"] for _, _, plan in explained], dtype=float)
+    percentiles = np.percentile(total_costs, [50, 90, 99])
+
+    return {
+        "num_statements": len(explained),
+        "operators": operators,
+        "tables": tables,
+        "scans": {
+            "seq_scans": num_seq_scans,
+            "index_scans": num_index_scans,
+            "seq_scan_ratio": num_seq_scans / num_scans if num_scans else 0.0,
+        },
+        "cost_distribution": {
+            "mean": float(total_costs.mean()),
+            "p50": float(percentiles[0]),
+            "p90": float(percentiles[1]),
+            "p99": float(percentiles[2]),
+            "max": float(total_costs.max()),
+        },
+    }
+
+
+def analyse_workload(processor, statements, top_n=DEFAULT_TOP_N) -> dict:
+    """Deduplicates a stream of statements, explains the top_n by calls × mean time and summarises them.
+
+    Args:
+        processor (QueryProcessor): Processor to explain the statements with.
+        statements (iterable): Tuples of query, number of calls and mean time in milliseconds.
+        top_n (int, optional): Number of statements to explain. Defaults to DEFAULT_TOP_N.
+
+    Returns:
+        dict: The workload report.
+    """
+    workload = deduplicate_statements(statements)
+    explained, skipped = explain_statements(processor, top_statements(workload, top_n))
+
+    report = summarise_workload(explained)
+    report["num_fingerprints"] = len(workload)
+    report["statements"] = [
+        {"fingerprint": fingerprint, "query": statement["query"], "calls": statement["calls"],
+         "mean_time": statement["total_time"] / statement["calls"] if statement["calls"] else 0.0,
+         "total_cost": plan.query_plan["Total Cost"], "node_type_counts": plan.node_type_counts,
+         "generic_plan": statement["generic_plan"]}
+        for fingerprint, statement, plan in explained
+    ]
+    report["skipped"] = skipped
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Explain and summarise the most expensive statements of a workload.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--pg-stat-statements", action="store_true", help="read statements from pg_stat_statements")
+    source.add_argument("--log", help="read statements from a PostgreSQL log file")
+    parser.add_argument("-n", "--top", type=int, default=DEFAULT_TOP_N, help="number of statements to explain")
+    parser.add_argument("-t", "--target", default=DEFAULT_TARGET, choices=list(target_configs.keys()),
+                        help="PostgreSQL target to explain against")
+    parser.add_argument("-o", "--output", default="workload.json", help="file to write the report to")
+    args = parser.parse_args(argv)
+
+    processor = QueryProcessor(target_configs[args.target])
+    statements = stream_pg_stat_statements(processor) if args.pg_stat_statements else stream_log_file(args.log)
+    report = analyse_workload(processor, statements, args.top)
+    processor.stop_db_connection()
+
+    with open(args.output, "w") as report_file:
+        json.dump(report, report_file, indent=2)
+
+    print(f"Explained {report['num_statements']} of {report['num_fingerprints']} distinct statements "
+          f"({len(report['skipped'])} skipped). Report written to {args.output}")
+    print("Operators by share of estimated cost:")
+    for operator in report["operators"][:10]:
+        print(f"  {operator['node_type']}: {operator['share']:.1%}")
+    print("Tables by share of estimated cost:")
+    for table in report["tables"][:10]:
+        print(f"  {table['relation']}: {table['share']:.1%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())